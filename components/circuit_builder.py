@@ -1,24 +1,40 @@
 import streamlit as st
 import plotly.graph_objects as go
 import numpy as np
-from quantum_utils import QuantumComputer
+from quantum_utils import (QuantumComputer, Circuit, PrefixStateCache, as_circuit, optimize_circuit,
+                           top_k_indices, PRECISIONS, EQUIVALENCE_CHECK_MAX_QUBITS)
 from components.circuit_heatmap import create_circuit_heatmap, show_performance_metrics
 
+# Shot counts offered for a run; large counts are drawn in one vectorized step
+SHOT_OPTIONS = [100, 1000, 10_000, 100_000, 1_000_000]
+
+# Rows of the state-vector and measurement tables; only the largest entries are shown
+MAX_STATE_ROWS = 32
+MAX_MEASUREMENT_ROWS = 64
+
+# Confidence interval widths offered for adaptive sampling
+TOLERANCE_OPTIONS = [0.1, 0.05, 0.02, 0.01, 0.005]
+
 def show_circuit_builder():
     st.title("Quantum Circuit Builder")
 
-    # Initialize quantum computer
-    qc = QuantumComputer()
-    available_gates = qc.get_available_gates()
-
     # Circuit building interface
     st.subheader("Build Your Circuit")
 
     # Number of qubits selector
-    num_qubits = st.slider("Number of Qubits", 1, 3, 1)
+    num_qubits = st.slider("Number of Qubits", 1, 20, 1)
+
+    # Intermediate states survive reruns, so adding a gate costs one gate application
+    if 'prefix_cache' not in st.session_state:
+        st.session_state.prefix_cache = PrefixStateCache()
+
+    # Initialize quantum computer; the planner picks an engine for each circuit
+    qc = QuantumComputer(engine='auto', prefix_cache=st.session_state.prefix_cache,
+                         session=st.session_state.get('simulation_session'))
+    available_gates = qc.get_available_gates()
 
     # Circuit operations with state tracking
-    circuit_ops = []
+    circuit_ops = Circuit()
 
     # Show current circuit state
     if 'circuit_ops' not in st.session_state:
@@ -28,9 +44,6 @@ def show_circuit_builder():
     if not st.session_state.circuit_ops:
         st.info("Circuit is empty. Add gates using the controls below.")
 
-    # Initialize quantum computer instance
-    qc = QuantumComputer()
-
     # Display available gates with descriptions
     st.subheader("Available Gates")
     for gate, description in qc.gate_descriptions.items():
@@ -52,11 +65,7 @@ def show_circuit_builder():
 
             for gate in gates:
                 try:
-                    new_op = {
-                        'gate': gate,
-                        'target': i
-                    }
-                    circuit_ops.append(new_op)
+                    circuit_ops.append(gate, i)
                     st.success(f"Added {gate} gate to qubit {i}")
                 except Exception as e:
                     st.error(f"Failed to add gate: {str(e)}")
@@ -77,11 +86,7 @@ def show_circuit_builder():
                         target_options,
                         key=f"target_{i}_{gate}"
                     )
-                    circuit_ops.append({
-                        'gate': gate,
-                        'control': i,
-                        'target': target
-                    })
+                    circuit_ops.append(gate, target, control=i)
 
     # Circuit visualization with enhanced features
     if st.button("Visualize Circuit"):
@@ -92,6 +97,45 @@ def show_circuit_builder():
         st.subheader("Circuit Complexity Analysis")
         analyze_circuit_complexity(circuit_ops)
 
+    shots = st.select_slider("Number of Shots", SHOT_OPTIONS, value=1000)
+    noisy = st.checkbox("Simulate gate noise",
+                        help="Turn each gate's fidelity into random Pauli errors and spread the "
+                             "shots over many noisy trajectories of the circuit.")
+
+    # Noisy runs always draw the full shot count
+    tolerance = None
+    if not noisy and st.checkbox("Stop sampling once estimates are precise",
+                                 help="Treat the shot count as a budget and draw shots in batches until "
+                                      "every 95% confidence interval is narrower than the chosen width."):
+        tolerance = st.select_slider("Confidence Interval Width", TOLERANCE_OPTIONS, value=0.02)
+
+    marginal_qubits = st.multiselect(
+        "Marginal Distribution Qubits",
+        list(range(num_qubits)),
+        help="Also show the measurement distribution of just these qubits."
+    )
+
+    qc.precision = st.radio(
+        "Amplitude Precision", list(PRECISIONS), horizontal=True,
+        format_func=lambda precision: "Double" if precision == 'complex128' else "Single",
+        help="Single precision halves the memory per amplitude and speeds up large registers, "
+             "at about 7 significant digits.")
+
+    # Timing is switched per run; untimed runs skip the clock reads entirely
+    qc.timing = st.checkbox("Time each gate", value=True,
+                            help="Measure how long the engine spends executing every gate.")
+    heatmap_metric = 'fidelity'
+    if qc.timing:
+        heatmap_metric = st.radio("Heat Map", ['fidelity', 'time'], horizontal=True,
+                                  format_func=lambda metric: "Gate fidelity" if metric == 'fidelity'
+                                  else "Execution time")
+
+    # Building the full unitary takes a while at larger registers, so the check is opt-in
+    verify = st.checkbox("Check optimizations against the circuit's unitary",
+                         disabled=num_qubits > EQUIVALENCE_CHECK_MAX_QUBITS,
+                         help="Confirm the optimized circuit has the original's unitary, up to a "
+                              f"global phase. Available up to {EQUIVALENCE_CHECK_MAX_QUBITS} qubits.")
+
     # Run circuit simulation with advanced analysis
     if st.button("Run Circuit"):
         if not circuit_ops:
@@ -99,7 +143,10 @@ def show_circuit_builder():
             return
 
         with st.spinner("Running quantum circuit simulation..."):
-            result = qc.simulate_circuit(circuit_ops)
+            if noisy:
+                result = qc.simulate_noisy(circuit_ops, shots=shots)
+            else:
+                result = qc.simulate_circuit(circuit_ops, shots=shots, tolerance=tolerance)
 
             if result['success']:
                 st.success("Simulation completed successfully!")
@@ -107,33 +154,55 @@ def show_circuit_builder():
                 # Show performance visualization
                 if 'performance_data' in result:
                     st.subheader("Circuit Performance Analysis")
-                    heatmap = create_circuit_heatmap(circuit_ops, result['performance_data'])
+                    heatmap = create_circuit_heatmap(circuit_ops, result['performance_data'],
+                                                     metric=heatmap_metric)
                     st.plotly_chart(heatmap)
                     show_performance_metrics(result['performance_data'])
 
                 st.subheader("Simulation Results")
                 # Display state vector with enhanced visualization
-                st.write("Final State Vector:")
                 state_vector = result['state_vector']
-                # Create columns for better layout
-                cols = st.columns(2)
-                with cols[0]:
-                    st.write("State")
-                with cols[1]:
-                    st.write("Amplitude")
-                for i, amplitude in enumerate(state_vector):
+                if state_vector is not None:
+                    st.write("Final State Vector (largest amplitudes):")
+                    # Create columns for better layout
+                    cols = st.columns(2)
                     with cols[0]:
-                        st.write(f"|{format(i, f'0{num_qubits}b')}⟩")
+                        st.write("State")
                     with cols[1]:
-                        # Format complex numbers properly
-                        if isinstance(amplitude, complex):
-                            st.write(f"{amplitude.real:.3f}{amplitude.imag:+.3f}j")
-                        else:
-                            st.write(f"{amplitude:.3f}")
+                        st.write("Amplitude")
+                    for i in top_k_indices(np.abs(state_vector), MAX_STATE_ROWS):
+                        amplitude = state_vector[i]
+                        with cols[0]:
+                            st.write(f"|{format(int(i), f'0{num_qubits}b')}⟩")
+                        with cols[1]:
+                            # Format complex numbers properly
+                            if np.iscomplexobj(amplitude):
+                                st.write(f"{amplitude.real:.3f}{amplitude.imag:+.3f}j")
+                            else:
+                                st.write(f"{amplitude:.3f}")
+
+                if 'stabilizers' in result:
+                    st.write("Stabilizer Generators:")
+                    st.code("\n".join(result['stabilizers']))
+
+                if 'truncation_error' in result:
+                    st.write(f"MPS bond dimension: {result['bond_dimension']}, "
+                             f"truncation error: {result['truncation_error']:.2e}")
+
+                if 'passes' in result:
+                    st.write(f"Out-of-core passes over the state file: {result['passes']}")
 
                 # Display measurement results with improved formatting
                 st.write("\nMeasurement Results:")
                 measurements = result['measurements']
+                if 'trajectories' in result:
+                    st.info(f"Shots spread over {result['trajectories']} noisy trajectories; "
+                            "the counts include gate errors.")
+                if 'converged' in result:
+                    if result['converged']:
+                        st.info(f"All intervals narrower than {tolerance} after {result['shots']} shots.")
+                    else:
+                        st.warning(f"Shot budget spent before every interval was narrower than {tolerance}.")
 
                 # Create a table for measurements
                 cols = st.columns([2, 1, 1, 1])
@@ -142,24 +211,53 @@ def show_circuit_builder():
                 cols[2].write("Probability")
                 cols[3].write("Visualization")
 
-                for state, data in measurements.items():
+                for state, data in measurements.top_k(MAX_MEASUREMENT_ROWS):
                     cols = st.columns([2, 1, 1, 1])
                     cols[0].write(data['basis_state'])
-                    cols[1].write(f"{data['count']}/1000")
-                    cols[2].write(f"{data['probability']:.4f}")
+                    cols[1].write(f"{data['count']}/{result['shots']}")
+                    low, high = data['interval']
+                    cols[2].write(f"{data['probability']:.4f} ± {(high - low) / 2:.4f}")
                     cols[3].progress(data['probability'])
+                if len(measurements) > MAX_MEASUREMENT_ROWS:
+                    st.caption(f"{len(measurements) - MAX_MEASUREMENT_ROWS} less frequent outcomes not shown.")
+
+                # The measured register ends at the highest qubit a gate touches
+                measured_qubits = [qubit for qubit in marginal_qubits if qubit < measurements.num_qubits]
+                if len(measured_qubits) < len(marginal_qubits):
+                    st.warning("Qubits no gate acts on were not measured and are left out of "
+                               "the marginal distribution.")
+                if measured_qubits:
+                    show_marginal_distribution(measurements, measured_qubits)
 
                 # Add circuit optimization suggestions
-                show_optimization_suggestions(circuit_ops)
+                show_optimization_suggestions(qc, circuit_ops, verify)
             else:
                 st.error(f"Simulation failed: {result.get('error', 'Unknown error')}")
                 st.info("Try simplifying your circuit or checking the gate connections.")
 
+def show_marginal_distribution(measurements, qubits):
+    """Plot the measured distribution of a subset of qubits."""
+    marginal = measurements.marginal(qubits)
+    top = marginal.top_k(MAX_MEASUREMENT_ROWS)
+    labels = ", ".join(f"q{qubit}" for qubit in reversed(qubits))
+    fig = go.Figure(data=[go.Bar(
+        x=[state for state, _ in top],
+        y=[data['probability'] for _, data in top]
+    )])
+    fig.update_layout(
+        title=f"Marginal Distribution ({labels})",
+        xaxis_title="Outcome",
+        yaxis_title="Probability",
+        yaxis_range=[0, 1]
+    )
+    st.plotly_chart(fig)
+
 def analyze_circuit_complexity(circuit_ops):
     """Analyze and display circuit complexity metrics."""
     # Calculate basic metrics
-    n_gates = len(circuit_ops)
-    n_two_qubit_gates = sum(1 for op in circuit_ops if 'control' in op)
+    circuit = as_circuit(circuit_ops)
+    n_gates = len(circuit)
+    n_two_qubit_gates = int(np.count_nonzero(circuit.records['control'] >= 0))
 
     # Display metrics
     col1, col2, col3 = st.columns(3)
@@ -174,20 +272,36 @@ def analyze_circuit_complexity(circuit_ops):
     if n_gates > 10:
         st.warning("Circuit complexity is high. Consider optimization.")
 
-def show_optimization_suggestions(circuit_ops):
+def show_optimization_suggestions(qc, circuit_ops, verify=False):
     """Display suggestions for circuit optimization."""
     st.subheader("Optimization Suggestions")
 
-    # Check for common patterns that could be optimized
-    consecutive_same_gates = False
-    for i in range(len(circuit_ops)-1):
-        if (circuit_ops[i].get('gate') == circuit_ops[i+1].get('gate') and 
-            circuit_ops[i].get('target') == circuit_ops[i+1].get('target')):
-            consecutive_same_gates = True
-            break
-
-    if consecutive_same_gates:
-        st.info("Found consecutive identical gates. These might cancel out.")
+    # Run the same compile pass the simulator uses and report what it removed;
+    # on request, also check the result against the original unitary
+    _, report = optimize_circuit(circuit_ops)
+    if verify and report['removed']:
+        check = qc.check_optimization(circuit_ops)
+        if check['success']:
+            report = check['report']
+        else:
+            st.warning(check['error'])
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Gates After Optimization", report['optimized_gates'],
+                  delta=-report['removed'], delta_color="inverse")
+    with col2:
+        st.metric("Cancelled Gates", report['cancelled'])
+    with col3:
+        st.metric("Fused Gates", report['fused'])
+
+    if report['cancelled']:
+        st.info(f"{report['cancelled']} gates cancel out in pairs and can be removed.")
+    if report['fused']:
+        st.info(f"{report['fused']} single-qubit gates can be merged into their neighbours.")
+    if report.get('equivalent') is False:
+        st.error("The optimized circuit does not match the original one.")
+    elif report.get('equivalent') and report['removed']:
+        st.caption("Checked: the optimized circuit has the original's unitary, up to a global phase.")
 
     # Additional optimization tips
     st.markdown("""
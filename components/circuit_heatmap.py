@@ -1,53 +1,61 @@
 import streamlit as st
 import plotly.graph_objects as go
 import numpy as np
+from quantum_utils import as_circuit, OPCODE_GATES
 
-def create_circuit_heatmap(circuit_ops, performance_data):
+def create_circuit_heatmap(circuit_ops, performance_data, metric='fidelity'):
     """
     Create a heat map visualization of quantum circuit performance.
     
     Args:
-        circuit_ops: List of circuit operations
+        circuit_ops: Circuit or list of circuit operations
         performance_data: Dictionary containing performance metrics
+        metric: 'fidelity', or 'time' to show measured execution time per gate
     """
     # Extract gate types and qubit indices
-    n_qubits = max([op.get('target', 0) for op in circuit_ops]) + 1
-    n_steps = len(circuit_ops)
+    circuit = as_circuit(circuit_ops)
+    records = circuit.records
+    n_qubits = circuit.num_qubits
+    n_steps = len(circuit)
+    steps = np.arange(n_steps)
     
     # Initialize performance matrix
     perf_matrix = np.zeros((n_qubits, n_steps))
-    gate_labels = []
+    gate_labels = [OPCODE_GATES[opcode] for opcode in records['opcode'].tolist()]
     
     # Populate performance matrix
-    for i, op in enumerate(circuit_ops):
-        gate = op['gate']
-        target = op.get('target', 0)
-        control = op.get('control', None)
-        
-        # Set performance value based on gate type
-        perf_value = performance_data.get(f"step_{i}", {}).get('fidelity', 0.5)
-        perf_matrix[target, i] = perf_value
-        
-        # For two-qubit gates, also mark the control qubit
-        if control is not None:
-            perf_matrix[control, i] = perf_value
-        
-        gate_labels.append(gate)
+    if metric == 'time':
+        # Measured nanoseconds per step, shown in microseconds
+        trace = performance_data.get('trace') or {}
+        step_ns = trace.get('step_ns')
+        perf_values = np.zeros(n_steps) if step_ns is None else np.asarray(step_ns[:n_steps]) / 1e3
+        colorscale, zmax, label = 'Reds', max(perf_values.max(initial=0), 1e-3), "Time (µs)"
+        title = "Circuit Execution Time Heat Map"
+    else:
+        perf_values = np.array([performance_data.get(f"step_{i}", {}).get('fidelity', 0.5)
+                                for i in range(n_steps)])
+        colorscale, zmax, label = 'RdYlBu', 1, "Fidelity"
+        title = "Circuit Performance Heat Map"
+    perf_matrix[records['target'], steps] = perf_values
+    
+    # For two-qubit gates, also mark the control qubit
+    has_control = records['control'] >= 0
+    perf_matrix[records['control'][has_control], steps[has_control]] = perf_values[has_control]
     
     # Create heat map
     fig = go.Figure(data=go.Heatmap(
         z=perf_matrix,
         x=[f"Step {i+1}\n{gate}" for i, gate in enumerate(gate_labels)],
         y=[f"Qubit {i}" for i in range(n_qubits)],
-        colorscale='RdYlBu',
+        colorscale=colorscale,
         zmin=0,
-        zmax=1,
-        text=[[f"Fidelity: {perf_matrix[i,j]:.3f}" for j in range(n_steps)] for i in range(n_qubits)],
+        zmax=zmax,
+        text=[[f"{label}: {perf_matrix[i,j]:.3f}" for j in range(n_steps)] for i in range(n_qubits)],
         hoverongaps=False
     ))
     
     fig.update_layout(
-        title="Circuit Performance Heat Map",
+        title=title,
         xaxis_title="Circuit Steps",
         yaxis_title="Qubits",
         width=800,
@@ -60,19 +68,83 @@ def show_performance_metrics(performance_data):
     """Display additional performance metrics."""
     st.subheader("Performance Metrics")
     
-    if performance_data:
+    # Per-gate entries are keyed step_<i>; other keys hold run-level reports
+    steps = [data for key, data in performance_data.items() if key.startswith("step_")]
+    trace = performance_data.get('trace')
+    if steps:
         metrics = st.columns(3)
         
         with metrics[0]:
             avg_fidelity = np.mean([step.get('fidelity', 0) 
-                                  for step in performance_data.values()])
+                                  for step in steps])
             st.metric("Average Fidelity", f"{avg_fidelity:.3f}")
         
         with metrics[1]:
-            total_time = sum(step.get('time', 0) 
-                           for step in performance_data.values())
-            st.metric("Total Execution Time", f"{total_time:.2f} ms")
+            if trace is None:
+                st.metric("Total Execution Time", "not timed")
+            else:
+                gate_ns = 0 if trace.get('step_ns') is None else float(np.sum(trace['step_ns']))
+                total_time = (gate_ns + trace.get('finish_ns', 0)) / 1e6
+                st.metric("Total Execution Time", f"{total_time:.3f} ms")
         
         with metrics[2]:
-            n_gates = len(performance_data)
+            n_gates = len(steps)
             st.metric("Total Gates", n_gates)
+
+    if trace is not None:
+        show_time_breakdown(steps, trace)
+
+    noise = performance_data.get('noise')
+    if noise:
+        st.caption(f"{noise['trajectories']} noisy trajectories in {noise['batches']} batches "
+                   f"on {noise['workers']} process(es), {noise['time_ms']:,.1f} ms.")
+
+    plan = performance_data.get('plan')
+    if plan:
+        show_engine_plan(plan)
+
+def show_time_breakdown(steps, trace):
+    """Show where measured simulation time went: gate kinds and the final readout."""
+    if trace.get('step_ns') is None:
+        st.caption(f"The {trace['engine']} engine runs the whole circuit in one call; "
+                   f"it took {trace.get('finish_ns', 0) / 1e6:.3f} ms.")
+        return
+    by_gate = {}
+    for step, elapsed in zip(steps, trace['step_ns'].tolist()):
+        by_gate[step['gate']] = by_gate.get(step['gate'], 0) + elapsed
+    parts = [f"{gate} {elapsed / 1e3:,.1f} µs"
+             for gate, elapsed in sorted(by_gate.items(), key=lambda item: -item[1])]
+    if trace.get('finish_ns'):
+        parts.append(f"readout {trace['finish_ns'] / 1e3:,.1f} µs")
+    if trace.get('resumed'):
+        parts.append(f"{trace['resumed']} operations resumed from cache")
+    st.caption("Time by gate: " + ", ".join(parts))
+
+def show_engine_plan(plan):
+    """Show which engine simulated the circuit and what the planner expected."""
+    estimate = plan['estimate']
+    summary = f"Simulated with the **{plan['engine']}** engine"
+    if estimate and 'reason' not in estimate:
+        summary += (f" (estimated {estimate['time']:.2f} ms, "
+                    f"{estimate['bytes'] / 1024:.0f} KiB")
+        if estimate.get('disk_bytes'):
+            summary += f" in memory plus a {estimate['disk_bytes'] / 2 ** 20:,.0f} MiB state file"
+        summary += ")"
+    admission = plan.get('admission')
+    if admission and admission['queued_ms'] >= 1:
+        summary += f", after waiting {admission['queued_ms'] / 1000:.1f} s for memory"
+    st.markdown(summary)
+    if plan.get('downgraded_from'):
+        st.info(f"The {plan['downgraded_from']} engine would exceed the memory budget, "
+                f"so the {plan['engine']} engine ran instead.")
+
+    with st.expander("Engine Cost Estimates"):
+        for name, candidate in plan['candidates'].items():
+            if 'reason' in candidate:
+                st.write(f"{name}: not suitable, {candidate['reason']}")
+            else:
+                approximate = " (truncated, approximate)" if candidate.get('approximate') else ""
+                disk = (f" + {candidate['disk_bytes'] / 2 ** 20:,.0f} MiB on disk"
+                        if candidate.get('disk_bytes') else "")
+                st.write(f"{name}: {candidate['time']:.2f} ms, "
+                         f"{candidate['bytes'] / 1024:.0f} KiB{disk}{approximate}")
@@ -1,8 +1,11 @@
 import streamlit as st
 import numpy as np
-from quantum_utils import QuantumComputer
+from quantum_utils import QuantumComputer, Circuit, top_k_probabilities, statevector_columns
 import plotly.graph_objects as go
 
+# Most likely outcomes listed or charted per result, independent of register size
+MAX_LISTED_OUTCOMES = 16
+
 def show_algorithms():
     st.title("Quantum Algorithm Demonstrations")
 
@@ -65,23 +68,22 @@ def show_deutsch_algorithm():
     )
 
     if st.button("Run Deutsch's Algorithm"):
-        qc = QuantumComputer()
+        qc = QuantumComputer(engine='auto', session=st.session_state.get('simulation_session'))
         # Create circuit based on selected function
-        circuit_ops = [
-            {'gate': 'X', 'target': 1},  # Prepare second qubit in |1⟩
-            {'gate': 'H', 'target': 0},  # Hadamard on first qubit
-            {'gate': 'H', 'target': 1},  # Hadamard on second qubit
-        ]
+        circuit_ops = Circuit()
+        circuit_ops.append('X', 1)  # Prepare second qubit in |1⟩
+        circuit_ops.append('H', 0)  # Hadamard on first qubit
+        circuit_ops.append('H', 1)  # Hadamard on second qubit
 
         # Add oracle based on selection
         if function_type == "Constant (1)":
-            circuit_ops.append({'gate': 'X', 'target': 1})
+            circuit_ops.append('X', 1)
         elif function_type == "Balanced (NOT)":
-            circuit_ops.append({'gate': 'CNOT', 'control': 0, 'target': 1})
+            circuit_ops.append('CNOT', 1, control=0)
         elif function_type == "Balanced (Identity)":
-            circuit_ops.append({'gate': 'CZ', 'control': 0, 'target': 1})
+            circuit_ops.append('CZ', 1, control=0)
 
-        circuit_ops.append({'gate': 'H', 'target': 0})  # Final Hadamard
+        circuit_ops.append('H', 0)  # Final Hadamard
 
         result = qc.simulate_circuit(circuit_ops)
 
@@ -89,7 +91,8 @@ def show_deutsch_algorithm():
             st.success("Algorithm executed successfully!")
             st.write("Result:", "Function is " +
                     ("constant" if function_type.startswith("Constant") else "balanced"))
-            st.write("State Vector:", result['state_vector'])
+            st.write("State Vector:")
+            st.dataframe(statevector_columns(result['state_vector']))
         else:
             st.error(f"Simulation failed: {result.get('error', 'Unknown error')}")
 
@@ -126,7 +129,7 @@ def show_grover_search():
 
     # Interactive demonstration
     st.subheader("Interactive Demo")
-    n_qubits = st.slider("Number of Qubits", 2, 3, 2)
+    n_qubits = st.slider("Number of Qubits", 2, 6, 2)
     target_state = st.selectbox(
         "Target State",
         [format(i, f'0{n_qubits}b') for i in range(2**n_qubits)]
@@ -139,9 +142,11 @@ def show_grover_search():
 
     if st.button("Run Grover's Search"):
         try:
-            qc = QuantumComputer()
+            qc = QuantumComputer(engine='auto', session=st.session_state.get('simulation_session'))
             # Initialize superposition
-            circuit_ops = [{'gate': 'H', 'target': i} for i in range(n_qubits)]
+            circuit_ops = Circuit()
+            for i in range(n_qubits):
+                circuit_ops.append('H', i)
 
             # Apply oracle and diffusion for the specified number of iterations
             for _ in range(iterations):
@@ -149,38 +154,40 @@ def show_grover_search():
                 target_int = int(target_state, 2)
                 for i in range(n_qubits):
                     if not (target_int & (1 << i)):
-                        circuit_ops.append({'gate': 'X', 'target': i})
+                        circuit_ops.append('X', i)
 
                 # Multi-controlled Z
                 for i in range(n_qubits-1):
-                    circuit_ops.append({'gate': 'CZ', 'control': i, 'target': n_qubits-1})
+                    circuit_ops.append('CZ', n_qubits-1, control=i)
 
                 # Undo X gates
                 for i in range(n_qubits):
                     if not (target_int & (1 << i)):
-                        circuit_ops.append({'gate': 'X', 'target': i})
+                        circuit_ops.append('X', i)
 
                 # Diffusion operator
                 for i in range(n_qubits):
-                    circuit_ops.append({'gate': 'H', 'target': i})
-                    circuit_ops.append({'gate': 'X', 'target': i})
+                    circuit_ops.append('H', i)
+                    circuit_ops.append('X', i)
 
                 for i in range(n_qubits-1):
-                    circuit_ops.append({'gate': 'CZ', 'control': i, 'target': n_qubits-1})
+                    circuit_ops.append('CZ', n_qubits-1, control=i)
 
                 for i in range(n_qubits):
-                    circuit_ops.append({'gate': 'X', 'target': i})
-                    circuit_ops.append({'gate': 'H', 'target': i})
+                    circuit_ops.append('X', i)
+                    circuit_ops.append('H', i)
 
-            result = qc.simulate_circuit(circuit_ops)
+            # The chart needs the exact distribution, so skip sampling
+            result = qc.simulate_circuit(circuit_ops, shots=None)
 
             if result['success']:
                 st.success("Algorithm executed successfully!")
 
-                # Display probabilities with a bar chart
+                # Display the most likely outcomes with a bar chart
                 st.subheader("Measurement Probabilities")
-                probabilities = {state: data['probability'] 
-                               for state, data in result['measurements'].items()}
+                indices, values = top_k_probabilities(result['probabilities'], MAX_LISTED_OUTCOMES)
+                probabilities = {format(int(i), f'0{n_qubits}b'): probability
+                               for i, probability in zip(indices, values)}
 
                 # Create bar chart using plotly
                 import plotly.graph_objects as go
@@ -204,7 +211,7 @@ def show_grover_search():
                 st.plotly_chart(fig)
 
                 # Display target state probability
-                target_prob = probabilities.get(target_state, 0)
+                target_prob = result['probabilities'][int(target_state, 2)]
                 st.info(f"Probability of measuring target state |{target_state}⟩: {target_prob:.4f}")
 
                 if target_prob < 0.5:
@@ -252,29 +259,32 @@ def show_quantum_fourier_transform():
     )
 
     if st.button("Run QFT"):
-        qc = QuantumComputer()
-        circuit_ops = []
+        qc = QuantumComputer(engine='auto', session=st.session_state.get('simulation_session'))
+        circuit_ops = Circuit()
 
         # Prepare input state
         input_int = int(input_state, 2)
         for i in range(n_qubits):
             if input_int & (1 << i):
-                circuit_ops.append({'gate': 'X', 'target': i})
+                circuit_ops.append('X', i)
 
         # Apply QFT
         for i in range(n_qubits):
-            circuit_ops.append({'gate': 'H', 'target': i})
+            circuit_ops.append('H', i)
             for j in range(i+1, n_qubits):
-                circuit_ops.append({'gate': 'CZ', 'control': j, 'target': i})
+                circuit_ops.append('CZ', i, control=j)
 
-        result = qc.simulate_circuit(circuit_ops)
+        result = qc.simulate_circuit(circuit_ops, shots=None)
 
         if result['success']:
             st.success("QFT completed successfully!")
-            st.write("Final State Vector:", result['state_vector'])
-            st.write("\nMeasurement Results:")
-            for state, data in result['measurements'].items():
-                st.write(f"State |{state}⟩: {data['probability']:.4f}")
+            if result['state_vector'] is not None:
+                st.write("Final State Vector:")
+                st.dataframe(statevector_columns(result['state_vector']))
+            st.write("\nMeasurement Probabilities:")
+            for i, probability in zip(*top_k_probabilities(result['probabilities'], MAX_LISTED_OUTCOMES)):
+                if probability > 0:
+                    st.write(f"State |{format(int(i), f'0{n_qubits}b')}⟩: {probability:.4f}")
         else:
             st.error(f"Simulation failed: {result.get('error', 'Unknown error')}")
 
@@ -309,7 +319,7 @@ def show_traveling_salesman():
     """)
 
     # Interactive demo setup
-    n_cities = st.slider("Number of Cities", 2, 4, 3)
+    n_cities = st.slider("Number of Cities", 2, 8, 3)
 
     # Generate random city coordinates for visualization
     np.random.seed(42)  # For reproducibility
@@ -349,26 +359,55 @@ def show_traveling_salesman():
                     distances[i,j] = np.sqrt(np.sum((city_coords[i] - city_coords[j])**2))
 
             # Create QAOA circuit
-            qc = QuantumComputer()
+            qc = QuantumComputer(engine='auto', session=st.session_state.get('simulation_session'))
             n_qubits = n_cities * 2  # Encoding cities requires more qubits
 
             # Initialize superposition
-            circuit_ops = [{'gate': 'H', 'target': i} for i in range(n_qubits)]
+            circuit_ops = Circuit()
+            for i in range(n_qubits):
+                circuit_ops.append('H', i)
 
             # Add QAOA specific operations (simplified version)
             for i in range(n_qubits-1):
-                circuit_ops.append({'gate': 'CZ', 'control': i, 'target': i+1})
+                circuit_ops.append('CZ', i+1, control=i)
 
-            result = qc.simulate_circuit(circuit_ops)
+            # The expectation values below need the statevector; planning for it
+            # here lets them reuse this cached run
+            result = qc.simulate_circuit(circuit_ops, shots=None, require_statevector=True)
 
             if result['success']:
                 st.success("QAOA optimization completed!")
 
                 # Display results
                 st.subheader("Possible Routes and Probabilities")
-                for state, data in result['measurements'].items():
-                    if data['probability'] > 0.01:  # Only show significant probabilities
-                        st.write(f"Route: {state}, Probability: {data['probability']:.4f}")
+                for i, probability in zip(*top_k_probabilities(result['probabilities'], MAX_LISTED_OUTCOMES)):
+                    if probability > 0.01:  # Only show significant probabilities
+                        st.write(f"Route: {format(int(i), f'0{n_qubits}b')}, Probability: {probability:.4f}")
+
+                # Cost Hamiltonian: distance-weighted ZZ couplings between the cities' first
+                # qubits; mixer Hamiltonian: X on every qubit
+                cost_terms = {}
+                for i in range(n_cities):
+                    for j in range(i + 1, n_cities):
+                        label = ['I'] * n_qubits
+                        label[n_qubits - 1 - 2 * i] = label[n_qubits - 1 - 2 * j] = 'Z'
+                        cost_terms[''.join(label)] = distances[i, j]
+                mixer_terms = {}
+                for k in range(n_qubits):
+                    label = ['I'] * n_qubits
+                    label[n_qubits - 1 - k] = 'X'
+                    mixer_terms[''.join(label)] = 1.0
+
+                energy = qc.expectation(circuit_ops, {**cost_terms, **mixer_terms})
+                if energy['success']:
+                    st.subheader("Hamiltonian Expectation Values")
+                    cols = st.columns(3)
+                    cols[0].metric("Cost ⟨H_C⟩", f"{sum(c * energy['terms'][l] for l, c in cost_terms.items()):.4f}")
+                    cols[1].metric("Mixer ⟨H_M⟩", f"{sum(energy['terms'][l] for l in mixer_terms):.4f}")
+                    cols[2].metric("Measurement Bases", len(energy['groups']),
+                                   help=f"{len(energy['terms'])} Pauli terms share these basis rotations.")
+                else:
+                    st.error(energy['error'])
             else:
                 st.error(f"Optimization failed: {result.get('error', 'Unknown error')}")
         except Exception as e:
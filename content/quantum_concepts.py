@@ -6,11 +6,52 @@ from io import BytesIO
 import base64
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
+from quantum_utils import QuantumComputer, circuits_equivalent
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Gates whose matrices the gates page computes, as circuits on qubits 0 and 1
+GATE_MATRIX_CIRCUITS = {
+    'Hadamard (H)': [{'gate': 'H', 'target': 0}],
+    'Pauli-X': [{'gate': 'X', 'target': 0}],
+    'Pauli-Y': [{'gate': 'Y', 'target': 0}],
+    'Pauli-Z': [{'gate': 'Z', 'target': 0}],
+    'CNOT (control q0, target q1)': [{'gate': 'CNOT', 'target': 1, 'control': 0}],
+    'CZ (q0, q1)': [{'gate': 'CZ', 'target': 1, 'control': 0}],
+    'H ⊗ H': [{'gate': 'H', 'target': 0}, {'gate': 'H', 'target': 1}],
+}
+
+# Small circuits the circuits page compares through their unitaries
+EQUIVALENCE_CIRCUITS = {
+    'X': [{'gate': 'X', 'target': 0}],
+    'H·Z·H': [{'gate': 'H', 'target': 0}, {'gate': 'Z', 'target': 0}, {'gate': 'H', 'target': 0}],
+    'Y': [{'gate': 'Y', 'target': 0}],
+    'X then Z': [{'gate': 'X', 'target': 0}, {'gate': 'Z', 'target': 0}],
+    'CNOT (control q0, target q1)': [{'gate': 'CNOT', 'target': 1, 'control': 0}],
+    'H·CZ·H on q1': [{'gate': 'H', 'target': 1}, {'gate': 'CZ', 'target': 1, 'control': 0},
+                     {'gate': 'H', 'target': 1}],
+    'CNOT (control q1, target q0)': [{'gate': 'CNOT', 'target': 0, 'control': 1}],
+    'Bell preparation': [{'gate': 'H', 'target': 0}, {'gate': 'CNOT', 'target': 1, 'control': 0}],
+}
+
+def format_matrix_entry(value):
+    """Short text for a complex matrix entry, such as 1, -i, 0.707 or 0.5+0.5i."""
+    # Adding 0.0 turns a rounded -0.0 into 0
+    real, imag = round(value.real, 3) + 0.0, round(value.imag, 3) + 0.0
+    if imag == 0:
+        return f"{real:g}"
+    imaginary = {1: 'i', -1: '-i'}.get(imag, f"{imag:g}i")
+    if real == 0:
+        return imaginary
+    return f"{real:g}{'+' if imag > 0 else ''}{imaginary}"
+
+def matrix_latex(matrix):
+    """LaTeX bmatrix of a small complex matrix."""
+    rows = (" & ".join(format_matrix_entry(value) for value in row) for row in matrix)
+    return r"\begin{bmatrix} " + r" \\ ".join(rows) + r" \end{bmatrix}"
+
 def show_tooltip(term, explanation):
     """Display a tooltip using Streamlit's help parameter"""
     try:
@@ -817,9 +858,9 @@ def show_gate_content():
         st.header("Quantum Gates: Manipulating Quantum States")
 
         # Introduction section
-        st.write("In quantum computing, ", end='')
+        st.write("In quantum computing, ")
         show_tooltip("quantum gates", "Fundamental operations that manipulate quantum states, similar to classical logic gates but preserving quantum properties")
-        st.write(" are the building blocks of quantum circuits. They perform ", end='')
+        st.write(" are the building blocks of quantum circuits. They perform ")
         show_tooltip("unitary operations", "Mathematical operations that preserve thenorm of quantum states and ensure reversibility")
         st.write(" on qubits, enabling powerful quantum computations.")
 
@@ -911,6 +952,8 @@ def show_gate_content():
                 - Custom controlled operations
                 """)
 
+        show_gate_matrices()
+
         # Practical Applications section
         st.markdown("### 🔬 Practical Applications")
         app_col1, app_col2 = st.columns(2)
@@ -1001,6 +1044,58 @@ def show_gate_content():
 
 
 
+def show_gate_matrices():
+    try:
+        st.markdown("### 🧮 Gate Matrices")
+        st.markdown("""
+        These matrices are computed by the simulator, which sends every basis state through the
+        gate at once. Rows and columns follow the basis |q1 q0⟩, so qubit 0 is the rightmost bit;
+        textbooks often list CNOT with the control as the leftmost bit instead.
+        """)
+        choice = st.selectbox("Gate", list(GATE_MATRIX_CIRCUITS), key="gate_matrix_choice")
+        qc = QuantumComputer(session=st.session_state.get('simulation_session'))
+        result = qc.unitary(GATE_MATRIX_CIRCUITS[choice])
+        if result['success']:
+            st.latex(matrix_latex(result['unitary']))
+        else:
+            st.error(result['error'])
+    except Exception as e:
+        logger.error(f"Error in show_gate_matrices: {str(e)}")
+        st.error("An error occurred while computing gate matrices. Please refresh the page.")
+
+
+def show_circuit_equivalence():
+    try:
+        st.markdown("### ⚖️ Circuit Equivalence")
+        st.markdown("""
+        Two circuits are equivalent when they have the same unitary matrix, up to a global phase
+        that no measurement can detect. Pick two circuits to compare their matrices.
+        """)
+        col1, col2 = st.columns(2)
+        names = list(EQUIVALENCE_CIRCUITS)
+        first = col1.selectbox("First circuit", names, index=0, key="equivalence_first")
+        second = col2.selectbox("Second circuit", names, index=1, key="equivalence_second")
+
+        # Both matrices act on the larger of the two registers
+        num_qubits = max(max(op.get('control') or 0, op['target'])
+                         for op in EQUIVALENCE_CIRCUITS[first] + EQUIVALENCE_CIRCUITS[second]) + 1
+        qc = QuantumComputer(session=st.session_state.get('simulation_session'))
+        for column, name in ((col1, first), (col2, second)):
+            result = qc.unitary(EQUIVALENCE_CIRCUITS[name], num_qubits=num_qubits)
+            if result['success']:
+                column.latex(matrix_latex(result['unitary']))
+            else:
+                column.error(result['error'])
+
+        if circuits_equivalent(EQUIVALENCE_CIRCUITS[first], EQUIVALENCE_CIRCUITS[second], num_qubits):
+            st.success("These circuits are equivalent up to a global phase.")
+        else:
+            st.info("These circuits implement different operations.")
+    except Exception as e:
+        logger.error(f"Error in show_circuit_equivalence: {str(e)}")
+        st.error("An error occurred while comparing circuits. Please refresh the page.")
+
+
 def show_circuit_content():
     logger.info("Displaying quantum circuit content")
     try:
@@ -1219,6 +1314,7 @@ def show_circuit_content():
         </div>
         """, unsafe_allow_html=True)
 
+        show_circuit_equivalence()
         show_circuits_advanced_content()
         if st.button("Mark as Complete"):
             mark_complete('concepts', 'Quantum Circuits')
@@ -1,6 +1,32 @@
 import streamlit as st
 import plotly.graph_objects as go
 import numpy as np
+from quantum_utils import (QuantumComputer, Circuit, NoiseModel, depolarizing_probability,
+                           top_k_probabilities)
+
+# Outcomes charted by the decoherence simulator, most likely first
+MAX_CHARTED_OUTCOMES = 16
+
+# Decoherence simulator sliders per platform as (min, max, default): coherence and
+# gate times in the platform's time unit, gate errors in percent
+DECOHERENCE_PRESETS = {
+    'superconducting': {
+        'unit': 'µs',
+        't1': (10.0, 500.0, 100.0),
+        't2': (10.0, 500.0, 80.0),
+        'gate_time': (0.01, 1.0, 0.05),
+        'error': (0.0, 5.0, 0.1),
+        'two_qubit_error': (0.0, 10.0, 1.0),
+    },
+    'ion': {
+        'unit': 'ms',
+        't1': (100.0, 10000.0, 5000.0),
+        't2': (10.0, 2000.0, 500.0),
+        'gate_time': (0.01, 1.0, 0.1),
+        'error': (0.0, 1.0, 0.01),
+        'two_qubit_error': (0.0, 5.0, 0.5),
+    },
+}
 
 def show_hardware():
     st.title("Quantum Computing Hardware")
@@ -262,6 +288,7 @@ def show_superconducting():
 
     # Add visualization of a superconducting qubit
     show_qubit_diagram("superconducting")
+    show_decoherence_simulator("superconducting")
 
 def show_trapped_ions():
     st.header("Trapped Ions")
@@ -287,6 +314,7 @@ def show_trapped_ions():
     """)
 
     show_qubit_diagram("ion")
+    show_decoherence_simulator("ion")
 
 def show_photonic():
     st.header("Photonic Quantum Computing")
@@ -343,5 +371,84 @@ def show_qubit_diagram(qubit_type):
     # Implementation diagrams could be added here using plotly
     st.info("Interactive 3D visualizations of qubit implementations coming soon!")
 
+def show_decoherence_simulator(platform):
+    """Simulate a GHZ state under the platform's coherence times and gate errors"""
+    preset = DECOHERENCE_PRESETS[platform]
+    unit = preset['unit']
+    st.subheader("Decoherence Simulator")
+    st.markdown("""
+    Prepare a GHZ state (a Hadamard followed by a chain of CNOTs), then let the register wait
+    while pairs of X gates run on qubit 0. Each gate depolarizes the qubits it acts on, and every
+    qubit relaxes (T1) and dephases (T2) for as long as each gate takes. The density matrix is
+    simulated exactly, so the figures below carry no sampling noise.
+    """)
+
+    col1, col2 = st.columns(2)
+    with col1:
+        num_qubits = st.slider("Qubits", 2, 8, 4, key=f"{platform}_noise_qubits")
+        idle_pairs = st.slider("Idle X-gate pairs", 0, 20, 5, key=f"{platform}_noise_idle")
+        t1 = st.slider(f"T1 ({unit})", *preset['t1'], key=f"{platform}_noise_t1")
+        t2 = st.slider(f"T2 ({unit})", *preset['t2'], key=f"{platform}_noise_t2")
+    with col2:
+        gate_time = st.slider(f"Gate time ({unit})", *preset['gate_time'], key=f"{platform}_noise_gate_time")
+        error = st.slider("Single-qubit gate error (%)", *preset['error'], key=f"{platform}_noise_error")
+        two_qubit_error = st.slider("Two-qubit gate error (%)", *preset['two_qubit_error'],
+                                    key=f"{platform}_noise_two_qubit_error")
+    if t2 > 2 * t1:
+        st.warning("T2 cannot exceed twice T1; simulating with T2 = 2·T1.")
+        t2 = 2 * t1
+
+    circuit = Circuit()
+    circuit.append('H', 0)
+    for qubit in range(1, num_qubits):
+        circuit.append('CNOT', qubit, control=qubit - 1)
+    for _ in range(idle_pairs):
+        circuit.append('X', 0)
+        circuit.append('X', 0)
+
+    # Gate errors are read as average infidelities
+    noise = NoiseModel.from_coherence_times(
+        t1, t2, gate_time,
+        depolarizing=depolarizing_probability(1 - error / 100, 1),
+        two_qubit_depolarizing=depolarizing_probability(1 - two_qubit_error / 100, 2))
+    qc = QuantumComputer(engine='numpy', session=st.session_state.get('simulation_session'))
+    result = qc.simulate_density(circuit, noise=noise, shots=None)
+    if not result['success']:
+        st.error(f"Simulation failed: {result.get('error', 'Unknown error')}")
+        return
+
+    duration = len(circuit) * gate_time
+    col1, col2, col3 = st.columns(3)
+    col1.metric("GHZ Fidelity", f"{result['fidelity']:.4f}")
+    col2.metric("Purity", f"{result['purity']:.4f}")
+    col3.metric("Circuit Duration", f"{duration:.2f} {unit}")
+
+    # Noisy outcome distribution against the ideal 50/50 split of |0...0> and |1...1>
+    indices, probabilities = top_k_probabilities(result['probabilities'], MAX_CHARTED_OUTCOMES)
+    labels = [format(int(i), f'0{num_qubits}b') for i in indices]
+    ideal = [0.5 if i in (0, (1 << num_qubits) - 1) else 0.0 for i in indices.tolist()]
+    fig = go.Figure(data=[
+        go.Bar(name='Ideal', x=labels, y=ideal),
+        go.Bar(name='With noise', x=labels, y=probabilities)
+    ])
+    fig.update_layout(title="Measurement Probabilities", xaxis_title="Outcome",
+                      yaxis_title="Probability", barmode='group')
+    st.plotly_chart(fig)
+
+    # Single-qubit decay curves, with the circuit's duration marked
+    times = np.linspace(0, 3 * max(t1, t2), 200)
+    fig = go.Figure(data=[
+        go.Scatter(x=times, y=np.exp(-times / t1), name='Excited population (T1)'),
+        go.Scatter(x=times, y=np.exp(-times / t2), name='Coherence (T2)')
+    ])
+    fig.add_vline(x=duration, line_dash='dash', annotation_text='circuit')
+    fig.update_layout(title="Single-Qubit Decoherence", xaxis_title=f"Time ({unit})",
+                      yaxis_title="Remaining fraction")
+    st.plotly_chart(fig)
+
+    density = result['performance_data']['density']
+    st.caption(f"{len(circuit)} gates on a {1 << num_qubits}×{1 << num_qubits} density matrix "
+               f"in {density['time_ms']:.1f} ms.")
+
 if __name__ == "__main__":
     show_hardware()
\ No newline at end of file
@@ -2,6 +2,7 @@ import streamlit as st
 from components import circuit_builder, state_visualizer, progress_tracker, auth
 from content import quantum_concepts, quantum_algorithms, quantum_hardware
 import quantum_utils
+import uuid
 
 def main():
     st.set_page_config(
@@ -13,6 +14,10 @@ def main():
     # Initialize authentication
     auth.init_auth()
 
+    # Identifies this browser session to the simulator's per-session memory budget
+    if 'simulation_session' not in st.session_state:
+        st.session_state['simulation_session'] = uuid.uuid4().hex
+
     # Initialize theme
     if 'theme' not in st.session_state:
         st.session_state['theme'] = 'light'
@@ -213,7 +218,10 @@ def show_home():
     st.markdown('<div class="card">', unsafe_allow_html=True)
     if st.button("Run Sample Quantum Circuit", key="quick_start"):
         result = quantum_utils.run_sample_circuit()
-        st.write("Sample circuit result:", result)
+        if result['success']:
+            st.write("Sample circuit result:", dict(result['measurements'].items()))
+        else:
+            st.error(result['error'])
     st.markdown('</div>', unsafe_allow_html=True)
 
 if __name__ == "__main__":
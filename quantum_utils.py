@@ -1,15 +1,2598 @@
 import numpy as np
+import scipy.linalg
 from qiskit import QuantumCircuit, transpile
-from qiskit_aer import AerSimulator, QasmSimulator
-from qiskit.quantum_info import Statevector
+from qiskit_aer import AerSimulator
 from qiskit.visualization import circuit_drawer
 from qiskit.exceptions import QiskitError
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from statistics import NormalDist
+import copy
+import functools
+import hashlib
+import heapq
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
 import time
 
-class QuantumComputer:
+# Number of measurement shots drawn from the final state
+DEFAULT_SHOTS = 1000
+
+# Largest number of shots a single simulation may request
+MAX_SHOTS = 10_000_000
+
+# Shots the MPS sampler draws per batch, bounding its bit-matrix memory
+SAMPLE_CHUNK_SHOTS = 1 << 16
+
+# Bytes the stabilizer sampler's per-batch matrices may take; its batch size
+# follows from the rank of the state
+STABILIZER_SAMPLE_BYTES = 16 * 1024 * 1024
+
+# Confidence level of the Wilson intervals reported with sampled probabilities
+CONFIDENCE_LEVEL = 0.95
+
+# Smallest batch drawn by adaptive sampling, and the size of its first batch
+ADAPTIVE_BATCH_SHOTS = 1000
+
+# Default memory budget of the process-wide simulation result cache
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+# Engines of each type kept warm in the process-wide backend pool
+DEFAULT_POOL_SIZE = 4
+
+# Default memory budget of a circuit builder session's prefix state cache
+DEFAULT_PREFIX_CACHE_BYTES = 16 * 1024 * 1024
+
+# Largest register the stabilizer and sparse engines expand into a dense statevector
+STATEVECTOR_EXPANSION_MAX_QUBITS = 12
+
+# Largest register for which exact mode (shots=None) returns a dense probability array
+EXACT_PROBABILITY_MAX_QUBITS = 24
+
+# Largest bond dimension kept by the MPS engine, and the relative size below
+# which its singular values are dropped
+MPS_MAX_BOND = 64
+MPS_CUTOFF = 1e-12
+
+# Simulation memory budgets: all runs in the process together, and a single session's runs
+DEFAULT_PROCESS_MEMORY_BYTES = 4 * 1024 * 1024 * 1024
+DEFAULT_SESSION_MEMORY_BYTES = 1024 * 1024 * 1024
+
+# Seconds a run may wait for memory held by other runs before it is turned away
+DEFAULT_ADMISSION_TIMEOUT = 30.0
+
+# Threads the dense kernels split each gate across, and the smallest register
+# (in amplitudes, as qubits) worth splitting; smaller gates run on the caller's thread
+DEFAULT_KERNEL_THREADS = os.cpu_count() or 1
+PARALLEL_MIN_QUBITS = 20
+
+# The memmap engine holds blocks of 2**MEMMAP_BLOCK_QUBITS amplitudes in RAM; one pass
+# over its file may also bring in the partner blocks of up to MEMMAP_MAX_HIGH_QUBITS
+# qubits above the block, so gates on them become operations between whole blocks
+MEMMAP_BLOCK_QUBITS = 22
+MEMMAP_MAX_HIGH_QUBITS = 2
+
+# Largest register the memmap engine accepts, and where its state files go
+# (None for the system temporary directory)
+MEMMAP_MAX_QUBITS = 34
+MEMMAP_DIRECTORY = None
+
+# Throughput the planner assumes for one read-and-write pass over a memmap file
+MEMMAP_BYTES_PER_MS = 150_000
+
+# Trajectories a noisy run averages over (fewer when it has fewer shots), and the
+# memory one batch of trajectory statevectors may take
+NOISY_TRAJECTORIES = 256
+TRAJECTORY_BATCH_BYTES = 64 * 1024 * 1024
+
+# Worker processes for noisy trajectory batches; smaller registers run in the calling
+# process, where starting workers would cost more than it saves
+DEFAULT_TRAJECTORY_PROCESSES = os.cpu_count() or 1
+TRAJECTORY_PARALLEL_MIN_QUBITS = 12
+
+# Largest register the density-matrix engine takes; its 4**n entries need
+# 256 MiB at 12 qubits in double precision
+DENSITY_MAX_QUBITS = 12
+
+# Largest register whose full unitary is built, as a (2**n, 2**n) matrix that takes
+# 256 MiB at 12 qubits in double precision; on request the circuit builder checks
+# optimizer output against the original circuit's unitary up to the smaller size
+UNITARY_MAX_QUBITS = 12
+EQUIVALENCE_CHECK_MAX_QUBITS = 10
+
+# The sparse engine switches to a dense array once this fraction of amplitudes is nonzero
+SPARSE_DENSE_FRACTION = 1 / 16
+
+# Largest register the sparse engine may densify, and its support limit beyond that
+SPARSE_MAX_DENSE_QUBITS = 24
+SPARSE_MAX_SUPPORT = 1 << 22
+
+# Amplitudes smaller than this are dropped from sparse states
+SPARSE_TOLERANCE = 1e-12
+
+# Peak bytes per output amplitude of a sparse branching gate: the concatenated
+# branches, np.unique's sorted copy and inverse, and the merged bincounts
+SPARSE_MERGE_BYTES = 128
+
+# Amplitude precisions selectable through QuantumComputer(precision=...); single
+# precision halves statevector memory and bandwidth at about 7 significant digits
+PRECISIONS = {'complex128': np.complex128, 'complex64': np.complex64}
+DEFAULT_PRECISION = 'complex128'
+
+# Precomputed 2x2 kernels for the built-in single-qubit gates
+GATE_MATRICES = {
+    'H': np.array([[1, 1], [1, -1]], dtype=complex) / np.sqrt(2),
+    'X': np.array([[0, 1], [1, 0]], dtype=complex),
+    'Y': np.array([[0, -1j], [1j, 0]], dtype=complex),
+    'Z': np.array([[1, 0], [0, -1]], dtype=complex),
+}
+
+# Rotations taking each Pauli's eigenbasis to the computational (Z) basis
+BASIS_ROTATIONS = {
+    'X': GATE_MATRICES['H'],
+    'Y': GATE_MATRICES['H'] @ np.diag([1, -1j]),
+}
+
+class KernelThreads:
+    """Thread pool that splits large statevector kernels into blocks.
+
+    A gate's reshaped view is cut into strided blocks along one of its free
+    axes and each block is updated on its own thread; NumPy releases the GIL
+    inside the element-wise loops, so the blocks run on separate cores. The
+    calling thread works on the first block itself.
+    """
+
+    def __init__(self, threads=DEFAULT_KERNEL_THREADS, min_qubits=PARALLEL_MIN_QUBITS):
+        self.threads = threads
+        self.min_qubits = min_qubits
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def configure(self, threads=None, min_qubits=None):
+        """Change the thread count or the size threshold for this process."""
+        with self._lock:
+            if threads is not None and threads != self.threads:
+                if threads < 1:
+                    raise ValueError("Kernel thread count must be at least 1.")
+                self.threads = threads
+                if self._executor is not None:
+                    # Gates already running keep the old workers until they finish
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+            if min_qubits is not None:
+                self.min_qubits = min_qubits
+
+    def run(self, kernel, view, axes, *args):
+        """Apply kernel(block, *args) in place over `view`, split along the longest of `axes`."""
+        threads = self.threads
+        if threads <= 1 or view.size < 1 << self.min_qubits:
+            kernel(view, *args)
+            return
+        axis = max(axes, key=lambda axis: view.shape[axis])
+        blocks = np.array_split(view, min(threads, view.shape[axis]), axis=axis)
+        # Submit under the lock so configure() cannot shut the executor down
+        # in between; blocks already submitted still run on its workers
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(1, self.threads - 1),
+                                                    thread_name_prefix='kernel')
+            futures = [self._executor.submit(kernel, block, *args) for block in blocks[1:]]
+        kernel(blocks[0], *args)
+        for future in futures:
+            future.result()
+
+# Shared by every dense kernel in the process
+KERNEL_THREADS = KernelThreads()
+
+def _single_qubit_block(view, coefficients):
+    amp0 = view[:, 0, :]
+    amp1 = view[:, 1, :]
+    (m00, m01), (m10, m11) = coefficients
+
+    if m01 == 0 and m10 == 0:
+        # Diagonal gates only rescale the two halves
+        if m00 != 1:
+            amp0 *= m00
+        if m11 != 1:
+            amp1 *= m11
+        return
+
+    # Update in place through two buffers; every fresh temporary of a large
+    # state costs page faults on top of the arithmetic
+    saved = amp0.copy()
+    if m00 != 0:
+        amp0 *= m00
+        if m01 != 0:
+            amp0 += np.multiply(amp1, m01)
+    else:
+        np.multiply(amp1, m01, out=amp0)
+    if m11 != 0:
+        amp1 *= m11
+        saved *= m10
+        amp1 += saved
+    else:
+        np.multiply(saved, m10, out=amp1)
+
+def apply_single_qubit_gate(state, matrix, target):
+    """Apply a 2x2 matrix in place to qubit `target` of a (batch, 2**n) state array."""
+    # Axis 1 of the view is the target qubit's bit (qubit 0 is the least significant bit)
+    view = state.reshape(-1, 2, 1 << target)
+    # Python scalars keep the arithmetic in the state's own precision
+    KERNEL_THREADS.run(_single_qubit_block, view, (0, 2), np.asarray(matrix).tolist())
+    return state
+
+def _controlled_block(view, gate, control_axis):
+    if gate == 'CZ':
+        view[:, 1, :, 1, :] *= -1
+        return
+
+    # CNOT: swap the target halves of the control=1 subspace
+    index = [slice(None)] * 5
+    index[control_axis] = 1
+    target_axis = 3 if control_axis == 1 else 1
+    index[target_axis] = 0
+    amp0 = view[tuple(index)]
+    index[target_axis] = 1
+    amp1 = view[tuple(index)]
+    swapped = amp0.copy()
+    amp0[...] = amp1
+    amp1[...] = swapped
+
+def apply_controlled_gate(state, gate, control, target):
+    """Apply CNOT or CZ in place to a (batch, 2**n) state array."""
+    high, low = max(control, target), min(control, target)
+    view = state.reshape(-1, 2, 1 << (high - low - 1), 2, 1 << low)
+    control_axis = 1 if control == high else 3
+    KERNEL_THREADS.run(_controlled_block, view, (0, 2, 4), gate, control_axis)
+    return state
+
+def apply_gate(state, gate, target, control=None, matrix=None):
+    """Apply one built-in gate (or a fused 'U' matrix) in place to a (batch, 2**n) state array."""
+    if gate == 'U':
+        return apply_single_qubit_gate(state, matrix, target)
+    if gate in GATE_MATRICES:
+        return apply_single_qubit_gate(state, GATE_MATRICES[gate], target)
+    if gate in ('CNOT', 'CZ'):
+        if control is not None:
+            apply_controlled_gate(state, gate, control, target)
+        return state
+    raise ValueError(f"Unsupported gate '{gate}'")
+
+class GateTrace:
+    """Execution times an engine records while simulating one circuit.
+
+    Engines append one perf_counter_ns duration per applied operation into a
+    preallocated array, so recording allocates nothing. Time spent in
+    finish() (readout, or the whole run for engines that execute lazily) is
+    kept separately.
+    """
+    def __init__(self, num_operations):
+        self.operation_ns = np.zeros(num_operations, dtype=np.int64)
+        self.count = 0
+        self.finish_ns = 0
+
+    def record(self, elapsed_ns):
+        self.operation_ns[self.count] = elapsed_ns
+        self.count += 1
+
+def timed_apply(apply):
+    """Time an engine's apply() into its attached GateTrace; untraced runs skip the clock."""
+    @functools.wraps(apply)
+    def wrapper(self, gate, target, control=None, matrix=None):
+        trace = self.trace
+        if trace is None:
+            return apply(self, gate, target, control, matrix)
+        start = time.perf_counter_ns()
+        apply(self, gate, target, control, matrix)
+        trace.record(time.perf_counter_ns() - start)
+    return wrapper
+
+def timed_finish(finish):
+    """Time an engine's finish() into its attached GateTrace."""
+    @functools.wraps(finish)
+    def wrapper(self):
+        trace = self.trace
+        if trace is None:
+            return finish(self)
+        start = time.perf_counter_ns()
+        state = finish(self)
+        trace.finish_ns = time.perf_counter_ns() - start
+        return state
+    return wrapper
+
+class Engine:
+    """Base of the simulation engines: start() a register, apply() gates, finish().
+
+    Engines are pooled and reused between runs, so finish() hands the final
+    state over and discard() drops an unfinished run; either way an idle
+    engine holds none of the attributes named in `run_attributes`.
+    """
+    name = None
+    supports_fusion = True
+    per_gate_timing = True
+    trace = None
+    # Attributes holding one run's state
+    run_attributes = ('state',)
+
     def __init__(self):
+        self._clear()
+
+    def _clear(self):
+        for attribute in self.run_attributes:
+            setattr(self, attribute, None)
+
+    def _hand_over(self, state):
+        self._clear()
+        return state
+
+    def discard(self):
+        """Drop an unfinished run."""
+        self._clear()
+
+class EngineState:
+    """Final state an engine hands over instead of a dense statevector.
+
+    Subclasses sample with sample_outcomes(shots, rng) and expand with
+    probabilities() and to_statevector().
+    """
+
+    def result_fields(self):
+        """Engine-specific entries added to the simulation result."""
+        return {}
+
+class AerEngine(Engine):
+    """Statevector simulation through Qiskit Aer."""
+    name = 'aer'
+    # Gates are only appended to a circuit until finish() runs it in one call,
+    # so only the whole run can be timed
+    per_gate_timing = False
+    run_attributes = ('circuit',)
+
+    def __init__(self):
+        super().__init__()
         self.simulator = AerSimulator(method='statevector')
-        self.qasm_sim = QasmSimulator()
+        self.dtype = np.complex128
+
+    def start(self, num_qubits, dtype=np.complex128):
+        self.circuit = QuantumCircuit(num_qubits)
+        self.dtype = dtype
+        self.simulator.set_options(precision='single' if dtype == np.complex64 else 'double')
+
+    def apply(self, gate, target, control=None, matrix=None):
+        if gate == 'U':
+            self.circuit.unitary(matrix, [target])
+        elif gate == 'H':
+            self.circuit.h(target)
+        elif gate == 'X':
+            self.circuit.x(target)
+        elif gate == 'Y':
+            self.circuit.y(target)
+        elif gate == 'Z':
+            self.circuit.z(target)
+        elif gate in ('CNOT', 'CZ'):
+            if control is None:
+                return
+            if gate == 'CNOT':
+                self.circuit.cx(control, target)
+            else:
+                self.circuit.cz(control, target)
+        else:
+            raise ValueError(f"Unsupported gate '{gate}'")
+
+    @timed_finish
+    def finish(self):
+        # Run the circuit once and keep the final statevector
+        self.circuit.save_statevector()
+        qc_transpiled = transpile(self.circuit, self.simulator)
+        result = self.simulator.run(qc_transpiled).result()
+        return self._hand_over(np.asarray(result.get_statevector(), dtype=self.dtype))
+
+class NumpyEngine(Engine):
+    """Pure-NumPy statevector simulation for the built-in gate set."""
+    name = 'numpy'
+
+    def start(self, num_qubits, initial_state=None, dtype=np.complex128):
+        if initial_state is not None:
+            self.state = np.array(initial_state, dtype=dtype).reshape(1, 1 << num_qubits)
+            return
+        self.state = np.zeros((1, 1 << num_qubits), dtype=dtype)
+        self.state[0, 0] = 1
+
+    @timed_apply
+    def apply(self, gate, target, control=None, matrix=None):
+        apply_gate(self.state, gate, target, control, matrix)
+
+    def snapshot(self):
+        """Return a copy of the current statevector."""
+        return self.state[0].copy()
+
+    @timed_finish
+    def finish(self):
+        return self._hand_over(self.state[0])
+
+def _pauli_product_phase(x1, z1, x2, z2):
+    """Exponent of i picked up when multiplying single-qubit Paulis (x1, z1)·(x2, z2)."""
+    x1, z1, x2, z2 = (a.astype(np.int8) for a in (x1, z1, x2, z2))
+    return np.where(
+        x1 & z1, z2 - x2,
+        np.where(x1, z2 * (2 * x2 - 1), np.where(z1, x2 * (1 - 2 * z2), 0))
+    )
+
+def count_bit_samples(sample, shots, num_qubits, rng, chunk=SAMPLE_CHUNK_SHOTS):
+    """Pack (shots, n) bit samples into uint64 words and count distinct outcomes.
+
+    `sample(shots, rng)` is called in chunks of `chunk` shots so the
+    unpacked bit matrix stays small.
+    """
+    words = (num_qubits + 63) // 64
+    packed = np.empty((shots, words), dtype=np.uint64)
+    for start in range(0, shots, chunk):
+        stop = min(start + chunk, shots)
+        bits = np.packbits(sample(stop - start, rng), axis=1, bitorder='little')
+        padded = np.zeros((stop - start, words * 8), dtype=np.uint8)
+        padded[:, :bits.shape[1]] = bits
+        packed[start:stop] = padded.view('<u8')
+
+    if words == 1:
+        return np.unique(packed[:, 0], return_counts=True)
+    return np.unique(packed, axis=0, return_counts=True)
+
+def stabilizer_shot_bytes(rank, num_qubits):
+    """Working bytes per shot of stabilizer sampling from a state of `rank`.
+
+    A batch holds uint8 and float32 coefficients (rank each), then a float32
+    product with its int32 parity and the uint8 bits (n each).
+    """
+    return 5 * rank + 9 * num_qubits
+
+class StabilizerTableau(EngineState):
+    """Stabilizer generators of an n-qubit Clifford state.
+
+    Each generator is stored as X and Z bit columns plus a sign bit, following
+    Aaronson and Gottesman. Gates cost O(n) and sampling costs O(n^3) once, so
+    registers with thousands of qubits stay cheap.
+    """
+
+    def __init__(self, num_qubits):
+        self.num_qubits = num_qubits
+        # Indexed [qubit, generator] so gate updates touch contiguous columns
+        self.x = np.zeros((num_qubits, num_qubits), dtype=np.uint8)
+        self.z = np.eye(num_qubits, dtype=np.uint8)
+        self.r = np.zeros(num_qubits, dtype=np.uint8)
+
+    @property
+    def nbytes(self):
+        return self.x.nbytes + self.z.nbytes + self.r.nbytes
+
+    def apply(self, gate, target, control=None):
+        """Conjugate every generator by a built-in Clifford gate."""
+        x, z = self.x, self.z
+        if gate == 'H':
+            self.r ^= x[target] & z[target]
+            x[target], z[target] = z[target].copy(), x[target].copy()
+        elif gate == 'X':
+            self.r ^= z[target]
+        elif gate == 'Y':
+            self.r ^= x[target] ^ z[target]
+        elif gate == 'Z':
+            self.r ^= x[target]
+        elif gate == 'CNOT':
+            if control is None:
+                return
+            self.r ^= x[control] & z[target] & (x[target] ^ z[control] ^ 1)
+            x[target] ^= x[control]
+            z[control] ^= z[target]
+        elif gate == 'CZ':
+            if control is None:
+                return
+            self.apply('H', target)
+            self.apply('CNOT', target, control)
+            self.apply('H', target)
+        else:
+            raise ValueError(f"Gate '{gate}' is not supported by the stabilizer engine")
+
+    def stabilizers(self):
+        """Return the generators as signed Pauli labels (qubit 0 is the rightmost letter)."""
+        letters = np.array(['I', 'X', 'Z', 'Y'])
+        labels = letters[self.x.T + 2 * self.z.T][:, ::-1]
+        return [('-' if sign else '+') + ''.join(row) for sign, row in zip(self.r, labels)]
+
+    def _canonical_form(self):
+        """Row-reduce the generators over GF(2).
+
+        Returns the independent X parts spanning the measurement support and
+        one basis state inside that support.
+        """
+        n = self.num_qubits
+        x, z, r = self.x.T.copy(), self.z.T.copy(), self.r.copy()
+
+        # Eliminate X parts; the first `rank` rows end up with independent X pivots
+        rank = 0
+        for qubit in range(n):
+            candidates = np.flatnonzero(x[rank:, qubit]) + rank
+            if candidates.size == 0:
+                continue
+            pivot = candidates[0]
+            if pivot != rank:
+                x[[rank, pivot]] = x[[pivot, rank]]
+                z[[rank, pivot]] = z[[pivot, rank]]
+                r[[rank, pivot]] = r[[pivot, rank]]
+            rows = np.flatnonzero(x[:, qubit])
+            rows = rows[rows != rank]
+            if rows.size:
+                phase = (2 * r[rows].astype(np.int64) + 2 * int(r[rank])
+                         + _pauli_product_phase(x[rank], z[rank], x[rows], z[rows]).sum(axis=1))
+                r[rows] = (phase % 4) // 2
+                x[rows] ^= x[rank]
+                z[rows] ^= z[rank]
+            rank += 1
+
+        # The remaining rows are Z-type parity checks: z · outcome = r (mod 2)
+        checks = np.concatenate([z[rank:], r[rank:, None]], axis=1)
+        pivots = []
+        row = 0
+        for qubit in range(n):
+            candidates = np.flatnonzero(checks[row:, qubit]) + row
+            if candidates.size == 0:
+                continue
+            checks[[row, candidates[0]]] = checks[[candidates[0], row]]
+            others = np.flatnonzero(checks[:, qubit])
+            others = others[others != row]
+            checks[others] ^= checks[row]
+            pivots.append(qubit)
+            row += 1
+            if row == len(checks):
+                break
+
+        # Free qubits are set to 0, so each pivot qubit equals its row's parity bit
+        outcome = np.zeros(n, dtype=np.uint8)
+        for i, qubit in enumerate(pivots):
+            outcome[qubit] = checks[i, -1]
+
+        return x[:rank], outcome
+
+    def sample(self, shots, rng):
+        """Sample full-register measurement outcomes as a (shots, n) bit array."""
+        support, outcome = self._canonical_form()
+        return self._sample_span(support.astype(np.float32), outcome, shots, rng)
+
+    def _sample_span(self, basis, outcome, shots, rng):
+        if len(basis) == 0:
+            return np.broadcast_to(outcome, (shots, self.num_qubits))
+
+        # Outcomes are uniform over outcome + span(support) (mod 2); float32 sums
+        # of at most n ones are exact
+        coefficients = rng.integers(0, 2, size=(shots, len(basis)), dtype=np.uint8)
+        parity = (coefficients.astype(np.float32) @ basis).astype(np.int32)
+        parity &= 1
+        bits = parity.astype(np.uint8)
+        bits ^= outcome
+        return bits
+
+    def sample_outcomes(self, shots, rng):
+        """Draw shots and return the distinct packed outcomes with their counts.
+
+        Registers of up to 64 qubits pack each outcome into one uint64 basis
+        index; wider registers use a row of little-endian uint64 words.
+        """
+        support, outcome = self._canonical_form()
+        chunk = max(1, STABILIZER_SAMPLE_BYTES // stabilizer_shot_bytes(len(support), self.num_qubits))
+        sample = functools.partial(self._sample_span, support.astype(np.float32), outcome)
+        return count_bit_samples(sample, shots, self.num_qubits, rng, chunk)
+
+    def probabilities(self):
+        """Exact outcome distribution, uniform over outcome + span(support)."""
+        support, outcome = self._canonical_form()
+        weights = 1 << np.arange(self.num_qubits, dtype=np.int64)
+        indices = np.array([int(outcome.astype(np.int64) @ weights)])
+        for row in support.astype(np.int64) @ weights:
+            indices = np.concatenate([indices, indices ^ row])
+
+        probabilities = np.zeros(1 << self.num_qubits)
+        probabilities[indices] = 1.0 / len(indices)
+        return probabilities
+
+    def result_fields(self):
+        return {'stabilizers': self.stabilizers()}
+
+    def to_statevector(self):
+        """Expand the stabilizer state into a dense vector (defined up to global phase)."""
+        n = self.num_qubits
+        _, outcome = self._canonical_form()
+        weights = 1 << np.arange(n, dtype=np.int64)
+        indices = np.arange(1 << n, dtype=np.int64)
+
+        # Project a basis state in the support onto the joint +1 eigenspace
+        state = np.zeros(1 << n, dtype=complex)
+        state[int(outcome @ weights)] = 1
+        for k in range(n):
+            x_mask = int(self.x[:, k].astype(np.int64) @ weights)
+            z_mask = int(self.z[:, k].astype(np.int64) @ weights)
+            phase = (-1) ** int(self.r[k]) * 1j ** int(np.bitwise_count(x_mask & z_mask))
+            signs = 1 - 2 * (np.bitwise_count(indices & z_mask) & 1).astype(np.int8)
+            image = np.empty_like(state)
+            image[indices ^ x_mask] = phase * signs * state
+            state = (state + image) / 2
+
+        return state / np.linalg.norm(state)
+
+class StabilizerEngine(Engine):
+    """Clifford tableau simulation for registers far beyond statevector reach."""
+    name = 'stabilizer'
+    # Fused 2x2 matrices are not Clifford-tracked, so only cancellation applies
+    supports_fusion = False
+    run_attributes = ('tableau',)
+
+    def start(self, num_qubits, dtype=np.complex128):
+        # The tableau holds no amplitudes; dense expansions are cast on readout
+        self.tableau = StabilizerTableau(num_qubits)
+
+    @timed_apply
+    def apply(self, gate, target, control=None, matrix=None):
+        self.tableau.apply(gate, target, control)
+
+    @timed_finish
+    def finish(self):
+        return self._hand_over(self.tableau)
+
+class SparseState(EngineState):
+    """Statevector holding only its nonzero amplitudes.
+
+    Basis indices and amplitudes live in parallel arrays, so permutation and
+    phase gates (X, Y, Z, CNOT, CZ) cost O(support) regardless of register
+    size. Branching gates such as H merge duplicate indices after each step.
+    """
+
+    def __init__(self, num_qubits, dtype=np.complex128):
+        if num_qubits > 62:
+            raise ValueError("The sparse engine supports at most 62 qubits.")
+        self.num_qubits = num_qubits
+        self.indices = np.zeros(1, dtype=np.int64)
+        self.amplitudes = np.ones(1, dtype=dtype)
+
+    @property
+    def support(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.amplitudes.nbytes
+
+    def apply(self, gate, target, control=None, matrix=None):
+        """Apply a gate to the nonzero amplitudes."""
+        mask = 1 << target
+        bits = (self.indices & mask) != 0
+
+        if gate == 'X':
+            self.indices ^= mask
+        elif gate == 'Z':
+            self.amplitudes[bits] *= -1
+        elif gate == 'Y':
+            self.amplitudes *= np.where(bits, -1j, 1j)
+            self.indices ^= mask
+        elif gate in ('CNOT', 'CZ'):
+            if control is None:
+                return
+            active = (self.indices & (1 << control)) != 0
+            if gate == 'CNOT':
+                self.indices[active] ^= mask
+            else:
+                self.amplitudes[active & bits] *= -1
+        elif gate in ('H', 'U'):
+            self._apply_matrix(GATE_MATRICES['H'] if gate == 'H' else matrix, mask, bits)
+        else:
+            raise ValueError(f"Unsupported gate '{gate}'")
+
+    def _apply_matrix(self, matrix, mask, bits):
+        # Column b of the matrix maps an amplitude with bit b onto both branches
+        column = bits.astype(np.int8)
+        low = self.indices & ~mask
+        branches = []
+        for row in (0, 1):
+            weights = matrix[row][column]
+            keep = weights != 0
+            branches.append((low[keep] | (mask * row), weights[keep] * self.amplitudes[keep]))
+
+        indices = np.concatenate([branch[0] for branch in branches])
+        amplitudes = np.concatenate([branch[1] for branch in branches])
+
+        # Merge amplitudes landing on the same basis state
+        unique, inverse = np.unique(indices, return_inverse=True)
+        merged = (np.bincount(inverse, weights=amplitudes.real, minlength=len(unique))
+                  + 1j * np.bincount(inverse, weights=amplitudes.imag, minlength=len(unique)))
+        keep = np.abs(merged) > SPARSE_TOLERANCE
+        self.indices = unique[keep]
+        self.amplitudes = merged[keep].astype(self.amplitudes.dtype, copy=False)
+
+    def to_statevector(self):
+        """Scatter the nonzero amplitudes into a dense vector."""
+        state = np.zeros(1 << self.num_qubits, dtype=self.amplitudes.dtype)
+        state[self.indices] = self.amplitudes
+        return normalize_statevector(state)
+
+    def sample_outcomes(self, shots, rng):
+        """Draw shots from the support and return the distinct indices with their counts."""
+        probabilities = np.abs(self.amplitudes) ** 2
+        probabilities /= probabilities.sum()
+        counts = rng.multinomial(shots, probabilities)
+        drawn = np.flatnonzero(counts)
+        return self.indices[drawn].astype(np.uint64), counts[drawn]
+
+    def probabilities(self):
+        """Exact outcome distribution as a dense array."""
+        weights = np.abs(self.amplitudes) ** 2
+        probabilities = np.zeros(1 << self.num_qubits)
+        probabilities[self.indices] = weights / weights.sum()
+        return probabilities
+
+    def result_fields(self):
+        return {'support': self.support}
+
+class SparseEngine(Engine):
+    """Sparse statevector simulation that switches to dense arrays as support grows."""
+    name = 'sparse'
+    run_attributes = ('sparse', 'dense')
+
+    def start(self, num_qubits, dtype=np.complex128):
+        self.sparse = SparseState(num_qubits, dtype)
+        self.dense = None
+
+    @timed_apply
+    def apply(self, gate, target, control=None, matrix=None):
+        if self.dense is not None:
+            apply_gate(self.dense, gate, target, control, matrix)
+            return
+
+        self.sparse.apply(gate, target, control, matrix)
+        num_qubits = self.sparse.num_qubits
+        if num_qubits <= SPARSE_MAX_DENSE_QUBITS:
+            if self.sparse.support > SPARSE_DENSE_FRACTION * (1 << num_qubits):
+                self.dense = self.sparse.to_statevector().reshape(1, -1)
+                self.sparse = None
+        elif self.sparse.support > SPARSE_MAX_SUPPORT:
+            raise ValueError(
+                f"Sparse state grew to {self.sparse.support} amplitudes; "
+                f"{num_qubits} qubits are too many to simulate densely.")
+
+    @timed_finish
+    def finish(self):
+        return self._hand_over(self.dense[0] if self.dense is not None else self.sparse)
+
+# Two-site gates on neighbouring MPS sites, indexed by 2 * left bit + right bit
+SWAP_MATRIX = np.eye(4, dtype=complex)[[0, 2, 1, 3]]
+MPS_TWO_SITE_GATES = {
+    # (gate, control is the left site)
+    ('CNOT', True): np.eye(4, dtype=complex)[[0, 1, 3, 2]],
+    ('CNOT', False): np.eye(4, dtype=complex)[[0, 3, 2, 1]],
+    ('CZ', True): np.diag([1, 1, 1, -1]).astype(complex),
+    ('CZ', False): np.diag([1, 1, 1, -1]).astype(complex),
+}
+
+def _thin_svd(matrix):
+    """Thin SVD, falling back to LAPACK's gesvd driver if gesdd fails to converge.
+
+    The divide-and-conquer driver occasionally gives up on matrices with
+    many tiny singular values, which deep MPS circuits produce; the slower
+    QR-iteration driver does not.
+    """
+    try:
+        return np.linalg.svd(matrix, full_matrices=False)
+    except np.linalg.LinAlgError:
+        return scipy.linalg.svd(matrix, full_matrices=False, lapack_driver='gesvd')
+
+class MPSState(EngineState):
+    """Matrix product state with a bounded bond dimension.
+
+    Site q holds qubit q as a (left, 2, right) tensor, so memory grows with
+    the entanglement across each cut rather than with 2**n. Two-qubit gates
+    act on neighbouring sites (distant pairs are brought together with
+    SWAPs) and are split again by SVD, keeping at most max_bond singular
+    values. The discarded weight accumulates in truncation_error, an upper
+    bound on the infidelity of the final state.
+    """
+
+    def __init__(self, num_qubits, max_bond=MPS_MAX_BOND, dtype=np.complex128):
+        self.num_qubits = num_qubits
+        self.max_bond = max_bond
+        self.dtype = dtype
+        self.tensors = [np.array([1, 0], dtype=dtype).reshape(1, 2, 1)
+                        for _ in range(num_qubits)]
+        # Sites left of the center are left-orthonormal, sites right of it right-orthonormal
+        self.center = 0
+        self.truncation_error = 0.0
+
+    @property
+    def bond_dimension(self):
+        return max(tensor.shape[2] for tensor in self.tensors)
+
+    @property
+    def nbytes(self):
+        return sum(tensor.nbytes for tensor in self.tensors)
+
+    def apply(self, gate, target, control=None, matrix=None):
+        """Apply a gate, truncating bonds that exceed max_bond."""
+        if gate in ('CNOT', 'CZ'):
+            if control is not None:
+                self._apply_controlled(gate, control, target)
+            return
+        matrix = matrix if gate == 'U' else GATE_MATRICES.get(gate)
+        if matrix is None:
+            raise ValueError(f"Unsupported gate '{gate}'")
+        # Unitaries on the physical index keep the canonical form intact
+        matrix = np.asarray(matrix, dtype=self.dtype)
+        self.tensors[target] = np.einsum('ab,lbr->lar', matrix, self.tensors[target])
+
+    def _apply_controlled(self, gate, control, target):
+        # Walk the control next to the target, apply the gate, then walk it back
+        step = 1 if control < target else -1
+        position = control
+        while abs(target - position) > 1:
+            self._apply_two_site(min(position, position + step), SWAP_MATRIX)
+            position += step
+        self._apply_two_site(min(position, target), MPS_TWO_SITE_GATES[(gate, position < target)])
+        while position != control:
+            position -= step
+            self._apply_two_site(min(position, position + step), SWAP_MATRIX)
+
+    def _apply_two_site(self, site, matrix):
+        """Apply a 4x4 gate to sites (site, site + 1) and split them by truncated SVD."""
+        self._move_center(site)
+        left, right = self.tensors[site], self.tensors[site + 1]
+        left_bond, right_bond = left.shape[0], right.shape[2]
+        theta = np.einsum('lar,rbs->labs', left, right).reshape(left_bond, 4, right_bond)
+        theta = np.einsum('xy,lys->lxs', matrix.astype(self.dtype, copy=False), theta).reshape(left_bond * 2, 2 * right_bond)
+
+        u, singular, vh = _thin_svd(theta)
+        keep = int(np.count_nonzero(singular > MPS_CUTOFF * singular[0]))
+        keep = max(1, min(keep, self.max_bond))
+        weights = singular ** 2
+        self.truncation_error += float(weights[keep:].sum() / weights.sum())
+
+        # Renormalize what is kept; the center moves onto the right site
+        singular = singular[:keep] / np.sqrt(weights[:keep].sum())
+        self.tensors[site] = u[:, :keep].reshape(left_bond, 2, keep)
+        self.tensors[site + 1] = (singular[:, None] * vh[:keep]).reshape(keep, 2, right_bond)
+        self.center = site + 1
+
+    def _move_center(self, site):
+        """Shift the orthogonality center to a site with QR decompositions."""
+        while self.center < site:
+            tensor = self.tensors[self.center]
+            left_bond, _, right_bond = tensor.shape
+            q, r = np.linalg.qr(tensor.reshape(left_bond * 2, right_bond))
+            self.tensors[self.center] = q.reshape(left_bond, 2, q.shape[1])
+            self.tensors[self.center + 1] = np.einsum('ab,bsr->asr', r, self.tensors[self.center + 1])
+            self.center += 1
+        while self.center > site:
+            tensor = self.tensors[self.center]
+            left_bond, _, right_bond = tensor.shape
+            q, r = np.linalg.qr(tensor.reshape(left_bond, 2 * right_bond).T)
+            self.tensors[self.center] = q.T.reshape(q.shape[1], 2, right_bond)
+            self.tensors[self.center - 1] = np.einsum('lsa,ab->lsb', self.tensors[self.center - 1], r.T)
+            self.center -= 1
+
+    def amplitude(self, basis_state):
+        """Amplitude of one basis state, given as an index or a bitstring (qubit 0 rightmost)."""
+        if isinstance(basis_state, str):
+            if len(basis_state) != self.num_qubits or set(basis_state) - set('01'):
+                raise ValueError(f"Basis state '{basis_state}' must be {self.num_qubits} bits.")
+            bits = [int(bit) for bit in reversed(basis_state)]
+        else:
+            bits = [(int(basis_state) >> qubit) & 1 for qubit in range(self.num_qubits)]
+
+        vector = np.ones(1, dtype=self.dtype)
+        for tensor, bit in zip(self.tensors, bits):
+            vector = vector @ tensor[:, bit, :]
+        return complex(vector[0])
+
+    def sample(self, shots, rng):
+        """Sample full-register outcomes site by site as a (shots, n) bit array."""
+        # With the center on site 0 the rest is right-orthonormal, so each
+        # conditional probability is the norm of the partially contracted branch
+        self._move_center(0)
+        environment = np.ones((shots, 1), dtype=self.dtype)
+        bits = np.empty((shots, self.num_qubits), dtype=np.uint8)
+        rows = np.arange(shots)
+        for site, tensor in enumerate(self.tensors):
+            branches = np.einsum('kl,lsr->ksr', environment, tensor)
+            weights = np.sum(np.abs(branches) ** 2, axis=2)
+            outcome = (rng.random(shots) * weights.sum(axis=1) < weights[:, 1]).astype(np.intp)
+            bits[:, site] = outcome
+            environment = branches[rows, outcome] / np.sqrt(weights[rows, outcome])[:, None]
+        return bits
+
+    def sample_outcomes(self, shots, rng):
+        """Draw shots and return the distinct packed outcomes with their counts."""
+        return count_bit_samples(self.sample, shots, self.num_qubits, rng)
+
+    def to_statevector(self):
+        """Contract the chain into a dense vector."""
+        state = np.ones((1, 1), dtype=self.dtype)
+        for tensor in self.tensors:
+            # New site bits become the most significant so qubit q stays bit q
+            state = np.einsum('ir,rsq->siq', state, tensor).reshape(-1, tensor.shape[2])
+        return normalize_statevector(state[:, 0])
+
+    def probabilities(self):
+        """Exact outcome distribution of the (truncated) state as a dense array."""
+        return np.abs(self.to_statevector()) ** 2
+
+    def result_fields(self):
+        return {
+            'bond_dimension': self.bond_dimension,
+            'truncation_error': self.truncation_error,
+            'mps': self
+        }
+
+class MPSEngine(Engine):
+    """Matrix product state simulation for weakly entangled circuits on many qubits."""
+    name = 'mps'
+
+    def start(self, num_qubits, dtype=np.complex128):
+        self.state = MPSState(num_qubits, dtype=dtype)
+
+    @timed_apply
+    def apply(self, gate, target, control=None, matrix=None):
+        self.state.apply(gate, target, control, matrix)
+
+    @timed_finish
+    def finish(self):
+        return self._hand_over(self.state)
+
+def _memmap_high_qubits(target, control, block_qubits):
+    """Qubits of an operation that lie above the memmap engine's in-RAM block."""
+    return {qubit for qubit in (target, control) if qubit is not None and qubit >= block_qubits}
+
+def count_memmap_passes(circuit, block_qubits=MEMMAP_BLOCK_QUBITS, max_high=MEMMAP_MAX_HIGH_QUBITS):
+    """Passes over its state file the memmap engine makes for a circuit."""
+    if circuit.num_qubits <= block_qubits:
+        return 1
+    passes, high = 1, set()
+    for target, control in zip(circuit.records['target'].tolist(), circuit.records['control'].tolist()):
+        qubits = _memmap_high_qubits(target, None if control < 0 else control, block_qubits)
+        if len(high | qubits) > max_high:
+            passes, high = passes + 1, set()
+        high |= qubits
+    return passes
+
+class MemmapState(EngineState):
+    """Dense statevector kept in a memory-mapped temporary file.
+
+    Only one block of amplitudes (plus the partner blocks of a pass) is in
+    RAM at a time, so registers larger than memory fit as long as the disk
+    does. The file is deleted when the state is closed or collected.
+    """
+
+    def __init__(self, num_qubits, block_qubits=MEMMAP_BLOCK_QUBITS, dtype=np.complex128,
+                 directory=MEMMAP_DIRECTORY):
+        if num_qubits > MEMMAP_MAX_QUBITS:
+            raise ValueError(f"The memmap engine supports at most {MEMMAP_MAX_QUBITS} qubits.")
+        self.num_qubits = num_qubits
+        self.block_qubits = min(block_qubits, num_qubits)
+        nbytes = np.dtype(dtype).itemsize << num_qubits
+        directory = directory if directory is not None else tempfile.gettempdir()
+        free = shutil.disk_usage(directory).free
+        if nbytes > free:
+            raise ValueError(
+                f"A {num_qubits}-qubit state file needs {nbytes / 2 ** 30:,.1f} GiB of disk, "
+                f"but only {free / 2 ** 30:,.1f} GiB is free.")
+
+        # Extending an anonymous file leaves it sparse: every amplitude starts at zero
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._file.truncate(nbytes)
+        self.amplitudes = np.memmap(self._file, dtype=dtype, mode='r+', shape=(1 << num_qubits,))
+        self.amplitudes[0] = 1
+        self.passes = 0
+        self._block_weights = None
+
+    @property
+    def blocks(self):
+        """The state as a (blocks, 2**block_qubits) array; each row is contiguous on disk."""
+        return self.amplitudes.reshape(-1, 1 << self.block_qubits)
+
+    def run_pass(self, operations, high):
+        """Apply operations in one blocked pass; `high` lists their qubits above the block.
+
+        Each step loads the blocks that differ only in the high qubits and
+        reorders those qubits to sit just above the block's own, so the
+        loaded rows form one small statevector the dense kernels can update.
+        """
+        block_qubits = self.block_qubits
+        high = sorted(high)
+        position = {qubit: block_qubits + i for i, qubit in enumerate(high)}
+        # Row offsets of the partner blocks, ordered so high[i] is bit i of the row
+        offsets = np.zeros(1, dtype=np.int64)
+        for qubit in high:
+            offsets = np.concatenate([offsets, offsets + (1 << (qubit - block_qubits))])
+        mask = int(offsets[-1])
+
+        blocks = self.blocks
+        for base in range(len(blocks)):
+            if base & mask:
+                continue
+            rows = base + offsets
+            chunk = np.array(blocks[rows]).reshape(1, -1)
+            for gate, target, control, matrix in operations:
+                apply_gate(chunk, gate, position.get(target, target),
+                           None if control is None else position.get(control, control), matrix)
+            blocks[rows] = chunk.reshape(len(rows), -1)
+        self.amplitudes.flush()
+        self.passes += 1
+        self._block_weights = None
+
+    def block_weights(self):
+        """Probability mass of each block, read once and kept until the state changes."""
+        if self._block_weights is None:
+            self._block_weights = np.array([np.sum(np.square(np.abs(block), dtype=np.float64))
+                                            for block in self.blocks])
+        return self._block_weights
+
+    def sample_outcomes(self, shots, rng):
+        """Split the shots over blocks by their mass, then draw within each block."""
+        weights = self.block_weights()
+        per_block = rng.multinomial(shots, weights / weights.sum())
+        outcomes, counts = [], []
+        blocks = self.blocks
+        for index in np.flatnonzero(per_block).tolist():
+            probabilities = np.square(np.abs(blocks[index]), dtype=np.float64)
+            probabilities /= probabilities.sum()
+            block_counts = rng.multinomial(per_block[index], probabilities)
+            drawn = np.flatnonzero(block_counts)
+            outcomes.append((drawn + (index << self.block_qubits)).astype(np.uint64))
+            counts.append(block_counts[drawn])
+        return np.concatenate(outcomes), np.concatenate(counts)
+
+    def probabilities(self):
+        """Exact outcome distribution as a dense array (small registers only)."""
+        weights = np.square(np.abs(self.amplitudes), dtype=np.float64)
+        return weights / weights.sum()
+
+    def to_statevector(self):
+        """Copy the state into RAM."""
+        return normalize_statevector(np.array(self.amplitudes))
+
+    def result_fields(self):
+        return {'passes': self.passes}
+
+    def close(self):
+        """Unmap the state and delete its file."""
+        self.amplitudes = None
+        self._file.close()
+
+class MemmapEngine(Engine):
+    """Out-of-core statevector simulation through a memory-mapped file.
+
+    Gates are buffered until the next one would need more than
+    MEMMAP_MAX_HIGH_QUBITS qubits above the in-RAM block; the buffered group
+    then runs in one pass over the file, so fused runs of gates cost one
+    read and one write of the state rather than one per gate.
+    """
+    name = 'memmap'
+    # Gates only run when a pass is flushed, so only the whole run is timed
+    per_gate_timing = False
+    run_attributes = ('state', 'pending', 'pending_high')
+
+    def start(self, num_qubits, dtype=np.complex128):
+        self.state = MemmapState(num_qubits, dtype=dtype)
+        self.pending = []
+        self.pending_high = set()
+
+    def apply(self, gate, target, control=None, matrix=None):
+        if gate not in GATE_MATRICES and gate not in ('U', 'CNOT', 'CZ'):
+            raise ValueError(f"Unsupported gate '{gate}'")
+        high = _memmap_high_qubits(target, control, self.state.block_qubits)
+        if len(self.pending_high | high) > MEMMAP_MAX_HIGH_QUBITS:
+            self._flush()
+        self.pending.append((gate, target, control, matrix))
+        self.pending_high |= high
+
+    def _flush(self):
+        if self.pending:
+            self.state.run_pass(self.pending, self.pending_high)
+        self.pending = []
+        self.pending_high = set()
+
+    @timed_finish
+    def finish(self):
+        self._flush()
+        # The caller closes the handed-over state once it has sampled from it
+        return self._hand_over(self.state)
+
+    def discard(self):
+        """Drop an unfinished run and delete its state file."""
+        if self.state is not None:
+            self.state.close()
+        super().discard()
+
+def _qubit_axes(num_qubits, qubits):
+    """Shape splitting a 2**n index into one axis per qubit in `qubits` and
+    grouped axes for the rest, with the axis of each of `qubits`."""
+    shape, axes = [], {}
+    above = num_qubits
+    for qubit in sorted(qubits, reverse=True):
+        axes[qubit] = len(shape) + 1
+        shape += [1 << (above - qubit - 1), 2]
+        above = qubit
+    shape.append(1 << above)
+    return shape, [axes[qubit] for qubit in qubits]
+
+@functools.lru_cache(maxsize=256)
+def _superoperator_terms(data, size):
+    """Nonzero (output block, [(weight, input block)]) terms of a superoperator,
+    leaving out blocks the channel maps to themselves unchanged."""
+    superoperator = np.frombuffer(data, dtype=complex).reshape(size, size)
+    terms = []
+    for out in range(size):
+        inputs = np.flatnonzero(superoperator[out]).tolist()
+        if inputs == [out] and superoperator[out, out] == 1:
+            continue
+        # Python scalars keep the arithmetic in the matrix's own precision, and
+        # real weights (all of the built-in channels') skip the complex multiply
+        weights = [superoperator[out, i].item() for i in inputs]
+        weights = [w.real if w.imag == 0 else w for w in weights]
+        terms.append((out, list(zip(weights, inputs))))
+    return tuple(terms)
+
+def _saved_blocks(terms):
+    """Blocks read by another output; they must be saved before that output is overwritten."""
+    written = {out for out, _ in terms}
+    return {i for out, inputs in terms for _, i in inputs if i != out} & written
+
+def superoperator_workspace(superoperator, nbytes):
+    """Bytes apply_superoperator allocates applying a channel to a matrix of `nbytes`:
+    copies of the saved blocks, plus one scratch block if any output sums inputs."""
+    superoperator = np.ascontiguousarray(superoperator, dtype=complex)
+    blocks = superoperator.shape[0]
+    terms = _superoperator_terms(superoperator.tobytes(), blocks)
+    scratch = any(len(inputs) > 1 for _, inputs in terms)
+    return (len(_saved_blocks(terms)) + scratch) * nbytes // blocks
+
+def apply_superoperator(matrix, superoperator, qubits):
+    """Apply a channel's superoperator in place to a (2**n, 2**n) density matrix.
+
+    The superoperator is the (4**k, 4**k) matrix sum(kron(K, K.conj())) of
+    the channel's Kraus operators on `qubits` (qubits[0] is the least
+    significant bit of K's index). The matrix is reshaped so each of the
+    qubits' row and column bits has its own axis, cutting it into 4**k
+    blocks, and every output block is a weighted sum of input blocks. The
+    channels used here are sparse, so zero weights are skipped, blocks the
+    channel leaves alone are not touched and blocks only rescaled are
+    updated in place.
+    """
+    n = matrix.shape[0].bit_length() - 1
+    size = 1 << len(qubits)
+    shape, row_axes = _qubit_axes(n, qubits)
+    view = matrix.reshape(shape + shape)
+    col_axes = [axis + len(shape) for axis in row_axes]
+
+    def block(index):
+        row, column = divmod(index, size)
+        selection = [slice(None)] * len(view.shape)
+        for j, (row_axis, col_axis) in enumerate(zip(row_axes, col_axes)):
+            selection[row_axis] = (row >> j) & 1
+            selection[col_axis] = (column >> j) & 1
+        return view[tuple(selection)]
+
+    superoperator = np.ascontiguousarray(superoperator, dtype=complex)
+    terms = _superoperator_terms(superoperator.tobytes(), size * size)
+    saved = {i: block(i).copy() for i in _saved_blocks(terms)}
+    scratch = None
+    for out, inputs in terms:
+        target = block(out)
+        if len(inputs) == 1 and inputs[0][1] == out:
+            target *= inputs[0][0]
+            continue
+        if not inputs:
+            target[...] = 0
+            continue
+        sources = [(weight, saved[i] if i in saved else block(i)) for weight, i in inputs]
+        weight, source = sources[0]
+        np.multiply(source, weight, out=target)
+        for weight, source in sources[1:]:
+            if scratch is None:
+                scratch = np.empty_like(target)
+            np.multiply(source, weight, out=scratch)
+            target += scratch
+    return matrix
+
+class DensityMatrix(EngineState):
+    """Exact mixed state of a small register as a dense (2**n, 2**n) matrix.
+
+    Flattened row-major, the matrix is a statevector of 2n qubits whose low
+    n bits index the column and high n bits the row, so a gate U acts as U
+    on qubit target + n and as conj(U) on qubit target of the dense kernels.
+    """
+
+    def __init__(self, num_qubits, dtype=np.complex128):
+        if num_qubits > DENSITY_MAX_QUBITS:
+            raise ValueError(
+                f"The density-matrix engine is limited to {DENSITY_MAX_QUBITS} qubits.")
+        self.num_qubits = num_qubits
+        self.matrix = np.zeros((1 << num_qubits, 1 << num_qubits), dtype=dtype)
+        self.matrix[0, 0] = 1
+
+    @property
+    def nbytes(self):
+        return self.matrix.nbytes
+
+    def apply(self, gate, target, control=None, matrix=None):
+        n = self.num_qubits
+        flat = self.matrix.reshape(1, -1)
+        if gate in ('CNOT', 'CZ'):
+            # Both gates are real, so the column side gets the same gate
+            if control is not None:
+                apply_controlled_gate(flat, gate, control + n, target + n)
+                apply_controlled_gate(flat, gate, control, target)
+            return
+        if gate == 'U':
+            unitary = np.asarray(matrix)
+        elif gate in GATE_MATRICES:
+            unitary = GATE_MATRICES[gate]
+        else:
+            raise ValueError(f"Unsupported gate '{gate}'")
+        apply_single_qubit_gate(flat, unitary, target + n)
+        apply_single_qubit_gate(flat, unitary.conj(), target)
+
+    def apply_channel(self, superoperator, qubits):
+        apply_superoperator(self.matrix, superoperator, qubits)
+
+    def probabilities(self):
+        """Outcome distribution from the diagonal, in double precision."""
+        probabilities = np.clip(self.matrix.diagonal().real.astype(np.float64), 0, None)
+        return probabilities / probabilities.sum()
+
+    def sample_outcomes(self, shots, rng):
+        return sample_distribution(self.probabilities(), shots, rng)
+
+    def purity(self):
+        """Tr(rho**2): 1 for a pure state, 1 / 2**n when fully mixed."""
+        return float(np.vdot(self.matrix, self.matrix).real)
+
+    def fidelity(self, statevector):
+        """Overlap <psi|rho|psi> with a pure state."""
+        statevector = np.asarray(statevector, dtype=self.matrix.dtype)
+        return float(np.vdot(statevector, self.matrix @ statevector).real)
+
+    def result_fields(self):
+        return {'density_matrix': self.matrix, 'purity': self.purity()}
+
+class DensityMatrixEngine(Engine):
+    """Exact noisy simulation on density matrices of up to DENSITY_MAX_QUBITS qubits.
+
+    After every gate the engine applies the channels of its `noise` model,
+    which the caller sets for the run like `trace`. It is not listed in
+    ENGINES: noiseless circuits are cheaper as statevectors, and noisy ones
+    run through QuantumComputer.simulate_density.
+    """
+    name = 'density'
+    # Noise follows every original gate, so gates are neither fused nor cancelled
+    supports_fusion = False
+    noise = None
+    run_attributes = ('state', 'idle', 'deferred')
+
+    def start(self, num_qubits, dtype=np.complex128):
+        self.state = DensityMatrix(num_qubits, dtype=dtype)
+        # Gates each qubit has waited through without its relaxation applied yet,
+        # and qubits whose last single-qubit gate's depolarizing is still pending
+        self.idle = [0] * num_qubits
+        self.deferred = set()
+
+    @timed_apply
+    def apply(self, gate, target, control=None, matrix=None):
+        qubits = (target,) if control is None else (target, control)
+        if self.noise is not None:
+            # A qubit's own channels commute with gates on other qubits, so they
+            # are only applied, merged into one, before the next gate touches it
+            self._flush(qubits)
+        self.state.apply(gate, target, control, matrix)
+        if self.noise is not None:
+            if control is None:
+                self.deferred.add(target)
+            elif self.noise.depolarizing[2] is not None:
+                self.state.apply_channel(self.noise.depolarizing[2], qubits)
+            self.idle = [waited + 1 for waited in self.idle]
+
+    def _flush(self, qubits):
+        for qubit in qubits:
+            superoperator = self.noise.relaxation(self.idle[qubit])
+            if qubit in self.deferred and self.noise.depolarizing[1] is not None:
+                depolarizing = self.noise.depolarizing[1]
+                superoperator = depolarizing if superoperator is None else superoperator @ depolarizing
+            if superoperator is not None:
+                self.state.apply_channel(superoperator, (qubit,))
+            self.idle[qubit] = 0
+            self.deferred.discard(qubit)
+
+    @timed_finish
+    def finish(self):
+        if self.noise is not None:
+            self._flush(range(self.state.num_qubits))
+        return self._hand_over(self.state)
+
+# Simulation engines selectable through QuantumComputer(engine=...)
+ENGINES = {
+    'aer': AerEngine,
+    'numpy': NumpyEngine,
+    'stabilizer': StabilizerEngine,
+    'sparse': SparseEngine,
+    'mps': MPSEngine,
+    'memmap': MemmapEngine,
+}
+
+# Opcodes of the compact circuit representation; 'U' carries a fused 2x2 matrix
+GATE_OPCODES = {'H': 0, 'X': 1, 'Y': 2, 'Z': 3, 'CNOT': 4, 'CZ': 5, 'U': 6}
+OPCODE_GATES = tuple(GATE_OPCODES)
+CONTROLLED_OPCODES = (GATE_OPCODES['CNOT'], GATE_OPCODES['CZ'])
+# Padding opcode used when circuits of different lengths are stacked
+NOOP_OPCODE = 255
+
+CIRCUIT_DTYPE = np.dtype([
+    ('opcode', np.uint8),
+    ('target', np.int32),
+    ('control', np.int32),  # -1 when the gate has no control qubit
+    ('param', np.int32),    # index into Circuit.matrices for 'U', otherwise -1
+])
+
+class Circuit:
+    """Compact circuit stored as one structured NumPy record per gate.
+
+    Appending is amortized O(1), register sizing and validation are
+    vectorized, and slices share the record buffer. Iterating yields the
+    operation dicts used throughout the app, and from_operations() accepts
+    them, so code written against lists of dicts keeps working.
+    """
+
+    def __init__(self, capacity=16):
+        self._records = np.empty(max(capacity, 1), dtype=CIRCUIT_DTYPE)
+        self._size = 0
+        self.matrices = []
+        # Original step indices behind each operation, set by optimize_circuit
+        self.steps = None
+
+    @classmethod
+    def from_operations(cls, circuit_operations):
+        """Build a circuit from a list of {'gate', 'target', 'control'} dicts."""
+        circuit = cls(len(circuit_operations))
+        rows = []
+        for i, op in enumerate(circuit_operations):
+            if 'gate' not in op:
+                raise ValueError(f"Operation #{i+1} is missing gate type.")
+            opcode = GATE_OPCODES.get(op['gate'])
+            if opcode is None:
+                raise ValueError(f"Operation #{i+1} uses invalid gate '{op['gate']}'")
+            param = -1
+            if op['gate'] == 'U':
+                param = len(circuit.matrices)
+                circuit.matrices.append(np.asarray(op['matrix'], dtype=complex))
+            control = op.get('control')
+            rows.append((opcode, op.get('target', 0), -1 if control is None else control, param))
+
+        circuit._records[:len(rows)] = rows
+        circuit._size = len(rows)
+        return circuit
+
+    @property
+    def records(self):
+        """Structured array view of the operations."""
+        return self._records[:self._size]
+
+    @property
+    def num_qubits(self):
+        """Register size needed by the circuit."""
+        if self._size == 0:
+            return 1
+        records = self.records
+        return int(max(records['target'].max(), records['control'].max())) + 1
+
+    def append(self, gate, target, control=None, matrix=None):
+        """Add one gate, growing the buffer geometrically when full."""
+        if gate not in GATE_OPCODES:
+            raise ValueError(f"Invalid gate '{gate}'")
+        if self._size == len(self._records):
+            grown = np.empty(2 * len(self._records), dtype=CIRCUIT_DTYPE)
+            grown[:self._size] = self._records[:self._size]
+            self._records = grown
+
+        param = -1
+        if gate == 'U':
+            param = len(self.matrices)
+            self.matrices.append(np.asarray(matrix, dtype=complex))
+        self._records[self._size] = (
+            GATE_OPCODES[gate], target, -1 if control is None else control, param)
+        self._size += 1
+        return self
+
+    def operations(self):
+        """Iterate (gate, target, control, matrix) tuples without building dicts."""
+        for opcode, target, control, param in self.records.tolist():
+            yield (OPCODE_GATES[opcode], target, None if control < 0 else control,
+                   self.matrices[param] if param >= 0 else None)
+
+    def operation_keys(self):
+        """Hashable per-operation keys, used by the prefix state cache."""
+        keys = []
+        for opcode, target, control, param in self.records.tolist():
+            matrix = self.matrices[param].tobytes() if param >= 0 else None
+            keys.append((opcode, target, control, matrix))
+        return keys
+
+    def key(self):
+        """Stable digest of the gate sequence."""
+        digest = hashlib.sha256(np.ascontiguousarray(self.records[['opcode', 'target', 'control']]).tobytes())
+        for param in self.records['param'][self.records['param'] >= 0].tolist():
+            digest.update(self.matrices[param].tobytes())
+        return digest.hexdigest()
+
+    def validate(self):
+        """Raise ValueError for the first malformed operation."""
+        if self._size == 0:
+            raise ValueError("Circuit is empty. Please add quantum gates.")
+        records = self.records
+        controlled = np.isin(records['opcode'], CONTROLLED_OPCODES)
+
+        problems = [
+            (np.flatnonzero(records['target'] < 0), "has a negative target qubit."),
+            (np.flatnonzero(controlled & (records['control'] < 0)), "requires control qubit."),
+            (np.flatnonzero(controlled & (records['control'] == records['target'])),
+             "uses the same qubit as control and target."),
+        ]
+        failures = [(indices[0], message) for indices, message in problems if indices.size]
+        if failures:
+            index, message = min(failures)
+            raise ValueError(f"Operation #{index+1} {message}")
+
+    def to_operations(self):
+        """Return the circuit as a list of operation dicts."""
+        return list(self)
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for gate, target, control, matrix in self.operations():
+            op = {'gate': gate, 'target': target}
+            if control is not None:
+                op['control'] = control
+            if matrix is not None:
+                op['matrix'] = matrix
+            yield op
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            view = Circuit.__new__(Circuit)
+            view._records = self.records[index]
+            view._size = len(view._records)
+            view.matrices = self.matrices
+            view.steps = None
+            return view
+        if not -self._size <= index < self._size:
+            raise IndexError("Circuit index out of range")
+        index %= self._size
+        return next(iter(self[index:index + 1]))
+
+def as_circuit(circuit_operations):
+    """Accept either a Circuit or a list of operation dicts."""
+    if isinstance(circuit_operations, Circuit):
+        return circuit_operations
+    return Circuit.from_operations(circuit_operations)
+
+def _prepare_circuit(circuit_operations):
+    """as_circuit() for a simulation entry point, raising ValueError if malformed."""
+    circuit = as_circuit(circuit_operations)
+    circuit.validate()
+    return circuit
+
+SELF_INVERSE_GATES = {'H', 'X', 'Y', 'Z', 'CNOT', 'CZ'}
+
+def _operation_qubits(op):
+    control = op.get('control')
+    if op['gate'] in ('CNOT', 'CZ') and control is not None:
+        return {op['target'], control}
+    return {op['target']}
+
+def _operation_matrix(op):
+    return op['matrix'] if op['gate'] == 'U' else GATE_MATRICES[op['gate']]
+
+def _is_diagonal(op):
+    if op['gate'] in ('Z', 'CZ'):
+        return True
+    return op['gate'] == 'U' and op['matrix'][0, 1] == 0 and op['matrix'][1, 0] == 0
+
+def _cancels(first, second):
+    if first['gate'] != second['gate'] or first['gate'] not in SELF_INVERSE_GATES:
+        return False
+    if first['gate'] == 'CZ':
+        return _operation_qubits(first) == _operation_qubits(second)
+    return first['target'] == second['target'] and first.get('control') == second.get('control')
+
+def optimize_circuit(circuit_operations, fuse=True, verify=False):
+    """Cancel, commute and fuse gates before simulation.
+
+    Self-inverse pairs (H·H, X·X, CNOT·CNOT, CZ·CZ, ...) cancel, diagonal
+    Z/CZ gates commute past each other to meet their partners, and with
+    `fuse` runs of single-qubit gates on one target merge into a single 'U'
+    operation carrying a 2x2 matrix. The optimized circuit's `steps` lists the
+    original step indices each operation covers.
+
+    With verify, the report's 'equivalent' says whether the optimized
+    circuit has the original's unitary up to a global phase.
+
+    Returns the optimized Circuit and a report of what was removed.
+    """
+    circuit = as_circuit(circuit_operations)
+    optimized = []
+    # Operations touching each qubit, in circuit order; removed ones are marked dead
+    timelines = {}
+    cancelled = fused = 0
+
+    for step, (gate, target, control, matrix) in enumerate(circuit.operations()):
+        op = {'gate': gate, 'target': target, 'control': control, 'steps': [step],
+              'order': step, 'alive': True}
+        if matrix is not None:
+            op['matrix'] = matrix
+        if op['gate'] in ('CNOT', 'CZ') and op['control'] is None:
+            # Controlled gates without a control are skipped by every engine
+            cancelled += 1
+            continue
+        qubits = _operation_qubits(op)
+        single = op['gate'] in GATE_MATRICES or op['gate'] == 'U'
+        merged = False
+
+        # Walk back over earlier operations on the same qubits while they commute
+        history = heapq.merge(*(reversed(timelines.get(qubit, [])) for qubit in qubits),
+                              key=lambda previous: -previous['order'])
+        for previous in history:
+            if not previous['alive']:
+                continue
+
+            if _cancels(previous, op):
+                previous['alive'] = False
+                cancelled += 2
+                merged = True
+            elif fuse and single and (previous['gate'] in GATE_MATRICES or previous['gate'] == 'U') \
+                    and previous['target'] == op['target']:
+                matrix = _operation_matrix(op) @ _operation_matrix(previous)
+                if np.allclose(matrix, np.eye(2), atol=1e-12):
+                    previous['alive'] = False
+                    cancelled += len(previous['steps']) + len(op['steps'])
+                else:
+                    previous.update(gate='U', matrix=matrix, steps=previous['steps'] + op['steps'])
+                    fused += 1
+                merged = True
+            elif _is_diagonal(previous) and _is_diagonal(op):
+                continue
+            break
+
+        if not merged:
+            optimized.append(op)
+            for qubit in qubits:
+                timeline = timelines.setdefault(qubit, [])
+                # Drop dead entries from the tail so walks stay short
+                while timeline and not timeline[-1]['alive']:
+                    timeline.pop()
+                timeline.append(op)
+
+    optimized = [op for op in optimized if op['alive']]
+
+    report = {
+        'original_gates': len(circuit),
+        'optimized_gates': len(optimized),
+        'removed': len(circuit) - len(optimized),
+        'cancelled': cancelled,
+        'fused': fused
+    }
+    optimized_circuit = Circuit.from_operations(optimized)
+    optimized_circuit.steps = [op['steps'] for op in optimized]
+    if verify:
+        report['equivalent'] = circuits_equivalent(circuit, optimized_circuit, circuit.num_qubits)
+    return optimized_circuit, report
+
+def _check_unitary_size(num_qubits):
+    if num_qubits > UNITARY_MAX_QUBITS:
+        raise ValueError(f"Unitaries are limited to {UNITARY_MAX_QUBITS} qubits.")
+
+def _apply_to_columns(matrix, operations):
+    """Apply gates in place to every column of a (2**n, 2**n) matrix at once.
+
+    Flattened row-major, the matrix is a statevector of 2n qubits whose high
+    n bits index the row, so a gate on qubit q is a gate on qubit q + n of
+    the dense kernels, and every pass runs over contiguous runs of at least
+    2**n entries.
+    """
+    n = matrix.shape[0].bit_length() - 1
+    flat = matrix.reshape(1, -1)
+    for gate, target, control, gate_matrix in operations:
+        apply_gate(flat, gate, target + n, None if control is None else control + n, gate_matrix)
+    return matrix
+
+def circuit_unitary(circuit_operations, num_qubits=None, dtype=np.complex128):
+    """Full (2**n, 2**n) matrix of a circuit, indexed like its statevectors.
+
+    Every basis state goes through the circuit at once: the identity is a
+    batch of 2**n statevectors, one per column, so each gate is a single
+    vectorized pass and column b ends up as the image of basis state b.
+    """
+    circuit = as_circuit(circuit_operations)
+    num_qubits = circuit.num_qubits if num_qubits is None else num_qubits
+    _check_unitary_size(num_qubits)
+    return _apply_to_columns(np.eye(1 << num_qubits, dtype=dtype), circuit.operations())
+
+def circuits_equivalent(first, second, num_qubits=None, atol=1e-9):
+    """Whether two circuits have the same unitary up to a global phase.
+
+    The identity batch goes through `first` and then through `second`
+    inverted, which leaves a multiple of the identity exactly when the two
+    agree; one batch is built instead of two unitaries.
+    """
+    first, second = as_circuit(first), as_circuit(second)
+    if num_qubits is None:
+        num_qubits = max(first.num_qubits, second.num_qubits)
+    # Every built-in gate is its own inverse
+    inverse = [(gate, target, control, np.conj(matrix).T if gate == 'U' else matrix)
+               for gate, target, control, matrix in reversed(list(second.operations()))]
+    states = _apply_to_columns(circuit_unitary(first, num_qubits), inverse)
+
+    phase = states[0, 0]
+    if abs(abs(phase) - 1) > atol:
+        return False
+    np.fill_diagonal(states, states.diagonal() - phase)
+    return bool(np.max(np.abs(states)) <= atol)
+
+def circuit_features(circuit):
+    """Summarize the properties of a circuit the engine planner looks at."""
+    records = circuit.records
+    opcodes = records['opcode']
+    entangling = records['control'] >= 0
+    # H and fused matrices can split a basis state in two; the other gates permute or phase it
+    branching = (opcodes == GATE_OPCODES['H']) | (opcodes == GATE_OPCODES['U'])
+
+    # Two-qubit gates crossing each cut between neighbouring qubits
+    num_qubits = circuit.num_qubits
+    crossings = np.zeros(num_qubits + 1, dtype=np.int64)
+    low = np.minimum(records['control'][entangling], records['target'][entangling])
+    high = np.maximum(records['control'][entangling], records['target'][entangling])
+    np.add.at(crossings, low, 1)
+    np.add.at(crossings, high, -1)
+
+    return {
+        'num_qubits': num_qubits,
+        'gates': len(circuit),
+        'entangling_gates': int(np.count_nonzero(entangling)),
+        # SWAPs needed to make every two-qubit gate act on neighbours
+        'swap_distance': int(np.sum(high - low - 1)),
+        'branching_gates': int(np.count_nonzero(branching)),
+        'max_cut_crossings': int(np.cumsum(crossings).max(initial=0)),
+        'clifford': not np.any(opcodes == GATE_OPCODES['U']),
+        'memmap_passes': count_memmap_passes(circuit)
+    }
+
+def estimate_engine_costs(features, shots=DEFAULT_SHOTS, require_statevector=False,
+                          precision=DEFAULT_PRECISION):
+    """Estimate each engine's run time (ms) and peak memory (bytes) for a circuit.
+
+    The model is coarse and calibrated on this app's kernels: a Python
+    overhead per gate plus work proportional to the amplitudes each gate
+    touches, then the cost of reading out samples or probabilities. Engines
+    that cannot run the circuit get a 'reason' instead of figures.
+    """
+    n = features['num_qubits']
+    gates = features['gates']
+    dim = 2.0 ** n
+    expands = n <= STATEVECTOR_EXPANSION_MAX_QUBITS
+    # Bytes per amplitude; amplitude sweeps are bandwidth-bound and scale with it
+    amplitude = np.dtype(PRECISIONS[precision]).itemsize
+    sweep = amplitude / 16
+    estimates = {}
+
+    # Reading out a state of `size` amplitudes holds float64 probabilities next
+    # to it; sampling adds the int64 multinomial counts and the distinct outcomes
+    def readout(size):
+        if shots is None:
+            return 8 * dim
+        return 16 * size + 24 * min(shots, size)
+
+    # Dense engines: every gate sweeps all 2**n amplitudes, and so does readout.
+    # A gate's kernel saves half the state and builds a product of the other half
+    dense_bytes = max(2 * amplitude * dim, amplitude * dim + readout(dim))
+    estimates['numpy'] = {'time': 0.02 * gates + 1e-5 * sweep * gates * dim + 1e-5 * dim,
+                          'bytes': dense_bytes}
+    # Aer pays a fixed transpile-and-launch cost but runs compiled kernels; its
+    # own state and the copy handed back overlap
+    estimates['aer'] = {'time': 150 + 3e-6 * sweep * gates * dim + 1e-5 * dim,
+                        'bytes': dense_bytes}
+
+    # Tableau updates cost O(n) per gate; readout row-reduces once, then samples bits
+    if not features['clifford']:
+        estimates['stabilizer'] = {'reason': "circuit has non-Clifford gates"}
+    elif require_statevector and not expands:
+        estimates['stabilizer'] = {'reason': "statevector output needs a dense engine"}
+    else:
+        time_ms = 0.025 * gates + 0.02 * n + 1e-6 * n ** 3
+        time_ms += 1e-6 * shots * n if shots is not None else 1e-5 * dim
+        # The tableau plus the row reduction's copies of it
+        memory = 5 * n * n
+        if shots is not None:
+            # One batch of sampled bits at the worst-case rank n, and the packed
+            # outcomes with np.unique's sorted copies
+            shot_bytes = stabilizer_shot_bytes(n, n)
+            memory += min(shots * shot_bytes, max(STABILIZER_SAMPLE_BYTES, shot_bytes))
+            memory += 32 * ((n + 63) // 64) * shots
+        else:
+            # The enumerated support indices and the probability array
+            memory += 16 * dim
+        if expands:
+            time_ms += 1e-5 * n * dim
+            memory += amplitude * dim
+        estimates['stabilizer'] = {'time': time_ms, 'bytes': memory}
+
+    # Sparse support at most doubles per branching gate, then the engine densifies
+    support = 2.0 ** min(features['branching_gates'], n)
+    if n > 62:
+        estimates['sparse'] = {'reason': f"{n} qubits exceed the sparse index width"}
+    elif n > SPARSE_MAX_DENSE_QUBITS and support > SPARSE_MAX_SUPPORT:
+        estimates['sparse'] = {'reason': "support may outgrow the sparse engine"}
+    elif require_statevector and not expands:
+        estimates['sparse'] = {'reason': "statevector output needs a dense engine"}
+    else:
+        if support <= SPARSE_DENSE_FRACTION * dim:
+            memory = (8 + amplitude) * support + max(SPARSE_MERGE_BYTES * support, readout(support))
+            if expands:
+                memory += amplitude * dim
+        else:
+            memory = dense_bytes
+        estimates['sparse'] = {'time': 0.03 * gates + 5e-5 * gates * support + 1e-5 * support,
+                               'bytes': memory}
+
+    # MPS work follows the bond dimension the two-qubit gates can build across a cut;
+    # past MPS_MAX_BOND the state is truncated and the result only approximate
+    exact_bond = 2.0 ** min(features['max_cut_crossings'], n // 2)
+    bond = min(exact_bond, MPS_MAX_BOND)
+    if require_statevector and not expands:
+        estimates['mps'] = {'reason': "statevector output needs a dense engine"}
+    else:
+        two_site = features['entangling_gates'] + 2 * features['swap_distance']
+        time_ms = 0.02 * gates + two_site * (0.1 + 3.5e-5 * bond ** 3)
+        memory = 2 * amplitude * n * bond ** 2
+        if shots is not None:
+            time_ms += shots * n * (3e-4 + 3.6e-6 * bond ** 2)
+            memory += 2 * amplitude * min(shots, SAMPLE_CHUNK_SHOTS) * bond
+        if shots is None or expands:
+            time_ms += 1e-5 * dim * bond
+            memory += amplitude * dim * bond
+        estimates['mps'] = {'time': time_ms, 'bytes': memory,
+                            'approximate': exact_bond > MPS_MAX_BOND}
+
+    # Memmap: the dense kernels' work plus a read and write of the state file per pass
+    # (and one more read to sample); RAM holds one pass's blocks at a time
+    if n > MEMMAP_MAX_QUBITS:
+        estimates['memmap'] = {'reason': f"{n} qubits exceed the memmap engine's limit"}
+    elif require_statevector and not expands:
+        estimates['memmap'] = {'reason': "statevector output needs a dense engine"}
+    else:
+        file_bytes = amplitude * dim
+        time_ms = estimates['numpy']['time'] + 2 * features['memmap_passes'] * file_bytes / MEMMAP_BYTES_PER_MS
+        if shots is not None:
+            time_ms += file_bytes / MEMMAP_BYTES_PER_MS
+        resident = min(dim, 2.0 ** (MEMMAP_BLOCK_QUBITS + MEMMAP_MAX_HIGH_QUBITS))
+        estimates['memmap'] = {'time': time_ms, 'bytes': 2 * amplitude * resident,
+                               'disk_bytes': file_bytes}
+    return estimates
+
+def plan_engine(circuit, shots=DEFAULT_SHOTS, require_statevector=False, engine=None,
+                max_bytes=DEFAULT_SESSION_MEMORY_BYTES, downgrade=True, precision=DEFAULT_PRECISION):
+    """Pick the engine with the lowest estimated cost for a circuit.
+
+    Engines estimated to need more than max_bytes are ruled out, and ties in
+    time go to the smaller footprint. Engines that would truncate the state
+    are only picked when no exact engine fits. With `engine` given, the plan
+    only reports that engine's estimate, unless it would exceed max_bytes:
+    then the plan switches to the cheapest engine that fits (recording
+    'downgraded_from'), or raises ValueError when downgrade is False. An
+    engine that cannot run the circuit at all raises ValueError with the
+    reason. Estimates assume amplitudes stored at `precision`. Returns the chosen
+    engine, its estimate, every candidate's estimate and the circuit
+    features they were based on.
+    """
+    features = circuit_features(circuit)
+    candidates = estimate_engine_costs(features, shots, require_statevector, precision)
+    for estimate in candidates.values():
+        if 'reason' not in estimate and estimate['bytes'] > max_bytes:
+            estimate["reason"] = f"needs about {estimate['bytes'] / 2 ** 20:,.0f} MiB"
+
+    downgraded_from = None
+    requested = candidates.get(engine) or {}
+    if 'reason' in requested and 'bytes' not in requested:
+        raise ValueError(f"The {engine} engine cannot run this circuit: {requested['reason']}.")
+    if requested.get('bytes', 0) > max_bytes:
+        if not downgrade:
+            raise ValueError(
+                f"The {engine} engine needs about {requested['bytes'] / 2 ** 20:,.0f} MiB, "
+                f"over the {max_bytes / 2 ** 20:,.0f} MiB memory budget.")
+        downgraded_from, engine = engine, None
+
+    if engine is None:
+        feasible = [name for name, estimate in candidates.items() if 'reason' not in estimate]
+        if not feasible:
+            reasons = "; ".join(f"{name}: {estimate['reason']}"
+                                for name, estimate in candidates.items())
+            raise ValueError(f"No engine can simulate this circuit ({reasons}).")
+        exact = [name for name in feasible if not candidates[name].get('approximate')]
+        engine = min(exact or feasible,
+                     key=lambda name: (candidates[name]['time'], candidates[name]['bytes']))
+
+    plan = {
+        'engine': engine,
+        'estimate': candidates.get(engine),
+        'candidates': candidates,
+        'features': features
+    }
+    if downgraded_from is not None:
+        plan['downgraded_from'] = downgraded_from
+    return plan
+
+def gate_fidelity(gate, step):
+    """Simplified fidelity model for a gate applied at position `step`."""
+    fidelity = 1.0
+    if gate in ['CNOT', 'CZ']:  # Two-qubit gates have lower fidelity
+        fidelity = 0.95
+    elif gate in ['X', 'Y', 'Z']:  # Single-qubit gates have high fidelity
+        fidelity = 0.99
+    else:
+        fidelity = 0.97
+
+    # Add noise effect based on circuit depth
+    depth_factor = 1.0 - (0.01 * step)  # Decrease fidelity with circuit depth
+    return fidelity * max(0.8, depth_factor)
+
+def _step_entry(gate, step, target, control):
+    """performance_data entry of one circuit step."""
+    return {
+        'gate': gate,
+        'fidelity': gate_fidelity(gate, step),
+        'target': target,
+        'control': control
+    }
+
+# Pauli gates indexed by the 2-bit codes used for sampled trajectory errors
+PAULI_CODES = (None, 'X', 'Y', 'Z')
+
+def depolarizing_probability(fidelity, num_qubits=1):
+    """Depolarizing error probability giving a gate the stated average fidelity.
+
+    A channel replacing the state by a uniformly random non-identity Pauli
+    with probability p has average fidelity 1 - p * d / (d + 1) for d = 2**n.
+    """
+    dim = 2 ** num_qubits
+    return min(1.0, (1 - fidelity) * (dim + 1) / dim)
+
+def run_trajectories(circuit, error_probabilities, shots, seeds, dtype=np.complex128):
+    """Simulate one batch of noisy trajectories and sample each of them.
+
+    `shots` and `seeds` hold the shot count and seed of every trajectory in
+    the batch, which runs as one (batch, 2**n) array. After gate i each
+    trajectory independently suffers, with probability error_probabilities[i],
+    a uniformly random non-identity Pauli on the gate's qubits. Returns the
+    merged distinct outcomes and counts.
+    """
+    # Each trajectory draws its errors and samples from its own generator,
+    # so its outcome does not depend on the batch it runs in
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+    batch = len(shots)
+    # Bits 0-1 of a code pick the target's Pauli, bits 2-3 the control's (0 is identity)
+    highs = np.array([4 if control is None else 16 for _, _, control, _ in circuit.operations()])
+    draws = np.array([rng.random(len(highs)) for rng in rngs]).reshape(batch, len(highs))
+    error_codes = np.array([rng.integers(1, highs) for rng in rngs]).reshape(batch, len(highs))
+    states = np.zeros((batch, 1 << circuit.num_qubits), dtype=dtype)
+    states[:, 0] = 1
+
+    for step, ((gate, target, control, matrix), probability) in enumerate(
+            zip(circuit.operations(), error_probabilities)):
+        apply_gate(states, gate, target, control, matrix)
+        rows = np.flatnonzero(draws[:, step] < probability)
+        if not rows.size:
+            continue
+        codes = error_codes[rows, step]
+        for code in np.unique(codes).tolist():
+            hit = rows[codes == code]
+            subset = states[hit]
+            for qubit, pauli in ((target, code & 3), (control, code >> 2)):
+                if pauli:
+                    apply_gate(subset, PAULI_CODES[pauli], qubit)
+            states[hit] = subset
+
+    outcomes, counts = [], []
+    for state, state_shots, rng in zip(states, np.asarray(shots).tolist(), rngs):
+        drawn, drawn_counts = sample_outcomes(state, state_shots, rng)
+        outcomes.append(drawn)
+        counts.append(drawn_counts)
+    unique, inverse = np.unique(np.concatenate(outcomes), return_inverse=True)
+    return unique, np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int64)
+
+def kraus_superoperator(kraus):
+    """Superoperator sum(kron(K, K.conj())) of a channel's Kraus operators."""
+    return sum(np.kron(operator, np.conj(operator)) for operator in kraus)
+
+def depolarizing_kraus(probability, num_qubits=1):
+    """Kraus operators replacing the state by a random non-identity Pauli with `probability`."""
+    paulis = [np.eye(2, dtype=complex)] + [GATE_MATRICES[p] for p in PAULI_CODES[1:]]
+    operators = [np.eye(1, dtype=complex)]
+    for _ in range(num_qubits):
+        # Later qubits are the more significant bit of the operator's index
+        operators = [np.kron(pauli, operator) for pauli in paulis for operator in operators]
+    weight = probability / (len(operators) - 1)
+    return [np.sqrt(1 - probability) * operators[0]] + [np.sqrt(weight) * op for op in operators[1:]]
+
+def amplitude_damping_kraus(gamma):
+    """Kraus operators decaying |1> to |0> with probability gamma (T1 relaxation)."""
+    return [np.array([[1, 0], [0, np.sqrt(1 - gamma)]], dtype=complex),
+            np.array([[0, np.sqrt(gamma)], [0, 0]], dtype=complex)]
+
+def dephasing_kraus(probability):
+    """Kraus operators of a phase flip with `probability` (pure dephasing)."""
+    return [np.sqrt(1 - probability) * np.eye(2, dtype=complex),
+            np.sqrt(probability) * GATE_MATRICES['Z']]
+
+class NoiseModel:
+    """Noise channels the density-matrix engine applies after every gate.
+
+    The gate's qubits are depolarized with probability `depolarizing`
+    (`two_qubit_depolarizing` for CNOT and CZ, jointly on both qubits). Each
+    qubit of the register, busy or idle, is then amplitude-damped with
+    probability `amplitude_damping` and phase-flipped with probability
+    `dephasing`, since the whole register waits while a gate runs.
+    """
+
+    def __init__(self, depolarizing=0.0, two_qubit_depolarizing=None, amplitude_damping=0.0,
+                 dephasing=0.0):
+        if two_qubit_depolarizing is None:
+            two_qubit_depolarizing = depolarizing
+        parameters = {'depolarizing': depolarizing, 'two_qubit_depolarizing': two_qubit_depolarizing,
+                      'amplitude_damping': amplitude_damping, 'dephasing': dephasing}
+        for name, value in parameters.items():
+            if not 0 <= value <= 1:
+                raise ValueError(f"The {name.replace('_', ' ')} probability must be between 0 and 1.")
+        self.parameters = parameters
+
+        # Superoperators are built once; a run only contracts them into the state
+        self.depolarizing = {
+            1: kraus_superoperator(depolarizing_kraus(depolarizing, 1)) if depolarizing else None,
+            2: (kraus_superoperator(depolarizing_kraus(two_qubit_depolarizing, 2))
+                if two_qubit_depolarizing else None),
+        }
+        self._relaxation = {}
+        if amplitude_damping or dephasing:
+            self._relaxation[1] = (kraus_superoperator(dephasing_kraus(dephasing))
+                                   @ kraus_superoperator(amplitude_damping_kraus(amplitude_damping)))
+
+    @classmethod
+    def from_coherence_times(cls, t1, t2, gate_time, depolarizing=0.0, two_qubit_depolarizing=None):
+        """Model a register with relaxation time T1 and coherence time T2.
+
+        Each gate lasts `gate_time` (in the same unit as t1 and t2). Damping
+        decays coherences by exp(-t / 2T1) on its own, so dephasing supplies
+        the rest of the exp(-t / T2) decay; T2 cannot exceed 2 * T1.
+        """
+        if t1 <= 0 or t2 <= 0 or gate_time < 0:
+            raise ValueError("Coherence times must be positive and the gate time non-negative.")
+        if t2 > 2 * t1:
+            raise ValueError("T2 cannot exceed twice T1.")
+        gamma = 1 - np.exp(-gate_time / t1)
+        dephasing = (1 - np.exp(-gate_time * (1 / t2 - 1 / (2 * t1)))) / 2
+        return cls(depolarizing, two_qubit_depolarizing, float(gamma), float(dephasing))
+
+    def key(self):
+        """Hashable summary of the parameters, for result caching."""
+        return tuple(sorted(self.parameters.items()))
+
+    def relaxation(self, gates):
+        """Superoperator of one qubit's damping and dephasing over `gates` gate times."""
+        if not self._relaxation or not gates:
+            return None
+        if gates not in self._relaxation:
+            self._relaxation[gates] = np.linalg.matrix_power(self._relaxation[1], gates)
+        return self._relaxation[gates]
+
+    def workspace(self, nbytes):
+        """Largest block workspace of the model's channels on a matrix of `nbytes`."""
+        relaxation, depolarizing = self.relaxation(1), self.depolarizing[1]
+        channels = [relaxation, depolarizing, self.depolarizing[2]]
+        if relaxation is not None and depolarizing is not None:
+            # The engine merges a qubit's relaxation and depolarizing into one channel
+            channels.append(relaxation @ depolarizing)
+        channels = [channel for channel in channels if channel is not None]
+        return max((superoperator_workspace(channel, nbytes) for channel in channels), default=0)
+
+class Measurements(Mapping):
+    """Sampled measurement counts kept as packed arrays.
+
+    `outcomes` holds each distinct outcome as a uint64 basis index (a row of
+    little-endian uint64 words for registers wider than 64 qubits) and
+    `counts` the matching number of shots. Bitstrings are only formatted when
+    the mapping is read, keyed with qubit 0 as the rightmost character, and
+    each value is the {'count', 'probability', 'interval', 'basis_state'}
+    dict the UI shows.
+    """
+
+    def __init__(self, outcomes, counts, shots, num_qubits):
+        self.outcomes = outcomes
+        self.counts = counts
+        self.shots = shots
+        self.num_qubits = num_qubits
+        self._positions = None
+        self._intervals = None
+
+    @property
+    def probabilities(self):
+        return self.counts / self.shots
+
+    @property
+    def intervals(self):
+        """(k, 2) array of Wilson confidence bounds on each probability."""
+        if self._intervals is None:
+            self._intervals = wilson_intervals(self.counts, self.shots)
+        return self._intervals
+
+    @property
+    def nbytes(self):
+        return self.outcomes.nbytes + self.counts.nbytes
+
+    def bitstring(self, position):
+        """Format the outcome at a position as a bitstring."""
+        outcome = self.outcomes[position]
+        if np.ndim(outcome) == 0:
+            return format(int(outcome), f'0{self.num_qubits}b')
+        bits = ''.join(format(int(word), '064b') for word in outcome[::-1])
+        return bits[-self.num_qubits:]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        for position in range(len(self.counts)):
+            yield self.bitstring(position)
+
+    def _entry(self, position, state):
+        count = int(self.counts[position])
+        low, high = self.intervals[position]
+        return {
+            'count': count,
+            'probability': count / self.shots,
+            'interval': (float(low), float(high)),
+            'basis_state': f"|{state}⟩"
+        }
+
+    def __getitem__(self, state):
+        if self._positions is None:
+            self._positions = {key: position for position, key in enumerate(self)}
+        return self._entry(self._positions[state], state)
+
+    def items(self):
+        # Format each bitstring once instead of twice through __getitem__
+        for position, state in enumerate(self):
+            yield state, self._entry(position, state)
+
+    def top_k(self, k):
+        """The k most frequent outcomes as (bitstring, entry) pairs, most frequent first."""
+        return [(self.bitstring(position), self._entry(position, self.bitstring(position)))
+                for position in top_k_indices(self.counts, k)]
+
+    def marginal(self, qubits):
+        """Counts summed over every qubit outside `qubits`.
+
+        Bit i of each marginal outcome is the measured value of qubits[i], so
+        the result is another Measurements over len(qubits) qubits.
+        """
+        qubits = _check_marginal_qubits(qubits, self.num_qubits)
+        if len(qubits) > 64:
+            raise ValueError("Marginals are limited to 64 qubits.")
+
+        outcomes = np.zeros(len(self.counts), dtype=np.uint64)
+        for i, qubit in enumerate(qubits):
+            words = self.outcomes if self.outcomes.ndim == 1 else self.outcomes[:, qubit // 64]
+            outcomes |= ((words >> np.uint64(qubit % 64)) & np.uint64(1)) << np.uint64(i)
+
+        unique, inverse = np.unique(outcomes, return_inverse=True)
+        counts = np.bincount(inverse, weights=self.counts, minlength=len(unique))
+        return Measurements(unique, counts.astype(np.int64), self.shots, len(qubits))
+
+    def memory(self, rng):
+        """Expand the counts into per-shot packed outcomes in random order."""
+        return rng.permutation(np.repeat(self.outcomes, self.counts, axis=0))
+
+def normalize_statevector(statevector):
+    """Rescale a statevector to unit norm if it drifted."""
+    norm = np.sqrt(np.sum(np.abs(statevector) ** 2))
+    if not np.isclose(norm, 1.0, atol=1e-7):
+        statevector = statevector / norm
+    return statevector
+
+def validate_shots(shots):
+    """Check that a shot count is a positive integer within MAX_SHOTS."""
+    if isinstance(shots, bool) or not isinstance(shots, (int, np.integer)):
+        raise ValueError("Shots must be an integer.")
+    if not 1 <= shots <= MAX_SHOTS:
+        raise ValueError(f"Shots must be between 1 and {MAX_SHOTS}.")
+    return int(shots)
+
+def circuit_key(circuit, shots, seed, engine, memory=False, tolerance=None,
+                precision=DEFAULT_PRECISION):
+    """Hash a canonical form of a circuit and its run settings."""
+    payload = repr((engine, precision, circuit.num_qubits, shots, seed, memory, tolerance,
+                    circuit.key()))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _result_nbytes(result):
+    """Roughly estimate the memory held by a simulation result."""
+    size = 512
+    state_vector = result.get('state_vector')
+    if state_vector is not None:
+        size += state_vector.nbytes
+    measurements = result.get('measurements')
+    if measurements is not None:
+        size += measurements.nbytes
+    for name in ('state', 'memory', 'probabilities', 'mps', 'density_matrix', 'unitary'):
+        if result.get(name) is not None:
+            size += result[name].nbytes
+    size += 256 * len(result.get('performance_data', {}))
+    size += sum(len(label) + 64 for label in result.get('stabilizers', []))
+    return size
+
+def _cache_copy(result):
+    """Copy of a result that shares only its frozen arrays with the original.
+
+    Performance data and engine states such as an MPS are mutable, so the
+    cache and each of its callers get their own copies.
+    """
+    result = dict(result)
+    for name, value in result.items():
+        if name == 'performance_data' or isinstance(value, EngineState):
+            result[name] = copy.deepcopy(value)
+    return result
+
+class SimulationCache:
+    """Thread-safe LRU cache of simulation results bounded by a memory budget."""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return a copy of the cached result for `key`, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return _cache_copy(entry[0])
+
+    def put(self, key, result):
+        """Store a result, evicting least recently used entries to fit the budget."""
+        size = _result_nbytes(result)
+        if size > self.max_bytes:
+            return
+
+        # Cached arrays are shared between callers, so freeze them
+        measurements = result.get('measurements')
+        arrays = list(result.values())
+        if measurements is not None:
+            arrays += [measurements.outcomes, measurements.counts]
+        for array in arrays:
+            if isinstance(array, np.ndarray):
+                array.setflags(write=False)
+        entry = _cache_copy(result)
+
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (entry, size)
+            self.current_bytes += size
+            self._evict()
+
+    def configure(self, max_bytes):
+        """Change the memory budget, evicting entries if it shrank."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """Drop every cached result and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return hit/miss/eviction counters and current memory use."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+# Default result cache; sessions that run the same seeded circuit share its entries
+RESULT_CACHE = SimulationCache()
+
+class _PrefixNode:
+    __slots__ = ('parent', 'operation', 'children', 'state')
+
+    def __init__(self, parent=None, operation=None):
+        self.parent = parent
+        self.operation = operation
+        self.children = {}
+        self.state = None
+
+class PrefixStateCache:
+    """Trie of intermediate statevectors keyed by operation prefix.
+
+    Appending a gate to a cached circuit costs one gate application, and
+    editing its tail resumes from the longest cached prefix. Stored states
+    are evicted least recently used first to stay within `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_PREFIX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._roots = {}
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def longest_prefix(self, num_qubits, operations, precision=DEFAULT_PRECISION):
+        """Find the deepest cached state along `operations`.
+
+        States of each register size and precision live in separate tries.
+        Returns (depth, state copy or None, node) where `node` can be passed
+        to extend() to keep growing the same branch.
+        """
+        with self._lock:
+            node = self._roots.setdefault((num_qubits, precision), _PrefixNode())
+            best = (0, None, node)
+            for depth, operation in enumerate(operations, start=1):
+                node = node.children.get(operation)
+                if node is None:
+                    break
+                if node.state is not None:
+                    best = (depth, node, node)
+
+            depth, holder, node = best
+            if holder is None:
+                return 0, None, node
+            self._states.move_to_end(id(holder))
+            return depth, holder.state.copy(), node
+
+    def extend(self, node, operation, state):
+        """Store the state reached by applying `operation` after `node`."""
+        with self._lock:
+            child = node.children.get(operation)
+            if child is None:
+                child = node.children[operation] = _PrefixNode(node, operation)
+            if child.state is not None:
+                self.current_bytes -= child.state.nbytes
+            child.state = state
+            self.current_bytes += state.nbytes
+            self._states[id(child)] = child
+            self._states.move_to_end(id(child))
+            self._evict()
+            return child
+
+    def clear(self):
+        """Drop every cached state."""
+        with self._lock:
+            self._roots.clear()
+            self._states.clear()
+            self.current_bytes = 0
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._states:
+            _, node = self._states.popitem(last=False)
+            self.current_bytes -= node.state.nbytes
+            node.state = None
+
+            # Prune branches that no longer lead to any cached state
+            while node.parent is not None and node.state is None and not node.children:
+                del node.parent.children[node.operation]
+                node = node.parent
+
+class BackendPool:
+    """Thread-safe pool of warm simulation engines shared by every session.
+
+    Engines are created on first use, at most `size` per engine type, and
+    handed out exclusively for the duration of one run. Borrowers wait for
+    a free engine once the limit is reached.
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE):
+        self.size = size
+        self._idle = {}
+        self._created = {}
+        self._condition = threading.Condition()
+
+    def warm(self, engine='aer'):
+        """Create engines of one type up front so the first runs skip construction."""
+        with self._condition:
+            idle = self._idle.setdefault(engine, [])
+            while self._created.get(engine, 0) < self.size:
+                idle.append(ENGINES[engine]())
+                self._created[engine] = self._created.get(engine, 0) + 1
+            self._condition.notify_all()
+
+    def configure(self, size):
+        """Change how many engines of each type may exist."""
+        with self._condition:
+            self.size = size
+            for engine, idle in self._idle.items():
+                while idle and self._created[engine] > size:
+                    idle.pop()
+                    self._created[engine] -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def borrow(self, engine='aer'):
+        """Lend an engine instance exclusively for the duration of a `with` block."""
+        instance = self._acquire(engine)
+        try:
+            yield instance
+        finally:
+            self._release(engine, instance)
+
+    def stats(self):
+        """Return created and idle engine counts per engine type."""
+        with self._condition:
+            return {
+                engine: {'created': created, 'idle': len(self._idle.get(engine, []))}
+                for engine, created in self._created.items()
+            }
+
+    def _acquire(self, engine):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown simulation engine '{engine}'. Choose from {sorted(ENGINES)}.")
+        with self._condition:
+            idle = self._idle.setdefault(engine, [])
+            while not idle and self._created.get(engine, 0) >= self.size:
+                self._condition.wait()
+            if idle:
+                return idle.pop()
+            self._created[engine] = self._created.get(engine, 0) + 1
+
+        # Build outside the lock; simulator construction is the slow part
+        try:
+            return ENGINES[engine]()
+        except Exception:
+            with self._condition:
+                self._created[engine] -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, engine, instance):
+        with self._condition:
+            if self._created[engine] > self.size:
+                # The pool shrank while this engine was out
+                self._created[engine] -= 1
+            else:
+                self._idle[engine].append(instance)
+            self._condition.notify()
+
+# Engines borrowed by QuantumComputer runs unless a computer is given its own pool
+BACKEND_POOL = BackendPool()
+
+class MemoryAdmission:
+    """Admission control for simulation memory, shared by every session.
+
+    Each run reserves its estimated peak memory before any state is
+    allocated. A run larger than the per-process or per-session budget is
+    rejected outright; one that fits but would overrun the memory other runs
+    currently hold waits in line for up to `queue_timeout` seconds.
+    """
+
+    def __init__(self, process_bytes=DEFAULT_PROCESS_MEMORY_BYTES,
+                 session_bytes=DEFAULT_SESSION_MEMORY_BYTES, queue_timeout=DEFAULT_ADMISSION_TIMEOUT):
+        self.process_bytes = process_bytes
+        self.session_bytes = session_bytes
+        self.queue_timeout = queue_timeout
+        self.reserved_bytes = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self._sessions = {}
+        self._condition = threading.Condition()
+
+    def limit(self):
+        """Largest reservation a single run can ever be granted."""
+        return min(self.process_bytes, self.session_bytes)
+
+    def configure(self, process_bytes=None, session_bytes=None, queue_timeout=None):
+        """Change the budgets or queue timeout; waiting runs re-check at once."""
+        with self._condition:
+            if process_bytes is not None:
+                self.process_bytes = process_bytes
+            if session_bytes is not None:
+                self.session_bytes = session_bytes
+            if queue_timeout is not None:
+                self.queue_timeout = queue_timeout
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes, session=None):
+        """Hold nbytes of the budgets for a `with` block; yields the time queued in ms."""
+        queued_ms = self._acquire(nbytes, session)
+        try:
+            yield queued_ms
+        finally:
+            self._release(nbytes, session)
+
+    def stats(self):
+        """Return budget usage and admission counters."""
+        with self._condition:
+            return {
+                'reserved_bytes': self.reserved_bytes,
+                'process_bytes': self.process_bytes,
+                'session_bytes': self.session_bytes,
+                'active_sessions': len(self._sessions),
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'rejected': self.rejected
+            }
+
+    def _fits(self, nbytes, session):
+        if self.reserved_bytes + nbytes > self.process_bytes:
+            return False
+        return self._sessions.get(session, 0) + nbytes <= self.session_bytes
+
+    def _acquire(self, nbytes, session):
+        start = time.perf_counter()
+        with self._condition:
+            if nbytes > self.limit():
+                self.rejected += 1
+                raise ValueError(
+                    f"This run needs about {nbytes / 2 ** 20:,.0f} MiB, over the "
+                    f"{self.limit() / 2 ** 20:,.0f} MiB simulation memory budget.")
+
+            queued = False
+            while not self._fits(nbytes, session):
+                remaining = start + self.queue_timeout - time.perf_counter()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise ValueError("The simulator is busy with other runs; please try again shortly.")
+                if not queued:
+                    self.queued += 1
+                    queued = True
+                self._condition.wait(remaining)
+
+            self.reserved_bytes += nbytes
+            self._sessions[session] = self._sessions.get(session, 0) + nbytes
+            self.admitted += 1
+        return (time.perf_counter() - start) * 1000
+
+    def _release(self, nbytes, session):
+        with self._condition:
+            self.reserved_bytes -= nbytes
+            self._sessions[session] -= nbytes
+            if not self._sessions[session]:
+                del self._sessions[session]
+            self._condition.notify_all()
+
+# The one memory budget every session's runs reserve against
+ADMISSION = MemoryAdmission()
+
+def _init_trajectory_worker():
+    # Each worker is one of many processes; splitting kernels across threads as well
+    # would oversubscribe the cores
+    KERNEL_THREADS.configure(threads=1)
+
+class TrajectoryPool:
+    """Process pool running batches of noisy trajectories in parallel.
+
+    Workers are spawned on first use and kept for later runs. Small
+    registers, single batches and a one-process pool run inline instead.
+    """
+
+    def __init__(self, processes=DEFAULT_TRAJECTORY_PROCESSES, min_qubits=TRAJECTORY_PARALLEL_MIN_QUBITS):
+        self.processes = processes
+        self.min_qubits = min_qubits
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def configure(self, processes=None, min_qubits=None):
+        """Change the worker count or the size threshold for this process."""
+        with self._lock:
+            if processes is not None and processes != self.processes:
+                if processes < 1:
+                    raise ValueError("Trajectory process count must be at least 1.")
+                self.processes = processes
+                self._shutdown()
+            if min_qubits is not None:
+                self.min_qubits = min_qubits
+
+    def workers(self, num_qubits, jobs):
+        """Processes that run() would use for this many jobs."""
+        if self.processes <= 1 or jobs <= 1 or num_qubits < self.min_qubits:
+            return 1
+        return min(self.processes, jobs)
+
+    def run(self, num_qubits, function, jobs):
+        """Return [function(*job) for job in jobs], computed in worker processes when worthwhile."""
+        if self.workers(num_qubits, len(jobs)) == 1:
+            return [function(*job) for job in jobs]
+        with self._lock:
+            if self._executor is None:
+                # Spawned workers are safe to start from the app's threaded server
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_trajectory_worker)
+            executor = self._executor
+        try:
+            return list(executor.map(function, *zip(*jobs)))
+        except BrokenProcessPool:
+            # A worker died or could not start; seeded jobs give the same results
+            # inline, and the next run starts a fresh pool
+            with self._lock:
+                if self._executor is executor:
+                    self._shutdown()
+            return [function(*job) for job in jobs]
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+# Worker processes for noisy trajectories; started on first use and kept warm
+TRAJECTORY_POOL = TrajectoryPool()
+
+def _error_result(error, kind="Simulation"):
+    return {
+        'error': f"{kind} error: {str(error)}",
+        'success': False
+    }
+
+class QuantumComputer:
+    def __init__(self, engine='aer', cache=RESULT_CACHE, prefix_cache=None, optimize=True,
+                 pool=None, admission=None, session=None, downgrade=True, timing=False,
+                 precision=DEFAULT_PRECISION):
+        # 'auto' lets the planner pick an engine per circuit
+        if engine != 'auto' and engine not in ENGINES:
+            raise ValueError(
+                f"Unknown simulation engine '{engine}'. Choose from {sorted(ENGINES)} or 'auto'.")
+        if engine != 'auto' and prefix_cache is not None and not hasattr(ENGINES[engine], 'snapshot'):
+            raise ValueError(f"The '{engine}' engine cannot resume from cached prefix states.")
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}'. Choose from {sorted(PRECISIONS)}.")
+        # Engines are borrowed from the shared pool per run instead of built per instance
+        self.engine_name = engine
+        self.pool = pool if pool is not None else BACKEND_POOL
+        # Runs reserve their estimated memory against the process and session budgets
+        self.admission = admission if admission is not None else ADMISSION
+        self.session = session
+        self.downgrade = downgrade
+        # Per-gate perf_counter_ns timing; may be switched between runs
+        self.timing = timing
+        # Amplitude precision of every engine, sampler and returned statevector
+        self.precision = precision
+        self.cache = cache
+        self.prefix_cache = prefix_cache
+        self.optimize = optimize
+        self.rng = np.random.default_rng()
         self.gates = ['H', 'X', 'Y', 'Z', 'CNOT', 'CZ']
         self.gate_descriptions = {
             'H': 'Hadamard Gate - Creates superposition',
@@ -21,134 +2604,816 @@ class QuantumComputer:
         }
         self.performance_data = {}
 
+    @property
+    def dtype(self):
+        """NumPy dtype of the amplitudes at the selected precision."""
+        return PRECISIONS[self.precision]
+
     def get_available_gates(self):
         """Return list of available quantum gates."""
         return self.gates
 
-    def simulate_circuit(self, circuit_operations):
-        """Simulate a quantum circuit using Qiskit with performance tracking."""
+    def _cached_result(self, key, traced=True):
+        """Cached result for `key`, or None; a timed run is repeated if the
+        cached result of a `traced` kind was not timed."""
+        if key is None:
+            return None
+        cached = self.cache.get(key)
+        if cached is not None and traced and self.timing and 'trace' not in cached['performance_data']:
+            return None
+        return cached
+
+    def simulate_circuit(self, circuit_operations, shots=DEFAULT_SHOTS, seed=None, memory=False,
+                         tolerance=None, require_statevector=False):
+        """Simulate a circuit on the selected engine, or the planner's pick with engine='auto'.
+
+        Takes a Circuit or a list of operation dicts. The final state is cached
+        without the seed, so seeded runs repeat their counts and unseeded ones
+        draw fresh shots. shots=None returns exact 'probabilities'; memory=True
+        adds per-shot outcomes; a tolerance turns shots into a budget sampled
+        until every confidence interval is narrower; require_statevector limits
+        the planner to engines returning a dense statevector.
+        """
         try:
             self.performance_data = {}  # Reset performance data
+            if shots is not None:
+                shots = validate_shots(shots)
+            elif memory or tolerance is not None:
+                raise ValueError("Per-shot memory and adaptive sampling require a shot count.")
+            if tolerance is not None and not 0 < tolerance < 1:
+                raise ValueError("Tolerance must be between 0 and 1.")
+            circuit = _prepare_circuit(circuit_operations)
 
             # Calculate number of qubits needed
-            num_qubits = 1
-            for op in circuit_operations:
-                num_qubits = max(num_qubits, op.get('target', 0) + 1)
-                if 'control' in op:
-                    num_qubits = max(num_qubits, op['control'] + 1)
+            num_qubits = circuit.num_qubits
+            if shots is None and num_qubits > EXACT_PROBABILITY_MAX_QUBITS:
+                raise ValueError(
+                    f"Exact probabilities are limited to {EXACT_PROBABILITY_MAX_QUBITS} qubits; "
+                    "pass a shot count to sample instead.")
 
-            # Create quantum circuit
-            qc = QuantumCircuit(num_qubits)
+            # Plan against the requested outputs and the memory budget; an explicit
+            # engine is only costed unless it would overrun the budget
+            plan = plan_engine(circuit, shots, require_statevector,
+                               engine=None if self.engine_name == 'auto' else self.engine_name,
+                               max_bytes=self.admission.limit(), downgrade=self.downgrade,
+                               precision=self.precision)
+            engine_name = plan['engine']
 
-            # Add gates to circuit with performance tracking
-            for i, op in enumerate(circuit_operations):
-                start_time = time.time()
-                gate = op['gate']
-                target = op.get('target', 0)
+            key = None
+            # The final state depends on neither the seed nor the shots, so it is cached
+            # without them and every run draws its own samples from it; a memmap
+            # state's file is closed once it has been sampled, so it is not kept
+            if self.cache is not None and engine_name != 'memmap':
+                key = circuit_key(circuit, None, None, engine_name, precision=self.precision)
+            final = self._cached_result(key)
+            rng = self.rng if seed is None else np.random.default_rng(seed)
 
-                # Apply gate and measure performance
+            # Reserve the estimated peak memory before anything is allocated;
+            # waits while other runs hold the budget. Sampling a cached dense
+            # state only allocates its probabilities
+            if final is None:
+                estimate = plan['estimate'] or {}
+                reserved = int(estimate.get('bytes', 0))
+                if self.prefix_cache is not None and hasattr(ENGINES[engine_name], 'snapshot'):
+                    # Every gate's snapshot is kept until the prefix cache evicts it
+                    state_bytes = np.dtype(self.dtype).itemsize << num_qubits
+                    snapshots = min(len(circuit), self.prefix_cache.max_bytes // state_bytes + 1)
+                    reserved += snapshots * state_bytes
+            elif isinstance(final['state'], np.ndarray):
+                reserved = np.dtype(np.float64).itemsize << num_qubits
+            else:
+                reserved = 0
+            with self.admission.reserve(reserved, self.session) as queued_ms:
+                if final is None:
+                    final = self._final_state(circuit, engine_name, plan)
+                    if key is not None:
+                        self.cache.put(key, final)
+                else:
+                    # The state was cached by a run with its own plan
+                    final['performance_data']['plan'] = plan
+                self.performance_data = final['performance_data']
+                state = final['state']
+
+                extra = {}
                 try:
-                    if gate == 'H':
-                        qc.h(target)
-                    elif gate == 'X':
-                        qc.x(target)
-                    elif gate == 'Y':
-                        qc.y(target)
-                    elif gate == 'Z':
-                        qc.z(target)
-                    elif gate == 'CNOT' and 'control' in op:
-                        qc.cx(op['control'], target)
-                    elif gate == 'CZ' and 'control' in op:
-                        qc.cz(op['control'], target)
-
-                    # Calculate gate fidelity (simplified model)
-                    fidelity = 1.0
-                    if gate in ['CNOT', 'CZ']:  # Two-qubit gates have lower fidelity
-                        fidelity = 0.95
-                    elif gate in ['X', 'Y', 'Z']:  # Single-qubit gates have high fidelity
-                        fidelity = 0.99
+                    if not isinstance(state, np.ndarray):
+                        # Tableau and sparse states sample directly; expand only small registers
+                        statevector = None
+                        if num_qubits <= STATEVECTOR_EXPANSION_MAX_QUBITS:
+                            statevector = state.to_statevector().astype(self.dtype, copy=False)
+                        if shots is None:
+                            extra['probabilities'] = state.probabilities()
+                        draw = state.sample_outcomes
+                        extra.update(state.result_fields())
                     else:
-                        fidelity = 0.97
-
-                    # Add noise effect based on circuit depth
-                    depth_factor = 1.0 - (0.01 * i)  # Decrease fidelity with circuit depth
-                    fidelity *= max(0.8, depth_factor)
-
-                    # Record performance metrics
-                    self.performance_data[f"step_{i}"] = {
-                        'gate': gate,
-                        'time': (time.time() - start_time) * 1000,  # Convert to ms
-                        'fidelity': fidelity,
-                        'target': target,
-                        'control': op.get('control', None)
-                    }
+                        statevector = state
+                        if shots is None:
+                            extra['probabilities'] = np.abs(statevector) ** 2
 
-                except Exception as e:
-                    self.performance_data[f"step_{i}"] = {
-                        'gate': gate,
-                        'error': str(e),
-                        'fidelity': 0.0
-                    }
-                    raise e
-
-            # Create statevector circuit and run simulation
-            sv_qc = qc.copy()
-            qc_transpiled = transpile(sv_qc, self.simulator)
-            job = self.simulator.run(qc_transpiled)
-            result = job.result()
-
-            # Get statevector
-            statevector = Statevector.from_instruction(qc)
-            if not isinstance(statevector, np.ndarray):
-                statevector = statevector.data
-
-            # Normalize
-            norm = np.sqrt(np.sum(np.abs(statevector) ** 2))
-            if not np.isclose(norm, 1.0, atol=1e-7):
-                statevector = statevector / norm
-
-            # Update measurement section
-            qc.measure_all()
-            meas_result = self.qasm_sim.run(qc, shots=1000).result()
-            counts = meas_result.get_counts()
-
-            # Format measurements
-            measurements = {
-                state: {
-                    'count': count,
-                    'probability': count / 1000,
-                    'basis_state': f"|{state}⟩"
-                }
-                for state, count in counts.items()
-            }
+                        # Sample measurement outcomes from the statevector probabilities
+                        def draw(batch, rng):
+                            return sample_outcomes(statevector, batch, rng)
+
+                    if tolerance is not None:
+                        outcomes, counts, shots, extra['converged'] = sample_adaptive(
+                            draw, shots, tolerance, rng)
+                    elif shots is not None:
+                        outcomes, counts = draw(shots, rng)
+
+                    if shots is not None:
+                        extra['measurements'] = Measurements(outcomes, counts, shots, num_qubits)
+                        if memory:
+                            extra['memory'] = extra['measurements'].memory(rng)
+                finally:
+                    # Sampling was the state file's last use
+                    if isinstance(state, MemmapState):
+                        state.close()
+            plan['admission'] = {'reserved_bytes': reserved, 'queued_ms': queued_ms}
 
             return {
                 'state_vector': statevector,
-                'measurements': measurements,
+                'shots': shots,
                 'performance_data': self.performance_data,
+                'optimization': final['optimization'],
+                'precision': self.precision,
+                'success': True,
+                **extra
+            }
+
+        except Exception as e:
+            return _error_result(e)
+
+    def _final_state(self, circuit, engine_name, plan):
+        """Run a circuit on a pooled engine and return its final state.
+
+        The returned dict holds the 'state' (a normalized statevector or the
+        engine's own state), the 'performance_data' and the 'optimization'
+        report; nothing in it depends on the seed or the shots.
+        """
+        num_qubits = circuit.num_qubits
+        # Compile: cancel and fuse gates before they reach the engine
+        operations = circuit
+        optimization = None
+        if self.optimize:
+            operations, optimization = optimize_circuit(
+                circuit, fuse=ENGINES[engine_name].supports_fusion)
+        steps = operations.steps or [[i] for i in range(len(operations))]
+        originals = list(circuit.operations())
+
+        trace = GateTrace(len(operations)) if self.timing else None
+        with self.pool.borrow(engine_name) as engine:
+            engine.trace = trace
+            try:
+                # Resume from the longest prefix simulated before, if any
+                resume_depth, prefix_node = 0, None
+                if self.prefix_cache is not None and hasattr(engine, 'snapshot'):
+                    canonical = operations.operation_keys()
+                    resume_depth, prefix_state, prefix_node = self.prefix_cache.longest_prefix(
+                        num_qubits, canonical, self.precision)
+                    engine.start(num_qubits, prefix_state, dtype=self.dtype)
+                else:
+                    engine.start(num_qubits, dtype=self.dtype)
+
+                for i, (gate, target, control, matrix) in enumerate(operations.operations()):
+                    if i < resume_depth:
+                        continue
+                    try:
+                        engine.apply(gate, target, control, matrix)
+                        if prefix_node is not None:
+                            prefix_node = self.prefix_cache.extend(
+                                prefix_node, canonical[i], engine.snapshot())
+                    except Exception as e:
+                        self.performance_data[f"step_{steps[i][0]}"] = {
+                            'gate': gate,
+                            'error': str(e),
+                            'fidelity': 0.0
+                        }
+                        raise e
+
+                state = engine.finish()
+            except Exception:
+                # A failed run must not leave its state on the pooled engine
+                engine.discard()
+                raise
+            finally:
+                # Pooled engines must not keep recording into this run's trace
+                engine.trace = None
+
+        # Spread each operation's measured time over the original steps it covers;
+        # resumed operations and steps cancelled by the optimizer cost nothing
+        step_ns = None
+        if trace is not None and ENGINES[engine_name].per_gate_timing:
+            step_ns = np.zeros(len(originals))
+            measured = trace.operation_ns[:trace.count].tolist()
+            for members, elapsed in zip(steps[resume_depth:], measured):
+                for step in members:
+                    step_ns[step] = elapsed / len(members)
+        covered = {step for members in steps for step in members}
+        for step, (original_gate, original_target, original_control, _) in enumerate(originals):
+            entry = _step_entry(original_gate, step, original_target, original_control)
+            if step_ns is not None:
+                entry['time'] = step_ns[step] / 1e6  # ms
+            if step not in covered:
+                entry['optimized_away'] = True
+            self.performance_data[f"step_{step}"] = entry
+        if trace is not None:
+            self.performance_data['trace'] = {
+                'engine': engine_name,
+                'operation_ns': trace.operation_ns[:trace.count],
+                'resumed': resume_depth,
+                'step_ns': step_ns,
+                'finish_ns': trace.finish_ns
+            }
+        self.performance_data['plan'] = plan
+
+        if isinstance(state, np.ndarray):
+            state = normalize_statevector(state)
+        return {'state': state, 'performance_data': self.performance_data,
+                'optimization': optimization}
+
+    def simulate_many(self, circuits, shots=DEFAULT_SHOTS, seed=None):
+        """Simulate many circuits with the NumPy kernels, batched by register size.
+
+        Circuits with the same qubit count share one (batch, 2**n) array, and
+        each gate position is applied once per distinct gate across the batch.
+        Each group reserves its memory first; groups over budget get error
+        results. With timing enabled, circuits sharing a kernel call split
+        its measured time. With a seed, each circuit samples from its own
+        child of the seed, so its counts do not depend on how the batch is
+        grouped. Batched circuits skip the planner and the optimizer, so their
+        results carry no plan and 'optimization' is None. Returns one result
+        dict per circuit, in input order.
+        """
+        shots = validate_shots(shots)
+        if seed is None:
+            rngs = [self.rng] * len(circuits)
+        else:
+            rngs = [np.random.default_rng(child)
+                    for child in np.random.SeedSequence(seed).spawn(len(circuits))]
+        results = [None] * len(circuits)
+        keys = [None] * len(circuits)
+        parsed = [None] * len(circuits)
+        groups = {}
+
+        for index, circuit_operations in enumerate(circuits):
+            try:
+                circuit = parsed[index] = _prepare_circuit(circuit_operations)
+                num_qubits = circuit.num_qubits
+            except Exception as e:
+                results[index] = _error_result(e)
+                continue
+
+            # Batch results have their own key: their samples come from the circuit's child seed
+            if self.cache is not None and seed is not None:
+                keys[index] = circuit_key(circuit, shots, (seed, index), 'numpy-batch',
+                                          precision=self.precision)
+            cached = self._cached_result(keys[index])
+            if cached is not None:
+                results[index] = cached
+                continue
+            groups.setdefault(num_qubits, []).append(index)
+
+        for num_qubits, members in groups.items():
+            # The batch holds one dense state per circuit, plus a copy for partial groups
+            reserved = (2 * np.dtype(self.dtype).itemsize * len(members)) << num_qubits
+            try:
+                with self.admission.reserve(reserved, self.session):
+                    states = np.zeros((len(members), 1 << num_qubits), dtype=self.dtype)
+                    states[:, 0] = 1
+                    performance = [{} for _ in members]
+                    depth = max(len(parsed[index]) for index in members)
+                    step_ns = np.zeros((len(members), depth))
+
+                    # Stack the gate records into a (batch, depth) table padded with no-ops
+                    table = np.zeros((len(members), depth), dtype=CIRCUIT_DTYPE)
+                    table['opcode'] = NOOP_OPCODE
+                    for row, index in enumerate(members):
+                        table[row, :len(parsed[index])] = parsed[index].records
+
+                    for step in range(depth):
+                        # Rows applying the same gate at this position share one kernel call
+                        column = table[:, step]
+                        signatures = ((column['opcode'].astype(np.int64) << 40)
+                                      | (column['target'].astype(np.int64) << 20)
+                                      | (column['control'].astype(np.int64) + 1))
+                        unique, inverse = np.unique(signatures, return_inverse=True)
+
+                        for group in range(len(unique)):
+                            rows = np.flatnonzero(inverse == group)
+                            opcode, target, control, _ = column[rows[0]].tolist()
+                            if opcode == NOOP_OPCODE:
+                                continue
+                            gate = OPCODE_GATES[opcode]
+                            control = None if control < 0 else control
+
+                            if self.timing:
+                                start = time.perf_counter_ns()
+                            if gate == 'U':
+                                # Fused matrices differ per circuit, so apply them row by row
+                                for row in rows:
+                                    matrix = parsed[members[row]].matrices[column[row]['param']]
+                                    apply_gate(states[row:row + 1], gate, target, control, matrix)
+                            elif len(rows) == len(members):
+                                apply_gate(states, gate, target, control)
+                            else:
+                                subset = states[rows]
+                                apply_gate(subset, gate, target, control)
+                                states[rows] = subset
+
+                            for row in rows.tolist():
+                                performance[row][f"step_{step}"] = _step_entry(gate, step, target, control)
+                            if self.timing:
+                                # Rows sharing a kernel call split its time
+                                elapsed = time.perf_counter_ns() - start
+                                step_ns[rows, step] = elapsed / len(rows)
+                                for row in rows.tolist():
+                                    performance[row][f"step_{step}"]['time'] = elapsed / len(rows) / 1e6
+
+                    for row, index in enumerate(members):
+                        if self.timing:
+                            performance[row]['trace'] = {
+                                'engine': 'numpy',
+                                'step_ns': step_ns[row, :len(parsed[index])]
+                            }
+                        statevector = normalize_statevector(states[row])
+                        outcomes, counts = sample_outcomes(statevector, shots, rngs[index])
+                        results[index] = {
+                            'state_vector': statevector,
+                            'measurements': Measurements(outcomes, counts, shots, num_qubits),
+                            'shots': shots,
+                            'performance_data': performance[row],
+                            'optimization': None,
+                            'precision': self.precision,
+                            'success': True
+                        }
+                        if keys[index] is not None:
+                            self.cache.put(keys[index], results[index])
+            except ValueError as e:
+                for index in members:
+                    results[index] = _error_result(e)
+
+        return results
+
+    def simulate_noisy(self, circuit_operations, shots=DEFAULT_SHOTS, seed=None,
+                       trajectories=NOISY_TRAJECTORIES):
+        """Sample a circuit under depolarizing noise derived from gate_fidelity.
+
+        Every gate's fidelity becomes a depolarizing error probability, and
+        the circuit runs as stochastic Pauli trajectories: each one is a
+        single statevector simulation with random Pauli errors inserted
+        after gates. The shots are split over the trajectories and their
+        counts merged. Trajectories are simulated in batches, spread over
+        the trajectory process pool. The circuit is not optimized first,
+        since cancelling gates would also cancel their noise. Only seeded
+        runs are cached.
+        """
+        try:
+            shots = validate_shots(shots)
+            circuit = _prepare_circuit(circuit_operations)
+            num_qubits = circuit.num_qubits
+            if trajectories < 1:
+                raise ValueError("A noisy run needs at least one trajectory.")
+            trajectories = min(trajectories, shots)
+
+            key = None
+            # Unseeded noise is drawn afresh on every run, so only seeded runs are cached
+            if self.cache is not None and seed is not None:
+                key = circuit_key(circuit, shots, seed, f"trajectories-{trajectories}",
+                                  precision=self.precision)
+            cached = self._cached_result(key, traced=False)
+            if cached is not None:
+                return cached
+
+            performance_data = {}
+            error_probabilities = []
+            for step, (gate, target, control, _) in enumerate(circuit.operations()):
+                entry = performance_data[f"step_{step}"] = _step_entry(gate, step, target, control)
+                entry['error_probability'] = depolarizing_probability(
+                    entry['fidelity'], 1 if control is None else 2)
+                error_probabilities.append(entry['error_probability'])
+
+            # Split the shots evenly, then cut the trajectories into memory-bounded
+            # batches, at least one per worker process the pool would use
+            trajectory_shots = np.full(trajectories, shots // trajectories)
+            trajectory_shots[:shots % trajectories] += 1
+            state_bytes = np.dtype(self.dtype).itemsize << num_qubits
+            per_worker = -(-trajectories // TRAJECTORY_POOL.workers(num_qubits, trajectories))
+            batch = max(1, min(per_worker, TRAJECTORY_BATCH_BYTES // state_bytes))
+            starts = range(0, trajectories, batch)
+            entropy = seed if seed is not None else int(self.rng.integers(1 << 62))
+            seeds = np.random.SeedSequence(entropy).spawn(trajectories)
+            jobs = [(circuit, error_probabilities, trajectory_shots[start:start + batch],
+                     seeds[start:start + batch], self.dtype)
+                    for start in starts]
+
+            # Every running batch holds its states plus the copies Pauli errors are applied to
+            workers = TRAJECTORY_POOL.workers(num_qubits, len(jobs))
+            reserved = 2 * min(batch, trajectories) * state_bytes * workers
+            with self.admission.reserve(reserved, self.session) as queued_ms:
+                start_time = time.perf_counter_ns()
+                batches = TRAJECTORY_POOL.run(num_qubits, run_trajectories, jobs)
+                elapsed = time.perf_counter_ns() - start_time
+
+            unique, inverse = np.unique(np.concatenate([outcomes for outcomes, _ in batches]),
+                                        return_inverse=True)
+            counts = np.bincount(inverse, weights=np.concatenate([counts for _, counts in batches]))
+            performance_data['noise'] = {
+                'trajectories': trajectories,
+                'batches': len(jobs),
+                'workers': workers,
+                'time_ms': elapsed / 1e6,
+                'queued_ms': queued_ms
+            }
+
+            result = {
+                'state_vector': None,
+                'measurements': Measurements(unique, counts.astype(np.int64), shots, num_qubits),
+                'shots': shots,
+                'trajectories': trajectories,
+                'performance_data': performance_data,
+                'precision': self.precision,
                 'success': True
             }
+            if key is not None:
+                self.cache.put(key, result)
+            return result
 
         except Exception as e:
+            return _error_result(e)
+
+    def simulate_density(self, circuit_operations, noise=None, shots=DEFAULT_SHOTS, seed=None):
+        """Simulate a circuit exactly as a density matrix under a NoiseModel.
+
+        The result holds the final 'density_matrix', its 'purity', the exact
+        'probabilities' and the 'fidelity' with the noiseless final state;
+        with shots=None nothing is sampled. Without a noise model the state
+        stays pure. Like simulate_noisy, the circuit is not optimized first.
+        """
+        try:
+            if shots is not None:
+                shots = validate_shots(shots)
+            circuit = _prepare_circuit(circuit_operations)
+            num_qubits = circuit.num_qubits
+            if num_qubits > DENSITY_MAX_QUBITS:
+                raise ValueError(
+                    f"Density-matrix simulation is limited to {DENSITY_MAX_QUBITS} qubits.")
+
+            key = None
+            # As in simulate_circuit, the exact result is cached without the seed
+            # and shots, and every run draws its own samples from it
+            if self.cache is not None:
+                noise_key = noise.key() if noise is not None else None
+                key = circuit_key(circuit, None, None, ('density', noise_key), precision=self.precision)
+            result = self._cached_result(key)
+            if result is None:
+                performance_data = {}
+
+                # The matrix plus the larger workspace of its two kinds of update: a gate's
+                # kernels hold a saved half and a product half, a channel the blocks it saves
+                matrix_bytes = np.dtype(self.dtype).itemsize << 2 * num_qubits
+                workspace = matrix_bytes
+                if noise is not None:
+                    workspace = max(workspace, noise.workspace(matrix_bytes))
+                reserved = matrix_bytes + workspace
+                with self.admission.reserve(reserved, self.session) as queued_ms:
+                    trace = GateTrace(len(circuit)) if self.timing else None
+                    engine = DensityMatrixEngine()
+                    engine.trace = trace
+                    engine.noise = noise
+                    start_time = time.perf_counter_ns()
+                    engine.start(num_qubits, dtype=self.dtype)
+                    ideal = np.zeros((1, 1 << num_qubits), dtype=self.dtype)
+                    ideal[0, 0] = 1
+                    for step, (gate, target, control, matrix) in enumerate(circuit.operations()):
+                        engine.apply(gate, target, control, matrix)
+                        apply_gate(ideal, gate, target, control, matrix)
+                        performance_data[f"step_{step}"] = _step_entry(gate, step, target, control)
+                        if trace is not None:
+                            performance_data[f"step_{step}"]['time'] = trace.operation_ns[step] / 1e6
+                    state = engine.finish()
+                    elapsed = time.perf_counter_ns() - start_time
+
+                if trace is not None:
+                    performance_data['trace'] = {
+                        'engine': engine.name,
+                        'operation_ns': trace.operation_ns[:trace.count],
+                        'resumed': 0,
+                        'step_ns': trace.operation_ns[:trace.count].astype(np.float64),
+                        'finish_ns': trace.finish_ns
+                    }
+                performance_data['density'] = {'bytes': state.nbytes, 'time_ms': elapsed / 1e6,
+                                               'queued_ms': queued_ms}
+
+                result = {
+                    'state_vector': None,
+                    'probabilities': state.probabilities(),
+                    'fidelity': state.fidelity(ideal[0]),
+                    'performance_data': performance_data,
+                    'precision': self.precision,
+                    'success': True,
+                    **state.result_fields()
+                }
+                if key is not None:
+                    self.cache.put(key, result)
+
+            rng = self.rng if seed is None else np.random.default_rng(seed)
+            result['shots'] = shots
+            if shots is not None:
+                outcomes, counts = sample_distribution(result['probabilities'], shots, rng)
+                result['measurements'] = Measurements(outcomes, counts, shots, num_qubits)
+            return result
+
+        except Exception as e:
+            return _error_result(e)
+
+    def unitary(self, circuit_operations, num_qubits=None):
+        """Full unitary matrix of a circuit at the computer's precision.
+
+        The circuit is not optimized, so the matrix can also check the
+        optimizer's output. Registers are widened to `num_qubits` if given.
+        """
+        try:
+            circuit = _prepare_circuit(circuit_operations)
+            num_qubits = circuit.num_qubits if num_qubits is None else num_qubits
+            if num_qubits < circuit.num_qubits:
+                raise ValueError(f"The circuit needs {circuit.num_qubits} qubits.")
+            _check_unitary_size(num_qubits)
+
+            key = None
+            if self.cache is not None:
+                key = circuit_key(circuit, None, None, ('unitary', num_qubits), precision=self.precision)
+            cached = self._cached_result(key, traced=False)
+            if cached is not None:
+                return cached
+
+            with self.admission.reserve(np.dtype(self.dtype).itemsize << 2 * num_qubits, self.session):
+                start_time = time.perf_counter_ns()
+                matrix = circuit_unitary(circuit, num_qubits, self.dtype)
+                elapsed = time.perf_counter_ns() - start_time
+
+            result = {
+                'unitary': matrix,
+                'num_qubits': num_qubits,
+                'time_ms': elapsed / 1e6,
+                'precision': self.precision,
+                'success': True
+            }
+            if key is not None:
+                self.cache.put(key, result)
+            return result
+
+        except Exception as e:
+            return _error_result(e, "Unitary")
+
+    def check_optimization(self, circuit_operations):
+        """Optimize a circuit and check it still has the original's unitary.
+
+        The check pushes the identity through both circuits, so it needs two
+        double-precision (2**n, 2**n) matrices' worth of memory and is limited
+        to EQUIVALENCE_CHECK_MAX_QUBITS.
+        """
+        try:
+            circuit = _prepare_circuit(circuit_operations)
+            if circuit.num_qubits > EQUIVALENCE_CHECK_MAX_QUBITS:
+                raise ValueError(f"Optimizations are only checked up to {EQUIVALENCE_CHECK_MAX_QUBITS} qubits.")
+
+            key = None
+            if self.cache is not None:
+                key = circuit_key(circuit, None, None, 'optimization-check')
+            cached = self._cached_result(key, traced=False)
+            if cached is not None:
+                return cached
+
+            optimized, report = optimize_circuit(circuit)
+            # The identity batch plus the kernels' temporaries, about one more matrix
+            reserved = 2 * np.dtype(np.complex128).itemsize << 2 * circuit.num_qubits
+            with self.admission.reserve(reserved, self.session):
+                start_time = time.perf_counter_ns()
+                report['equivalent'] = circuits_equivalent(circuit, optimized, circuit.num_qubits)
+                elapsed = time.perf_counter_ns() - start_time
+
+            result = {
+                'report': report,
+                'time_ms': elapsed / 1e6,
+                'success': True
+            }
+            if key is not None:
+                self.cache.put(key, result)
+            return result
+
+        except Exception as e:
+            return _error_result(e, "Optimization check")
+
+    def expectation(self, circuit_operations, observables):
+        """Expectation value of a weighted sum of Pauli strings after a circuit.
+
+        `observables` maps Pauli labels such as 'ZZI' (qubit 0 is the
+        rightmost letter) to real coefficients. Terms are grouped so that each
+        group agrees on the basis of every qubit it touches; the final state
+        is rotated once per group and each term is then a parity-weighted sum
+        of the rotated probabilities.
+        """
+        try:
+            circuit = _prepare_circuit(circuit_operations)
+            terms = [(label, parse_pauli_label(label, circuit.num_qubits), float(coefficient))
+                     for label, coefficient in dict(observables).items()]
+            if not terms:
+                raise ValueError("No observables given.")
+
+            # The exact result is cached, so repeated observables reuse the state
+            result = self.simulate_circuit(circuit, shots=None, require_statevector=True)
+            if not result['success']:
+                return result
+            statevector = result['state_vector']
+            if statevector is None:
+                raise ValueError(
+                    f"Expectation values need a dense state; use at most "
+                    f"{STATEVECTOR_EXPANSION_MAX_QUBITS} qubits or a statevector engine.")
+
+            indices = np.arange(len(statevector), dtype=np.int64)
+            values = {}
+            groups = group_commuting_terms([masks for _, masks, _ in terms])
+            for x_mask, z_mask, members in groups:
+                # One basis rotation serves every term in the group
+                rotated = np.array(statevector)
+                for qubit in range(circuit.num_qubits):
+                    if x_mask >> qubit & 1:
+                        basis = 'Y' if z_mask >> qubit & 1 else 'X'
+                        apply_single_qubit_gate(rotated, BASIS_ROTATIONS[basis], qubit)
+                probabilities = np.abs(rotated) ** 2
+
+                for i in members:
+                    label, (x, z), _ = terms[i]
+                    parity = (np.bitwise_count(indices & (x | z)) & 1).astype(np.int8)
+                    values[label] = float(probabilities @ (1 - 2 * parity))
+
             return {
-                'error': f"Simulation error: {str(e)}",
-                'success': False
+                'expectation': sum(coefficient * values[label] for label, _, coefficient in terms),
+                'terms': values,
+                'groups': [[terms[i][0] for i in members] for _, _, members in groups],
+                'success': True
             }
 
+        except Exception as e:
+            return _error_result(e, "Expectation")
+
     def validate_circuit(self, circuit_operations):
         """Validate circuit operations before simulation."""
-        if not circuit_operations:
-            raise ValueError("Circuit is empty. Please add quantum gates.")
+        if not isinstance(circuit_operations, Circuit):
+            if not circuit_operations:
+                raise ValueError("Circuit is empty. Please add quantum gates.")
+            for i, op in enumerate(circuit_operations):
+                if 'gate' in op and 'target' not in op:
+                    raise ValueError(f"Operation #{i+1} is missing target qubit.")
+        _prepare_circuit(circuit_operations)
 
-        for i, op in enumerate(circuit_operations):
-            if 'gate' not in op:
-                raise ValueError(f"Operation #{i+1} is missing gate type.")
-            if op['gate'] not in self.gates:
-                raise ValueError(f"Operation #{i+1} uses invalid gate '{op['gate']}'")
-            if 'target' not in op:
-                raise ValueError(f"Operation #{i+1} is missing target qubit.")
-            if op['gate'] in ['CNOT', 'CZ'] and 'control' not in op:
-                raise ValueError(f"Operation #{i+1} requires control qubit.")
+def sample_outcomes(statevector, shots, rng=None):
+    """Draw shots from the Born-rule probabilities of a statevector.
+
+    One multinomial draw covers every shot, so the cost depends on the
+    register size rather than the shot count. Returns the distinct basis
+    indices as uint64 together with their counts.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    # Normalize in double precision whatever the amplitude precision;
+    # multinomial rejects single-precision weights that round past 1
+    probabilities = np.square(np.abs(statevector), dtype=np.float64)
+    probabilities /= probabilities.sum()
+    return sample_distribution(probabilities, shots, rng)
+
+def sample_distribution(probabilities, shots, rng):
+    """Draw shots from a normalized outcome distribution in one multinomial step.
+
+    Returns the distinct basis indices as uint64 together with their counts.
+    """
+    counts = rng.multinomial(shots, probabilities)
+    drawn = np.flatnonzero(counts)
+    return drawn.astype(np.uint64), counts[drawn]
+
+def statevector_columns(statevector):
+    """Real and imaginary parts of a statevector as separate columns.
+
+    Arrow tables and JSON have no complex type, so displays and exports take
+    the parts, which keep the statevector's own float precision.
+    """
+    return {'real': statevector.real, 'imag': statevector.imag}
+
+def parse_pauli_label(label, num_qubits):
+    """Turn a Pauli label into (x_mask, z_mask) bitmasks; qubit 0 is the rightmost letter."""
+    if len(label) != num_qubits or set(label) - set('IXYZ'):
+        raise ValueError(f"Observable '{label}' must be {num_qubits} letters from I, X, Y, Z.")
+    x_mask = z_mask = 0
+    for qubit, letter in enumerate(reversed(label)):
+        if letter in 'XY':
+            x_mask |= 1 << qubit
+        if letter in 'YZ':
+            z_mask |= 1 << qubit
+    return x_mask, z_mask
+
+def group_commuting_terms(masks):
+    """Greedily group Pauli terms that agree on every qubit they share.
+
+    Terms in a group commute qubit by qubit, so one basis rotation measures
+    them all. Returns (x_mask, z_mask, positions) per group, where the masks
+    give the group's basis on every qubit its terms touch.
+    """
+    groups = []
+    for position, (x, z) in enumerate(masks):
+        for group in groups:
+            shared = (x | z) & (group['x'] | group['z'])
+            if not ((x ^ group['x']) | (z ^ group['z'])) & shared:
+                group['x'] |= x
+                group['z'] |= z
+                group['members'].append(position)
+                break
+        else:
+            groups.append({'x': x, 'z': z, 'members': [position]})
+    return [(group['x'], group['z'], group['members']) for group in groups]
+
+def top_k_indices(weights, k):
+    """Positions of the k largest weights, largest first.
+
+    argpartition finds them in O(len(weights)); only the k winners are sorted.
+    """
+    k = min(k, len(weights))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(weights, len(weights) - k)[len(weights) - k:]
+    return top[np.argsort(weights[top], kind='stable')[::-1]]
+
+def top_k_probabilities(probabilities, k):
+    """The k most likely basis states of a dense distribution as (indices, probabilities)."""
+    indices = top_k_indices(probabilities, k)
+    return indices, probabilities[indices]
+
+def _check_marginal_qubits(qubits, num_qubits):
+    qubits = [int(qubit) for qubit in qubits]
+    if not qubits:
+        raise ValueError("Select at least one qubit for the marginal.")
+    if len(set(qubits)) != len(qubits):
+        raise ValueError("Marginal qubits must be distinct.")
+    if not all(0 <= qubit < num_qubits for qubit in qubits):
+        raise ValueError(f"Marginal qubits must be between 0 and {num_qubits - 1}.")
+    return qubits
+
+def marginal_probabilities(probabilities, qubits):
+    """Sum a dense distribution over every qubit outside `qubits`.
+
+    The array is viewed as a tensor with one axis of length 2 per qubit and
+    reduced in one pass. Index bit i of the result is qubits[i].
+    """
+    num_qubits = len(probabilities).bit_length() - 1
+    qubits = _check_marginal_qubits(qubits, num_qubits)
+
+    # Axis 0 of the tensor is the most significant qubit
+    tensor = probabilities.reshape([2] * num_qubits)
+    kept = [num_qubits - 1 - qubit for qubit in reversed(qubits)]
+    tensor = np.moveaxis(tensor, kept, range(len(qubits)))
+    return tensor.reshape(1 << len(qubits), -1).sum(axis=1)
+
+def wilson_intervals(counts, shots, confidence=CONFIDENCE_LEVEL):
+    """Wilson score intervals for binomial proportions, as a (k, 2) array."""
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = counts / shots
+    denominator = 1 + z ** 2 / shots
+    centre = (p + z ** 2 / (2 * shots)) / denominator
+    half = z * np.sqrt(p * (1 - p) / shots + z ** 2 / (4 * shots ** 2)) / denominator
+    return np.column_stack([np.maximum(centre - half, 0), np.minimum(centre + half, 1)])
+
+def merge_outcomes(outcomes, counts, more_outcomes, more_counts):
+    """Combine two sets of distinct packed outcomes, summing shared counts."""
+    unique, inverse = np.unique(
+        np.concatenate([outcomes, more_outcomes]), axis=0, return_inverse=True)
+    merged = np.bincount(inverse.ravel(), weights=np.concatenate([counts, more_counts]),
+                         minlength=len(unique))
+    return unique, merged.astype(np.int64)
+
+def sample_adaptive(draw, budget, tolerance, rng, confidence=CONFIDENCE_LEVEL):
+    """Draw shots in batches until every confidence interval is narrower than tolerance.
+
+    `draw(shots, rng)` returns distinct outcomes and their counts. Each batch
+    is sized from the current estimates to close the widest interval in one
+    more step, and sampling stops once the shot budget is spent. Returns the
+    merged outcomes and counts, the shots spent and whether the tolerance was met.
+    """
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    total = min(ADAPTIVE_BATCH_SHOTS, budget)
+    outcomes, counts = draw(total, rng)
+
+    while True:
+        intervals = wilson_intervals(counts, total, confidence)
+        if np.max(intervals[:, 1] - intervals[:, 0]) < tolerance:
+            return outcomes, counts, total, True
+        if total >= budget:
+            return outcomes, counts, total, False
+
+        # Normal-approximation estimate of the shots the widest interval needs
+        p = counts / total
+        required = int(np.ceil(np.max(4 * z ** 2 * p * (1 - p)) / tolerance ** 2))
+        batch = min(budget - total, max(required - total, ADAPTIVE_BATCH_SHOTS))
+        more_outcomes, more_counts = draw(batch, rng)
+        outcomes, counts = merge_outcomes(outcomes, counts, more_outcomes, more_counts)
+        total += batch
 
 def run_sample_circuit():
     """Run a sample quantum circuit (Hadamard gate on |0⟩ state)."""
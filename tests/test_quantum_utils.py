@@ -0,0 +1,505 @@
+import threading
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import quantum_utils
+from quantum_utils import (BackendPool, DensityMatrixEngine, KernelThreads, Measurements, MemmapState,
+                           QuantumComputer, SimulationCache, as_circuit, optimize_circuit, plan_engine,
+                           wilson_intervals)
+
+BELL = [{'gate': 'H', 'target': 0}, {'gate': 'CNOT', 'target': 1, 'control': 0}]
+CLIFFORD_GATES = ('H', 'X', 'Y', 'Z', 'CNOT', 'CZ')
+ALL_GATES = CLIFFORD_GATES + ('U',)
+
+
+def _random_circuit(rng, num_qubits, depth, gates=ALL_GATES):
+    circuit = []
+    for _ in range(depth):
+        gate = gates[rng.integers(len(gates))]
+        if gate in ('CNOT', 'CZ'):
+            target, control = rng.choice(num_qubits, size=2, replace=False).tolist()
+            circuit.append({'gate': gate, 'target': target, 'control': control})
+        elif gate == 'U':
+            # Haar-random up to phases: the Q of a complex Gaussian matrix
+            matrix, _ = np.linalg.qr(rng.normal(size=(2, 2)) + 1j * rng.normal(size=(2, 2)))
+            circuit.append({'gate': gate, 'target': int(rng.integers(num_qubits)), 'matrix': matrix})
+        else:
+            circuit.append({'gate': gate, 'target': int(rng.integers(num_qubits))})
+    return circuit
+
+
+def test_unseeded_runs_reuse_the_state_but_draw_fresh_samples():
+    cache = SimulationCache()
+    qc = QuantumComputer(engine='numpy', cache=cache)
+    first = qc.simulate_circuit(BELL, shots=1000)
+    second = qc.simulate_circuit(BELL, shots=1000)
+    assert first['success'] and second['success']
+    assert first['measurements'] is not second['measurements']
+    assert cache.hits == 1
+
+
+def test_seeded_runs_repeat_their_counts_from_the_cache():
+    cache = SimulationCache()
+    qc = QuantumComputer(engine='numpy', cache=cache)
+    first = qc.simulate_circuit(BELL, shots=1000, seed=3)
+    second = qc.simulate_circuit(BELL, shots=500, seed=3)
+    third = qc.simulate_circuit(BELL, shots=1000, seed=3)
+    assert second['shots'] == 500
+    assert dict(third['measurements'].items()) == dict(first['measurements'].items())
+    assert cache.hits == 2
+
+
+def test_unseeded_density_runs_reuse_the_matrix():
+    cache = SimulationCache()
+    qc = QuantumComputer(engine='numpy', cache=cache)
+    first = qc.simulate_density(BELL, shots=1000)
+    second = qc.simulate_density(BELL, shots=1000)
+    assert first['measurements'] is not second['measurements']
+    assert cache.hits == 1
+
+
+def test_cached_performance_data_is_not_shared():
+    qc = QuantumComputer(engine='numpy', cache=SimulationCache())
+    first = qc.simulate_circuit(BELL, shots=100)
+    first['performance_data']['plan']['engine'] = 'changed'
+    second = qc.simulate_circuit(BELL, shots=100)
+    assert second['performance_data']['plan']['engine'] == 'numpy'
+    assert second['performance_data'] is not first['performance_data']
+
+
+def test_batched_results_do_not_depend_on_grouping():
+    single = [{'gate': 'H', 'target': 0}]
+    qc = QuantumComputer(engine='numpy', cache=SimulationCache())
+    alone = qc.simulate_many([BELL, single], seed=7)[1]['measurements']
+    # A two-qubit neighbour puts the single-qubit circuit in a different group order
+    grouped = qc.simulate_many([[{'gate': 'X', 'target': 0}], single], seed=7)[1]['measurements']
+    assert dict(alone.items()) == dict(grouped.items())
+
+
+def test_batched_results_do_not_share_cache_entries():
+    cache = SimulationCache()
+    qc = QuantumComputer(engine='numpy', cache=cache)
+    qc.simulate_many([BELL], seed=7)
+    qc.simulate_circuit(BELL, seed=7)
+    assert cache.hits == 0
+
+
+def test_batched_results_match_single_runs():
+    rng = np.random.default_rng(5)
+    circuits = [_random_circuit(rng, num_qubits, 20) for num_qubits in (2, 3, 3, 4, 2)]
+    qc = QuantumComputer(engine='numpy', cache=None)
+    batched = qc.simulate_many(circuits, shots=500, seed=1)
+    for circuit, result in zip(circuits, batched):
+        single = qc.simulate_circuit(circuit, shots=None)
+        assert np.allclose(result['state_vector'], single['state_vector'])
+        assert result['measurements'].counts.sum() == 500
+
+
+def test_unseeded_noisy_runs_are_not_cached():
+    cache = SimulationCache()
+    qc = QuantumComputer(engine='numpy', cache=cache)
+    first = qc.simulate_noisy(BELL, shots=200, trajectories=4)
+    second = qc.simulate_noisy(BELL, shots=200, trajectories=4)
+    assert first['success'] and second['success']
+    assert first['measurements'] is not second['measurements']
+    assert cache.hits == 0
+
+
+def test_seeded_noisy_runs_do_not_depend_on_batching(monkeypatch):
+    qc = QuantumComputer(engine='numpy', cache=None)
+    whole = qc.simulate_noisy(BELL, shots=500, trajectories=16, seed=5)
+    # One trajectory per batch
+    monkeypatch.setattr(quantum_utils, 'TRAJECTORY_BATCH_BYTES', 1)
+    split = qc.simulate_noisy(BELL, shots=500, trajectories=16, seed=5)
+    assert split['performance_data']['noise']['batches'] == 16
+    assert dict(split['measurements'].items()) == dict(whole['measurements'].items())
+
+
+def test_optimized_circuits_keep_their_unitary():
+    rng = np.random.default_rng(7)
+    qc = QuantumComputer(engine='numpy', cache=None)
+    removed = 0
+    for _ in range(20):
+        # Three qubits and few gate kinds leave many pairs to cancel
+        circuit = _random_circuit(rng, 3, 40, ('H', 'X', 'Z', 'CNOT', 'CZ', 'U'))
+        optimized, report = optimize_circuit(circuit)
+        removed += report['removed']
+        expected = qc.unitary(circuit, num_qubits=3)['unitary']
+        assert np.allclose(qc.unitary(optimized, num_qubits=3)['unitary'], expected)
+    assert removed > 0
+
+
+def test_optimization_check_is_cached():
+    cache = SimulationCache()
+    qc = QuantumComputer(engine='numpy', cache=cache)
+    circuit = BELL + [{'gate': 'X', 'target': 0}, {'gate': 'X', 'target': 0}]
+    first = qc.check_optimization(circuit)
+    second = qc.check_optimization(circuit)
+    assert first['success'] and first['report']['equivalent']
+    assert first['report']['removed'] == 2
+    assert second['report'] == first['report']
+    assert cache.hits == 1
+
+
+def _record_closes(monkeypatch):
+    closed = []
+    close = MemmapState.close
+
+    def recording_close(state):
+        closed.append(state)
+        close(state)
+    monkeypatch.setattr(MemmapState, 'close', recording_close)
+    return closed
+
+
+def test_cached_arrays_are_read_only():
+    qc = QuantumComputer(engine='numpy', cache=SimulationCache())
+    density = qc.simulate_density(BELL, seed=1)
+    unitary = qc.unitary(BELL)
+    for array in (density['density_matrix'], density['probabilities'], unitary['unitary']):
+        assert not array.flags.writeable
+
+
+def test_cached_mps_is_copied_for_each_caller():
+    qc = QuantumComputer(engine='mps', cache=SimulationCache())
+    first = qc.simulate_circuit(BELL, shots=None)
+    second = qc.simulate_circuit(BELL, shots=None)
+    assert second['mps'] is not first['mps']
+    assert np.allclose(second['mps'].to_statevector(), first['mps'].to_statevector())
+
+
+@pytest.mark.parametrize('engine', ['numpy', 'sparse'])
+@pytest.mark.parametrize('shots', [None, 1000, 100000])
+def test_dense_runs_stay_within_their_reservation(engine, shots):
+    n = 20
+    circuit = ([{'gate': 'H', 'target': q} for q in range(n)]
+               + [{'gate': 'CNOT', 'target': q, 'control': q - 1} for q in range(1, n)]
+               + [{'gate': 'U', 'target': q, 'matrix': [[1, 0], [0, 1j]]} for q in range(n)])
+    qc = QuantumComputer(engine=engine, cache=None)
+    tracemalloc.start()
+    try:
+        result = qc.simulate_circuit(circuit, shots=shots)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert result['success']
+    # NumPy's iterator buffers and the per-gate bookkeeping are not modelled
+    assert peak <= result['performance_data']['plan']['admission']['reserved_bytes'] + (1 << 20)
+
+
+def _phase_layer(num_qubits):
+    return ([{'gate': 'H', 'target': q} for q in range(num_qubits)]
+            + [{'gate': 'U', 'target': q, 'matrix': [[1, 0], [0, 1j]]} for q in range(num_qubits)])
+
+
+def test_planner_picks_the_engine_that_fits_the_circuit():
+    ghz = [{'gate': 'H', 'target': 0}] + [{'gate': 'CNOT', 'target': q, 'control': q - 1} for q in range(1, 100)]
+    assert plan_engine(as_circuit(ghz))['engine'] == 'stabilizer'
+    assert plan_engine(as_circuit(_phase_layer(4)))['engine'] == 'numpy'
+
+
+def test_planner_downgrades_an_engine_over_budget():
+    circuit = as_circuit(_phase_layer(26))
+    plan = plan_engine(circuit, engine='numpy', max_bytes=64 << 20)
+    assert plan['downgraded_from'] == 'numpy'
+    assert plan['estimate']['bytes'] <= 64 << 20
+    with pytest.raises(ValueError, match="over the 64 MiB memory budget"):
+        plan_engine(circuit, engine='numpy', max_bytes=64 << 20, downgrade=False)
+
+
+def test_an_engine_that_cannot_run_the_circuit_is_an_error():
+    circuit = [{'gate': 'H', 'target': q} for q in range(14)]
+    qc = QuantumComputer(engine='sparse', cache=None)
+    result = qc.simulate_circuit(circuit, require_statevector=True)
+    assert not result['success']
+    assert "statevector output needs a dense engine" in result['error']
+
+
+def test_stabilizer_engine_matches_dense_numpy():
+    rng = np.random.default_rng(11)
+    reference = QuantumComputer(engine='numpy', cache=None)
+    stabilizer = QuantumComputer(engine='stabilizer', cache=None)
+    for _ in range(20):
+        circuit = _random_circuit(rng, 6, 30, CLIFFORD_GATES)
+        expected = reference.simulate_circuit(circuit, shots=None)['probabilities']
+        assert np.allclose(stabilizer.simulate_circuit(circuit, shots=None)['probabilities'], expected)
+        sampled = stabilizer.simulate_circuit(circuit, shots=2000, seed=1)['measurements']
+        assert (expected[sampled.outcomes.astype(np.int64)] > 0).all()
+
+
+def test_sparse_engine_matches_dense_numpy():
+    rng = np.random.default_rng(13)
+    reference = QuantumComputer(engine='numpy', cache=None)
+    sparse = QuantumComputer(engine='sparse', cache=None)
+    supports = []
+    for _ in range(20):
+        circuit = _random_circuit(rng, 10, 30)
+        expected = reference.simulate_circuit(circuit, shots=None)['state_vector']
+        result = sparse.simulate_circuit(circuit, shots=None, require_statevector=True)
+        assert np.allclose(result['state_vector'], expected)
+        supports.append(result.get('support'))
+    # Both the sparse path and the switch to dense arrays are covered
+    assert None in supports and any(supports)
+
+
+def test_mps_engine_matches_dense_numpy():
+    rng = np.random.default_rng(19)
+    reference = QuantumComputer(engine='numpy', cache=None)
+    mps = QuantumComputer(engine='mps', cache=None)
+    for _ in range(20):
+        # Six qubits never need more than the maximum bond, so nothing is truncated
+        circuit = _random_circuit(rng, 6, 40)
+        expected = reference.simulate_circuit(circuit, shots=None)['state_vector']
+        result = mps.simulate_circuit(circuit, shots=None, require_statevector=True)
+        assert result['truncation_error'] < 1e-10
+        assert np.allclose(result['state_vector'], expected)
+        sampled = mps.simulate_circuit(circuit, shots=2000, seed=1)['measurements']
+        assert (np.abs(expected[sampled.outcomes.astype(np.int64)]) > 1e-9).all()
+
+
+class SmallBlockState(MemmapState):
+    """Memmap state with two-qubit blocks, so small circuits need several passes."""
+
+    def __init__(self, num_qubits, dtype=np.complex128):
+        super().__init__(num_qubits, block_qubits=2, dtype=dtype)
+
+
+def test_memmap_engine_matches_dense_numpy(monkeypatch):
+    monkeypatch.setattr(quantum_utils, 'MemmapState', SmallBlockState)
+    rng = np.random.default_rng(23)
+    reference = QuantumComputer(engine='numpy', cache=None)
+    memmap = QuantumComputer(engine='memmap', cache=None, pool=BackendPool(size=1))
+    passes = 0
+    for _ in range(10):
+        circuit = _random_circuit(rng, 6, 30)
+        expected = reference.simulate_circuit(circuit, shots=None)['state_vector']
+        result = memmap.simulate_circuit(circuit, shots=None, require_statevector=True)
+        assert np.allclose(result['state_vector'], expected)
+        passes = max(passes, result['passes'])
+    assert passes > 1
+
+
+def test_stabilizer_sampling_stays_within_its_reservation():
+    n = 300
+    circuit = ([{'gate': 'H', 'target': q} for q in range(0, n, 2)]
+               + [{'gate': 'CNOT', 'target': q + 1, 'control': q} for q in range(0, n, 2)])
+    qc = QuantumComputer(engine='stabilizer', cache=None)
+    tracemalloc.start()
+    try:
+        result = qc.simulate_circuit(circuit, shots=100000)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert result['success']
+    assert peak <= result['performance_data']['plan']['admission']['reserved_bytes']
+
+
+def test_noiseless_density_matrix_matches_dense_numpy():
+    rng = np.random.default_rng(29)
+    qc = QuantumComputer(engine='numpy', cache=None)
+    for _ in range(10):
+        circuit = _random_circuit(rng, 4, 30)
+        statevector = qc.simulate_circuit(circuit, shots=None)['state_vector']
+        result = qc.simulate_density(circuit, shots=None)
+        assert np.allclose(result['density_matrix'], np.outer(statevector, statevector.conj()))
+        assert np.allclose(result['probabilities'], np.abs(statevector) ** 2)
+        assert result['purity'] == pytest.approx(1)
+        assert result['fidelity'] == pytest.approx(1)
+
+
+def test_density_engine_hands_its_state_over():
+    engine = DensityMatrixEngine()
+    engine.start(2)
+    engine.apply('H', 0)
+    state = engine.finish()
+    assert state.num_qubits == 2
+    assert engine.state is None
+
+
+def test_memmap_state_file_is_closed_after_a_run(monkeypatch):
+    closed = _record_closes(monkeypatch)
+    pool = BackendPool(size=1)
+    qc = QuantumComputer(engine='memmap', cache=None, pool=pool)
+    assert qc.simulate_circuit(BELL, shots=100)['success']
+    assert len(closed) == 1
+    with pool.borrow('memmap') as engine:
+        assert engine.state is None
+
+
+def test_failed_memmap_run_releases_its_state(monkeypatch):
+    closed = _record_closes(monkeypatch)
+
+    def failing_pass(state, operations, high):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(MemmapState, 'run_pass', failing_pass)
+    pool = BackendPool(size=1)
+    qc = QuantumComputer(engine='memmap', cache=None, pool=pool)
+    result = qc.simulate_circuit(BELL, shots=100)
+    assert not result['success']
+    assert len(closed) == 1
+    with pool.borrow('memmap') as engine:
+        assert engine.state is None
+
+
+MALFORMED = [
+    ([{'gate': 'CNOT', 'target': 1, 'control': 1}], "same qubit as control and target"),
+    ([{'gate': 'X', 'target': -1}], "negative target qubit"),
+    ([{'gate': 'CNOT', 'target': 1}], "requires control qubit"),
+]
+
+ENTRY_POINTS = [
+    lambda qc, circuit: qc.simulate_circuit(circuit, shots=10),
+    lambda qc, circuit: qc.simulate_many([circuit])[0],
+    lambda qc, circuit: qc.simulate_noisy(circuit, shots=10),
+    lambda qc, circuit: qc.simulate_density(circuit),
+    lambda qc, circuit: qc.unitary(circuit),
+    lambda qc, circuit: qc.check_optimization(circuit),
+    lambda qc, circuit: qc.expectation(circuit, {'Z': 1.0}),
+]
+
+
+@pytest.mark.parametrize('circuit, message', MALFORMED)
+@pytest.mark.parametrize('entry_point', ENTRY_POINTS)
+def test_malformed_circuits_are_rejected(entry_point, circuit, message):
+    result = entry_point(QuantumComputer(engine='numpy', cache=None), circuit)
+    assert not result['success']
+    assert message in result['error']
+
+
+def test_mps_falls_back_when_the_svd_does_not_converge(monkeypatch):
+    ghz = [{'gate': 'H', 'target': 0}] + [{'gate': 'CNOT', 'target': q, 'control': q - 1} for q in range(1, 4)]
+    expected = QuantumComputer(engine='numpy', cache=None).simulate_circuit(ghz, shots=None)
+
+    def failing_svd(*args, **kwargs):
+        raise np.linalg.LinAlgError("SVD did not converge")
+    monkeypatch.setattr(np.linalg, 'svd', failing_svd)
+    result = QuantumComputer(engine='mps', cache=None).simulate_circuit(ghz, shots=None)
+    assert result['success']
+    assert np.allclose(result['probabilities'], expected['probabilities'])
+
+
+def test_kernel_threads_can_be_reconfigured_while_running():
+    def scale(block, factor):
+        block *= factor
+    threads = KernelThreads(threads=4, min_qubits=1)
+    errors = []
+    stop = threading.Event()
+
+    def run():
+        state = np.ones((1, 2, 64))
+        try:
+            while not stop.is_set():
+                threads.run(scale, state, (2,), 1.0)
+        except Exception as e:
+            errors.append(e)
+    runners = [threading.Thread(target=run) for _ in range(4)]
+    for runner in runners:
+        runner.start()
+    for i in range(1000):
+        threads.configure(threads=2 + i % 3)
+    stop.set()
+    for runner in runners:
+        runner.join()
+    assert errors == []
+
+
+def test_wilson_intervals_match_known_bounds():
+    bounds = wilson_intervals(np.array([50, 0, 100]), 100)
+    assert np.allclose(bounds, [[0.4038, 0.5962], [0, 0.0370], [0.9630, 1]], atol=1e-4)
+
+
+def test_wilson_intervals_cover_the_true_probability():
+    rng = np.random.default_rng(0)
+    bounds = wilson_intervals(rng.binomial(200, 0.1, size=20000), 200)
+    coverage = ((bounds[:, 0] <= 0.1) & (0.1 <= bounds[:, 1])).mean()
+    assert 0.94 <= coverage <= 0.97
+
+
+def test_measurement_marginals_sum_the_other_qubits():
+    measurements = Measurements(np.array([0b00, 0b01, 0b11, 0b10], dtype=np.uint64),
+                                np.array([10, 20, 30, 40]), 100, 2)
+    assert {state: entry['count'] for state, entry in measurements.marginal([1]).items()} == {'0': 30, '1': 70}
+    # Bit i of a marginal outcome is qubits[i], so listing both in reverse swaps them
+    swapped = measurements.marginal([1, 0])
+    assert {state: entry['count'] for state, entry in swapped.items()} == {
+        '00': 10, '01': 40, '11': 30, '10': 20}
+    assert [state for state, _ in measurements.top_k(2)] == ['10', '11']
+
+
+def test_wide_measurement_marginals_read_the_right_words():
+    # Qubits 3 and 69 are set in the first outcome, qubit 69 alone in the second
+    outcomes = np.array([[1 << 3, 1 << 5], [0, 1 << 5]], dtype=np.uint64)
+    measurements = Measurements(outcomes, np.array([3, 7]), 10, 70)
+    marginal = measurements.marginal([3, 69])
+    assert {state: entry['count'] for state, entry in marginal.items()} == {'11': 3, '10': 7}
+    assert measurements.top_k(1)[0][0] == '1' + '0' * 69
+
+
+PAULIS = {'I': np.eye(2), 'X': np.array([[0, 1], [1, 0]]), 'Y': np.array([[0, -1j], [1j, 0]]),
+          'Z': np.diag([1, -1])}
+
+
+def test_expectation_values_of_entangled_states():
+    qc = QuantumComputer(engine='numpy', cache=None)
+    bell = qc.expectation(BELL, {'ZZ': 1.0, 'XX': 1.0, 'YY': 1.0, 'ZI': 1.0})
+    assert bell['success']
+    assert bell['terms'] == pytest.approx({'ZZ': 1, 'XX': 1, 'YY': -1, 'ZI': 0}, abs=1e-12)
+    ghz = BELL + [{'gate': 'CNOT', 'target': 2, 'control': 1}]
+    result = qc.expectation(ghz, {'XXX': 0.5, 'ZZI': 0.25, 'YYX': 1.0})
+    assert result['terms'] == pytest.approx({'XXX': 1, 'ZZI': 1, 'YYX': -1}, abs=1e-12)
+    assert result['expectation'] == pytest.approx(-0.25)
+
+
+def test_expectation_values_match_dense_pauli_matrices():
+    rng = np.random.default_rng(17)
+    qc = QuantumComputer(engine='numpy', cache=None)
+    for _ in range(10):
+        circuit = _random_circuit(rng, 3, 20)
+        statevector = qc.simulate_circuit(circuit, shots=None)['state_vector']
+        num_qubits = len(statevector).bit_length() - 1
+        labels = [''.join(rng.choice(list('IXYZ'), size=num_qubits)) for _ in range(6)]
+        result = qc.expectation(circuit, dict.fromkeys(labels, 1.0))
+        for label in labels:
+            # The leftmost letter acts on the highest qubit, as in a Kronecker product
+            matrix = np.array([[1]])
+            for letter in label:
+                matrix = np.kron(matrix, PAULIS[letter])
+            assert result['terms'][label] == pytest.approx(np.vdot(statevector, matrix @ statevector).real)
+
+
+def _kron_operator(num_qubits, factors):
+    # Qubit 0 is the least significant index bit, so it is the last Kronecker factor
+    matrix = np.array([[1]])
+    for qubit in reversed(range(num_qubits)):
+        matrix = np.kron(matrix, factors.get(qubit, PAULIS['I']))
+    return matrix
+
+
+def _reference_unitary(circuit, num_qubits):
+    single = dict(PAULIS, H=np.array([[1, 1], [1, -1]]) / np.sqrt(2))
+    unitary = np.eye(1 << num_qubits, dtype=complex)
+    for op in circuit:
+        gate, target = op['gate'], op['target']
+        if gate in ('CNOT', 'CZ'):
+            flip = PAULIS['X' if gate == 'CNOT' else 'Z']
+            projectors = (np.diag([1, 0]), np.diag([0, 1]))
+            matrix = (_kron_operator(num_qubits, {op['control']: projectors[0]})
+                      + _kron_operator(num_qubits, {op['control']: projectors[1], target: flip}))
+        else:
+            matrix = _kron_operator(num_qubits, {target: op['matrix'] if gate == 'U' else single[gate]})
+        unitary = matrix @ unitary
+    return unitary
+
+
+def test_circuit_unitary_matches_kronecker_products():
+    rng = np.random.default_rng(31)
+    qc = QuantumComputer(engine='numpy', cache=None)
+    for _ in range(10):
+        circuit = _random_circuit(rng, 4, 25)
+        unitary = qc.unitary(circuit, num_qubits=4)['unitary']
+        assert np.allclose(unitary, _reference_unitary(circuit, 4))
+        # Column b is the image of basis state b, so column 0 is the simulated state
+        statevector = qc.simulate_circuit(circuit, shots=None)['state_vector']
+        assert np.allclose(qc.unitary(circuit)['unitary'][:, 0], statevector)